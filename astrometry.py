@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import time
+import numpy
+
+import coordinates
+
+#=============================================================================
+# Astrometry
+#=============================================================================
+#
+# Module: astrometry
+#
+# Local computation of sidereal time, hour angle and horizontal coordinates
+# from the site location and the host clock, so that these values do not
+# have to be queried from the mount.  All functions accept scalars or NumPy
+# arrays (of targets and/or times).
+#
+# Units: RA, hour angle and sidereal time in hours, declination, latitude,
+# longitude, azimuth and altitude in degrees.  Longitude is positive to the
+# east, azimuth is measured from north through east.  Times are Unix time
+# stamps (UTC seconds, as returned by time.time()).
+#
+# The sidereal time is accurate to about 0.1 s, which is well below the
+# resolution of the mount coordinate display.
+#
+#=============================================================================
+
+UNIX_EPOCH_JD = 2440587.5
+J2000_JD = 2451545.0
+SIDEREAL_RATE = 1.00273790935
+
+#-----------------------------------------------------------------------------
+# julian_date
+# Description:
+#	Convert Unix time stamps to Julian date.
+#-----------------------------------------------------------------------------
+
+def julian_date(t):
+	return numpy.asarray(t, dtype=float) / 86400.0 + UNIX_EPOCH_JD
+
+#-----------------------------------------------------------------------------
+# gmst
+# Description:
+#	Greenwich mean sidereal time [hour] at Unix time $t.
+#-----------------------------------------------------------------------------
+
+def gmst(t):
+	d = julian_date(t) - J2000_JD
+	return numpy.mod(18.697374558 + 24.06570982441908 * d, 24.0)
+
+#-----------------------------------------------------------------------------
+# lst
+# Description:
+#	Local mean sidereal time [hour] at Unix time $t and east longitude
+#	$longitude [deg].
+#-----------------------------------------------------------------------------
+
+def lst(t, longitude):
+	return numpy.mod(gmst(t) + numpy.asarray(longitude) / 15.0, 24.0)
+
+#-----------------------------------------------------------------------------
+# hour_angle
+# Description:
+#	Hour angle [hour] of $ra at Unix time $t, wrapped to [-12, 12).
+#-----------------------------------------------------------------------------
+
+def hour_angle(ra, t, longitude):
+	ha = lst(t, longitude) - numpy.asarray(ra, dtype=float)
+	return numpy.mod(ha + 12.0, 24.0) - 12.0
+
+#-----------------------------------------------------------------------------
+# equ2altaz
+# Synopsis:
+#	equ2altaz ha dec latitude
+# Description:
+#	Convert hour angle [hour] and declination [deg] to azimuth and altitude
+#	[deg] at $latitude.
+# Return:
+#	Tuple of azimuth and altitude.
+#-----------------------------------------------------------------------------
+
+def equ2altaz(ha, dec, latitude):
+	h = numpy.radians(numpy.asarray(ha, dtype=float) * 15.0)
+	d = numpy.radians(numpy.asarray(dec, dtype=float))
+	phi = numpy.radians(latitude)
+	sind, cosd = numpy.sin(d), numpy.cos(d)
+	sinp, cosp = numpy.sin(phi), numpy.cos(phi)
+	alt = numpy.arcsin(numpy.clip(sinp*sind + cosp*cosd*numpy.cos(h), -1, 1))
+	az = numpy.arctan2(-cosd*numpy.sin(h), cosp*sind - sinp*cosd*numpy.cos(h))
+	return numpy.mod(numpy.degrees(az), 360.0), numpy.degrees(alt)
+
+#-----------------------------------------------------------------------------
+# sin_altitude
+# Description:
+#	Sine of the altitude of hour angle [hour] and declination [deg] at
+#	$latitude. Cheaper than equ2altaz() when only limits are checked.
+#-----------------------------------------------------------------------------
+
+def sin_altitude(ha, dec, latitude):
+	h = numpy.radians(numpy.asarray(ha, dtype=float) * 15.0)
+	d = numpy.radians(numpy.asarray(dec, dtype=float))
+	phi = numpy.radians(latitude)
+	return numpy.sin(phi)*numpy.sin(d) + numpy.cos(phi)*numpy.cos(d)*numpy.cos(h)
+
+#-----------------------------------------------------------------------------
+# altaz2equ
+# Synopsis:
+#	altaz2equ az alt latitude
+# Description:
+#	Convert azimuth and altitude [deg] to hour angle [hour] and
+#	declination [deg] at $latitude.
+# Return:
+#	Tuple of hour angle and declination.
+#-----------------------------------------------------------------------------
+
+def altaz2equ(az, alt, latitude):
+	a = numpy.radians(numpy.asarray(az, dtype=float))
+	e = numpy.radians(numpy.asarray(alt, dtype=float))
+	phi = numpy.radians(latitude)
+	sine, cose = numpy.sin(e), numpy.cos(e)
+	sinp, cosp = numpy.sin(phi), numpy.cos(phi)
+	dec = numpy.arcsin(numpy.clip(sinp*sine + cosp*cose*numpy.cos(a), -1, 1))
+	ha = numpy.arctan2(-cose*numpy.sin(a), cosp*sine - sinp*cose*numpy.cos(a))
+	return numpy.degrees(ha) / 15.0, numpy.degrees(dec)
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
+# Site
+#=============================================================================
+#
+# Class: Site
+#
+# Geographical location of the telescope.  The Scope class reads it once
+# from the mount and keeps it, so the sidereal time and the horizontal
+# coordinates of any number of targets can be computed without further
+# queries.
+#
+#=============================================================================
+
+class Site(object):
+
+#-----------------------------------------------------------------------------
+# Site::__init__
+# Input:
+#	- longitude (%f):
+#		East longitude [deg].
+#	- latitude (%f):
+#		Latitude [deg].
+#-----------------------------------------------------------------------------
+
+	def __init__(self, longitude, latitude):
+		self.longitude = float(longitude)
+		self.latitude = float(latitude)
+		return
+
+#-----------------------------------------------------------------------------
+# Site::from_meade
+# Description:
+#	Create a site from the Meade Gg/Gt replies (dd:mm:ss strings).  The
+#	Meade longitude is positive to the west.
+#-----------------------------------------------------------------------------
+
+	@classmethod
+	def from_meade(cls, long, lat):
+		long = coordinates.parse_sexagesimal(long)
+		lat = coordinates.parse_sexagesimal(lat)
+		return cls(-long, lat)
+
+#-----------------------------------------------------------------------------
+# Site::lst
+# Description:
+#	Local sidereal time [hour] at $t (default: now).
+#-----------------------------------------------------------------------------
+
+	def lst(self, t=None):
+		if t is None:
+			t = time.time()
+		return lst(t, self.longitude)
+
+#-----------------------------------------------------------------------------
+# Site::hour_angle
+# Description:
+#	Hour angle [hour] of $ra at $t (default: now).
+#-----------------------------------------------------------------------------
+
+	def hour_angle(self, ra, t=None):
+		if t is None:
+			t = time.time()
+		return hour_angle(ra, t, self.longitude)
+
+#-----------------------------------------------------------------------------
+# Site::altaz
+# Synopsis:
+#	altaz ra dec t
+# Description:
+#	Azimuth and altitude [deg] of the targets at $ra [hour] and $dec [deg]
+#	at $t (default: now). Any of the inputs can be arrays, they are
+#	broadcast against each other.
+#-----------------------------------------------------------------------------
+
+	def altaz(self, ra, dec, t=None):
+		ha = self.hour_angle(ra, t)
+		return equ2altaz(ha, dec, self.latitude)
+
+#-----------------------------------------------------------------------------
+# Site::sin_altitude
+# Description:
+#	Sine of the altitude of the targets at $ra, $dec at $t (default: now).
+#-----------------------------------------------------------------------------
+
+	def sin_altitude(self, ra, dec, t=None):
+		ha = self.hour_angle(ra, t)
+		return sin_altitude(ha, dec, self.latitude)
+
+#-----------------------------------------------------------------------------
+# Site::radec
+# Synopsis:
+#	radec az alt t
+# Description:
+#	RA [hour] and Dec [deg] of the horizontal position $az, $alt [deg] at
+#	$t (default: now).
+#-----------------------------------------------------------------------------
+
+	def radec(self, az, alt, t=None):
+		ha, dec = altaz2equ(az, alt, self.latitude)
+		ra = numpy.mod(self.lst(t) - ha, 24.0)
+		return ra, dec
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
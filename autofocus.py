@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+import fleet
+
+#=============================================================================
+# Focus curve fit
+#=============================================================================
+
+#-----------------------------------------------------------------------------
+# fit_focus
+# Synopsis:
+#	fit_focus x y model
+# Input:
+#	- x, y (array):
+#		Focuser positions and focus metric (e.g. HFD, FWHM; smaller is
+#		better), shape (nstep, n): one column per focus curve.  NaN
+#		values are ignored.
+#	- model (%s):
+#		'parabola': y = a x^2 + b x + c
+#		'hyperbola': y^2 = a x^2 + b x + c, the hyperbola of the star
+#		size, which is a parabola in y^2.
+# Description:
+#	Fit all focus curves at once: the weighted normal equations of the
+#	columns are built with array operations and solved as one stack of
+#	3x3 systems.
+# Return:
+#	Array of the best focus positions (NaN if the curve has less than 3
+#	points or no minimum).
+#-----------------------------------------------------------------------------
+
+def fit_focus(x, y, model='parabola'):
+	x = numpy.asarray(x, dtype=float)
+	y = numpy.asarray(y, dtype=float)
+	if model == 'hyperbola':
+		y = y * y
+	w = numpy.isfinite(x) & numpy.isfinite(y)
+	n = w.sum(axis=0)
+
+	# Center and scale x per curve for a well conditioned system
+	x0 = numpy.nansum(numpy.where(w, x, 0.0), axis=0) / numpy.maximum(n, 1)
+	dx = numpy.where(w, x - x0, 0.0)
+	s = numpy.sqrt((dx * dx).sum(axis=0) / numpy.maximum(n, 1))
+	s = numpy.where(s > 0, s, 1.0)
+	u = dx / s
+	yw = numpy.where(w, y, 0.0)
+
+	a = numpy.array([u*u, u, w.astype(float)])		# (3, nstep, n)
+	a = numpy.where(w, a, 0.0)
+	m = numpy.einsum('ikn,jkn->nij', a, a)
+	v = numpy.einsum('ikn,kn->ni', a, yw)
+	c = numpy.einsum('nij,nj->ni', numpy.linalg.pinv(m), v)
+
+	ok = (n >= 3) & (c[:,0] > 0)
+	best = x0 - s * c[:,1] / numpy.where(ok, 2.0 * c[:,0], 1.0)
+	return numpy.where(ok, best, numpy.nan)
+
+#=============================================================================
+# AcquireError
+#=============================================================================
+#
+# Class: AcquireError
+#
+# Raised by a focus sweep step when the acquisition failed for one or more
+# IHUs, after all acquisitions of the step are done.  As in
+# fleet.FleetError, but self.errors is the dictionary of IHU number:
+# exception, and self.results the metrics of the step (NaN for the failed
+# IHUs).
+#
+#=============================================================================
+
+class AcquireError(fleet.FleetError):
+
+	what = 'acquisition'
+
+#=============================================================================
+# AutoFocus
+#=============================================================================
+#
+# Class: AutoFocus
+#
+# Focus sweep of many IHUs at once.  In every step the focusers of all
+# IHUs of a controller are moved with one SMTI burst and one MGC over the
+# combined bitmask, all controllers concurrently (see fleet.IHUFleet).
+#
+# The images are taken by the pluggable $acquire(ihu, position) callback,
+# which returns the focus metric of the IHU (smaller is better).  It is
+# started for each IHU as soon as its own focuser settles (see
+# IHUcontroller::motor_settle), so acquisition overlaps with the settling
+# of the other focusers.  The next step starts when all acquisitions of
+# the step are done.  If any of them failed, the sweep stops with
+# AcquireError; the exceptions are also kept in self.errors.
+#
+# The best focus of every IHU is fitted from the settled positions with
+# fit_focus().  The duration of the sweep is kept in self.sweep_time to
+# compare strategies (number of steps, width, model).
+#
+#=============================================================================
+
+class AutoFocus(object):
+
+#-----------------------------------------------------------------------------
+# AutoFocus::__init__
+# Input:
+#	- fleet (fleet.IHUFleet):
+#		The IHUs.
+#	- acquire (callable):
+#		acquire(ihu, position) -> focus metric.
+#	- model (%s):
+#		Focus curve model, see fit_focus().
+#-----------------------------------------------------------------------------
+
+	def __init__(self, fleet, acquire, model='hyperbola'):
+		self.fleet = fleet
+		self.acquire = acquire
+		self.model = model
+		self.positions = None
+		self.metrics = None
+		self.best = None
+		self.sweep_time = None
+		self.errors = {}
+		return
+
+#-----------------------------------------------------------------------------
+# AutoFocus::plan
+# Synopsis:
+#	plan center width nstep ihus
+# Description:
+#	Focuser positions of the sweep: $nstep equally spaced positions over
+#	$width steps around $center (scalar or array indexed by IHU number;
+#	default: the current positions).
+# Return:
+#	Array of shape (nstep, number of IHUs + 1), columns indexed by IHU
+#	number.
+#-----------------------------------------------------------------------------
+
+	def plan(self, center=None, width=1000, nstep=9, ihus=None):
+		if center is None:
+			center = self.fleet.get_positions('foc', ihus)
+		center = numpy.zeros(len(self.fleet.array({}))) + center
+		offset = numpy.linspace(-width / 2.0, width / 2.0, nstep)
+		return numpy.round(center[None,:] + offset[:,None])
+
+#-----------------------------------------------------------------------------
+# AutoFocus::run
+# Synopsis:
+#	run center width nstep ihus goto
+# Description:
+#	Run the focus sweep planned by AutoFocus::plan, fit the best focus of
+#	every IHU and, if $goto is True, move the focusers there.
+# Return:
+#	Array of the best focus positions indexed by IHU number.
+#-----------------------------------------------------------------------------
+
+	def run(self, center=None, width=1000, nstep=9, ihus=None, goto=True):
+		t0 = time.time()
+		self.errors = {}
+		plan = self.plan(center, width, nstep, ihus)
+		ihus = self.fleet.get_ihus(ihus)
+		groups = self.fleet.group(ihus, 'foc')
+		positions = numpy.empty(plan.shape)
+		positions.fill(numpy.nan)
+		metrics = positions.copy()
+		executor = ThreadPoolExecutor(max_workers=max(len(ihus), 1))
+		try:
+			for k in range(nstep):
+				self.step(executor, groups, plan[k], positions[k], metrics[k])
+		finally:
+			executor.shutdown()
+
+		self.positions, self.metrics = positions, metrics
+		self.best = fit_focus(positions, metrics, self.model)
+		if goto:
+			ok = [x for x in ihus if numpy.isfinite(self.best[x])]
+			if ok:
+				self.fleet.new(self.best, 'foc', ok)
+		self.sweep_time = time.time() - t0
+		return self.best
+
+#-----------------------------------------------------------------------------
+# AutoFocus::step
+# Description:
+#	Move the focusers to the $target positions and acquire the images.
+#	The settled positions and the metrics are written into $positions
+#	and $metrics (arrays indexed by IHU number).  IHUs whose target is
+#	unknown or out of the step limits of the focuser are skipped in this
+#	step, as are all IHUs of a controller which did not accept the
+#	targets; their entries stay NaN.  Failed acquisitions are collected
+#	and raised as AcquireError when the step is done. For internal use.
+#-----------------------------------------------------------------------------
+
+	def step(self, executor, groups, target, positions, metrics):
+		lock = threading.Lock()
+		pending = []
+
+		def acquire(ihu, pos):
+			metrics[ihu] = self.acquire(ihu, pos)
+
+		def move(number, c):
+			numbers, ids = groups[number]
+			ok = [i for i, x in enumerate(numbers)
+				if numpy.isfinite(target[x]) and
+					self.fleet.get_ihu(x).check_limits('foc', target[x])]
+			if not ok:
+				return None
+			numbers = [numbers[i] for i in ok]
+			ids = [ids[i] for i in ok]
+			ihu = dict(zip(ids, numbers))
+
+			def settled(id, pos):
+				positions[ihu[id]] = pos
+				with lock:
+					pending.append((ihu[id], executor.submit(acquire, ihu[id], pos)))
+
+			if not c.set_motor_target(ids, [int(target[x]) for x in numbers]):
+				return None
+			if c.motor_goto(ids) is False:
+				return None
+			return c.motor_settle(ids, callback=settled)
+
+		try:
+			self.fleet.map(move, sorted(groups))
+		finally:
+			errors = {}
+			for ihu, future in pending:
+				try:
+					future.result()
+				except Exception as e:
+					errors[ihu] = e
+			self.errors.update(errors)
+		if errors:
+			raise AcquireError(errors, metrics)
+		return
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
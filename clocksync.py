@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import time
+import calendar
+from collections import deque
+
+import numpy
+
+#=============================================================================
+# ClockSync
+#=============================================================================
+#
+# Class: ClockSync
+#
+# Estimator of the offset between the mount clock and the host clock, and
+# synchronization of the mount clock.
+#
+# The mount reports its local time (GL) with one second resolution only.
+# Every sample is a burst of GL, GC, GL sent at host time t0 and answered
+# by t1; if the mount shows M (converted to Unix time with the UTC offset
+# GG), its true time at the moment of the reply was in [M, M+1), and the
+# moment itself in [t0, t1].  So the offset (mount - host) is within
+# [M - t1, M + 1 - t0].  The intersection of the intervals of repeated
+# samples, spread over more than a second, narrows the offset to about
+# the round trip time (RTT), NTP style.  The estimate is the middle of the
+# intersection and the confidence bound is its half width.
+#
+# The offsets measured at different times are kept to estimate the drift
+# rate of the mount clock, which tells when the next check is needed.  The
+# clock is only set (SC/SL, and SG if requested) when the offset exceeds
+# the threshold.
+#
+# Units: seconds, Unix time stamps. The drift rate is in s/s.
+#
+#=============================================================================
+
+class ClockSync(object):
+
+#-----------------------------------------------------------------------------
+# ClockSync::__init__
+# Input:
+#	- scope (scope.Scope):
+#		Connected scope.
+#	- history (%d):
+#		Number of offset measurements kept for the drift rate.
+#-----------------------------------------------------------------------------
+
+	def __init__(self, scope, history=100):
+		self.scope = scope
+		self.utc_offset = None
+		self.offset = None
+		self.bound = None
+		self.rtt = None
+		self.drift = None
+		self.history = deque(maxlen=history)
+		return
+
+#-----------------------------------------------------------------------------
+# ClockSync::get_utc_offset
+# Description:
+#	Hours to add to the mount local time to get UTC (GG), queried once.
+#	For internal use.
+#-----------------------------------------------------------------------------
+
+	def get_utc_offset(self):
+		if self.utc_offset is None:
+			try:
+				self.utc_offset = float(self.scope.get_utc_offset())
+			except (TypeError, ValueError):
+				return None
+		return self.utc_offset
+
+#-----------------------------------------------------------------------------
+# ClockSync::sample
+# Description:
+#	Take one GL/GC/GL sample.
+# Return:
+#	Tuple of the offset interval (low, high) and the RTT, or None if the
+#	sample is not usable (timeout, date change during the burst).
+#-----------------------------------------------------------------------------
+
+	def sample(self):
+		utc = self.get_utc_offset()
+		if utc is None:
+			return None
+		t0 = time.time()
+		rcv = self.scope.command_pipeline(['GL', 'GC', 'GL'],
+			self.scope.get_timeout('query'))
+		t1 = time.time()
+		if not rcv or len(rcv) < 3 or rcv[2] < rcv[0]:
+			return None
+		m = self.mount_time(rcv[1], rcv[0], utc)
+		if m is None:
+			return None
+		return (m - t1, m + 1.0 - t0), t1 - t0
+
+#-----------------------------------------------------------------------------
+# ClockSync::mount_time
+# Description:
+#	Convert the mount date (MM/DD/YY) and local time (HH:MM:SS) replies to
+#	Unix time. For internal use.
+#-----------------------------------------------------------------------------
+
+	def mount_time(self, date, lt, utc):
+		try:
+			m, d, y = [int(x) for x in date.strip('#').split('/')]
+			hh, mm, ss = [int(x) for x in lt.strip('#').split(':')]
+		except ValueError:
+			return None
+		t = calendar.timegm((2000 + y, m, d, hh, mm, ss, 0, 0, 0))
+		return t + utc * 3600.0
+
+#-----------------------------------------------------------------------------
+# ClockSync::measure
+# Synopsis:
+#	measure nsample interval bound
+# Input:
+#	- nsample (%d):
+#		Maximum number of samples.
+#	- interval (%f):
+#		Time between the samples [s]. Should not divide one second.
+#	- bound (%f):
+#		Stop when the confidence bound is below this value [s].
+# Description:
+#	Estimate the clock offset (mount - host) from repeated samples, and
+#	update the drift rate.
+# Return:
+#	Tuple of the offset and its confidence bound [s], or (None, None).
+#-----------------------------------------------------------------------------
+
+	def measure(self, nsample=30, interval=0.07, bound=0.05):
+		low, high = -numpy.inf, numpy.inf
+		rtt = []
+		for i in range(nsample):
+			ret = self.sample()
+			if ret is not None:
+				(l, h), r = ret
+				if max(low, l) > min(high, h):
+					# Inconsistent with the earlier samples (clock set
+					# meanwhile): start again.
+					low, high, rtt = -numpy.inf, numpy.inf, []
+				low, high = max(low, l), min(high, h)
+				rtt.append(r)
+				if (high - low) / 2.0 < bound:
+					break
+			time.sleep(interval)
+
+		if not rtt:
+			return None, None
+		self.offset = (low + high) / 2.0
+		self.bound = (high - low) / 2.0
+		self.rtt = float(numpy.median(rtt))
+		self.history.append((time.time(), self.offset, self.bound))
+		self.update_drift()
+		return self.offset, self.bound
+
+#-----------------------------------------------------------------------------
+# ClockSync::update_drift
+# Description:
+#	Weighted linear fit of the offset history since the last clock set.
+#	For internal use.
+#-----------------------------------------------------------------------------
+
+	def update_drift(self):
+		if len(self.history) < 2:
+			return
+		t, offset, bound = numpy.array(self.history).T
+		if t[-1] - t[0] < 600.0:
+			return
+		w = 1.0 / numpy.maximum(bound, 0.01)
+		self.drift = float(numpy.polyfit(t - t[0], offset, 1, w=w)[0])
+		return
+
+#-----------------------------------------------------------------------------
+# ClockSync::sync
+# Synopsis:
+#	sync threshold utc_offset
+# Input:
+#	- threshold (%f):
+#		Maximum accepted offset [s].
+#	- utc_offset (%f):
+#		If given, the UTC offset of the mount is set too when it differs
+#		(hours to add to local time to get UTC).
+# Description:
+#	Measure the offset and set the mount clock if the offset is above
+#	$threshold.  The time, date and UTC offset commands are sent in one
+#	write, timed so that the mount second starts at the host second.
+# Return:
+#	The offset before the synchronization, or None if it can not be
+#	measured.
+#-----------------------------------------------------------------------------
+
+	def sync(self, threshold=1.0, utc_offset=None):
+		offset, bound = self.measure()
+		if offset is None:
+			return None
+		utc = self.get_utc_offset()
+		if utc_offset is not None and abs(utc_offset - utc) > 0.01:
+			utc = float(utc_offset)
+		elif abs(offset) <= max(threshold, bound):
+			return offset
+		self.set_clock(utc)
+		return offset
+
+#-----------------------------------------------------------------------------
+# ClockSync::set_clock
+# Description:
+#	Set the mount date and time to the host clock, and the UTC offset to
+#	$utc. For internal use.
+#
+#	SG and SL are answered by an unterminated '0' or '1', SC by '1' and,
+#	once the planetary data is updated, two '#' terminated lines.  SG and
+#	SL are sent first, so their answers are read with the first line of
+#	SC, and the exchange waits for both lines, so that no late reply is
+#	left for the next command.
+# Return:
+#	True if all commands were accepted, False otherwise.
+#-----------------------------------------------------------------------------
+
+	def set_clock(self, utc):
+		scope = self.scope
+		delay = (self.rtt or 0.0) / 2.0
+
+		# Send just before the next full second, so that the mount time
+		# is right when the command arrives.
+		now = time.time()
+		t = numpy.ceil(now + delay + 0.05)
+		time.sleep(max(t - delay - time.time(), 0.0))
+
+		lt = time.gmtime(t - utc * 3600.0)
+		cmds = []
+		if utc != self.utc_offset:
+			cmds.append('SG%+05.1f' % (utc,))
+		cmds.append('SL%02d:%02d:%02d' % (lt.tm_hour, lt.tm_min, lt.tm_sec))
+		cmds.append('SC%02d/%02d/%02d' % (lt.tm_mon, lt.tm_mday, lt.tm_year % 100))
+		acmd = ''.join([scope.formatstr % (x,) for x in cmds])
+		with scope.lock:
+			scope.flush_replies()
+			if not scope.write(acmd):
+				return False
+			rcv = scope.read_replies(2, scope.get_timeout('clock'))
+			if len(rcv) < 2:
+				scope.unread += 1
+		if not rcv or not rcv[0].startswith('1' * len(cmds)):
+			return False
+
+		self.utc_offset = utc
+		self.offset = 0.0
+		self.bound = None
+		self.history.clear()
+		return True
+
+#-----------------------------------------------------------------------------
+# ClockSync::next_check
+# Synopsis:
+#	next_check threshold tmin tmax
+# Description:
+#	Time [s] until the offset is expected to reach $threshold at the
+#	measured drift rate, limited to [$tmin, $tmax].
+#-----------------------------------------------------------------------------
+
+	def next_check(self, threshold=1.0, tmin=600.0, tmax=86400.0):
+		if self.offset is None or not self.drift:
+			return tmin
+		left = threshold - abs(self.offset) - (self.bound or 0.0)
+		return min(max(left / abs(self.drift), tmin), tmax)
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import re
+import numpy
+
+#=============================================================================
+# Coordinates
+#=============================================================================
+#
+# Module: coordinates
+#
+# Vectorized conversion between decimal coordinates (degrees or hours),
+# sexagesimal strings and the Meade wire formats used by the Hydra telescope
+# control (HH:MM:SS for hour angles, sDD*MM:SS for declination and altitude,
+# DDD*MM:SS for azimuth).
+#
+# All functions accept scalars, lists or NumPy arrays.  Scalar input gives
+# scalar output, array input gives arrays of the same shape.  The strings
+# are built and parsed column-wise on byte arrays, so a catalog of 100k
+# coordinates is converted in a few milliseconds.
+#
+#=============================================================================
+
+#-----------------------------------------------------------------------------
+# Wire formats: (number of degree/hour digits, sign, degree separator, wrap)
+#-----------------------------------------------------------------------------
+
+FORMAT_HMS = (2, False, ':', 24)
+FORMAT_DMS = (2, True, '*', None)
+FORMAT_AZ = (3, False, '*', 360)
+FORMAT_SEXA = (2, False, ':', None)
+FORMAT_ALT = (2, True, ':', None)
+FORMAT_DEG = (3, False, ':', 360)
+
+RE_SEXAGESIMAL = re.compile(
+	r"([+-]?)\s*(\d+(?:\.\d*)?)(?:[*:\s\xdf]+(\d+(?:\.\d*)?))?(?:[:'\s]+(\d+(?:\.\d*)?))?")
+
+#-----------------------------------------------------------------------------
+# split_sexagesimal
+# Synopsis:
+#	split_sexagesimal value ndigit wrap
+# Input:
+#	- value (%f):
+#		Decimal degrees or hours (scalar or array).
+#	- ndigit (%d):
+#		Number of decimals of the seconds.
+#	- wrap (%f):
+#		If given, the value is wrapped into the range [0, wrap).
+# Description:
+#	Split the values into sign, degree, minute and second fields.  The
+#	rounding is done on the total number of seconds, so 59.9999" rounds up
+#	into the minutes and degrees properly, and the sign is kept separately
+#	so that -0:30:00 is not lost.
+# Return:
+#	Tuple of integer arrays (negative, deg, min, sec).  The seconds are
+#	scaled by 10**ndigit.
+#-----------------------------------------------------------------------------
+
+def split_sexagesimal(value, ndigit=0, wrap=None):
+	x = numpy.asarray(value, dtype=float)
+	scale = 3600 * 10**ndigit
+	total = numpy.rint(x * scale).astype(numpy.int64)
+	if wrap is not None:
+		total %= int(wrap) * scale
+	negative = total < 0
+	total = numpy.abs(total)
+	deg, rest = numpy.divmod(total, scale)
+	min, sec = numpy.divmod(rest, scale // 60)
+	return negative, deg, min, sec
+
+#-----------------------------------------------------------------------------
+# format_sexagesimal
+# Synopsis:
+#	format_sexagesimal value form ndigit
+# Input:
+#	- value (%f):
+#		Decimal degrees or hours (scalar or array).
+#	- form (tuple):
+#		Output format, one of the FORMAT_* tuples.
+#	- ndigit (%d):
+#		Number of decimals of the seconds.
+# Description:
+#	Convert decimal values to sexagesimal strings.  The characters are
+#	computed column by column into a byte array, which is then viewed as
+#	an array of fixed width strings.
+# Return:
+#	String (scalar input) or array of strings.
+#-----------------------------------------------------------------------------
+
+def format_sexagesimal(value, form=FORMAT_SEXA, ndigit=0):
+	width, sign, sep, wrap = form
+	x = numpy.asarray(value, dtype=float)
+	negative, deg, min, sec = split_sexagesimal(x.ravel(), ndigit, wrap)
+
+	if not sign and negative.any():
+		sign = True
+	if deg.size:
+		width = max(width, len('%d' % deg.max()))
+
+	fields = [(deg, width), ord(sep), (min, 2), ord(':'), (sec, 2 + ndigit)]
+	if sign:
+		fields.insert(0, numpy.where(negative, ord('-'), ord('+')))
+	if ndigit > 0:
+		fields[-1:] = [(sec // 10**ndigit, 2), ord('.'), (sec % 10**ndigit, ndigit)]
+
+	ncol = sum([f[1] if type(f) is tuple else 1 for f in fields])
+	buf = numpy.empty((x.size, ncol), dtype=numpy.uint8)
+	i = 0
+	for field in fields:
+		if type(field) is tuple:
+			i = put_digits(buf, i, *field)
+		else:
+			buf[:,i] = field
+			i += 1
+	ret = buf.view('S%d' % ncol).reshape(x.shape).astype(str)
+
+	if ret.ndim == 0:
+		return str(ret[()])
+	return ret
+
+#-----------------------------------------------------------------------------
+# put_digits
+# Description:
+#	Write the $n decimal digits of $value into the columns of $buf starting
+#	at $col, two digits at a time from a lookup table. Returns the next
+#	column. For internal use.
+#-----------------------------------------------------------------------------
+
+DIGIT_PAIRS = numpy.array([[ord('0') + x // 10, ord('0') + x % 10]
+	for x in range(100)], dtype=numpy.uint8)
+
+def put_digits(buf, col, value, n):
+	value = value.astype(numpy.int32)
+	end = col + n
+	while n >= 2:
+		if n > 2:
+			value, pair = numpy.divmod(value, 100)
+		else:
+			pair = value
+		buf[:,col+n-2:col+n] = DIGIT_PAIRS.take(pair, axis=0)
+		n -= 2
+	if n:
+		buf[:,col] = value % 10 + ord('0')
+	return end
+
+#-----------------------------------------------------------------------------
+# format_hms / format_dms / format_az
+# Description:
+#	Shortcuts for the Meade wire formats: HH:MM:SS (wrapped to 0-24h),
+#	sDD*MM:SS and DDD*MM:SS (wrapped to 0-360 deg).
+#-----------------------------------------------------------------------------
+
+def format_hms(value, ndigit=0):
+	return format_sexagesimal(value, FORMAT_HMS, ndigit)
+
+def format_dms(value, ndigit=0):
+	return format_sexagesimal(value, FORMAT_DMS, ndigit)
+
+def format_az(value, ndigit=0):
+	return format_sexagesimal(value, FORMAT_AZ, ndigit)
+
+#-----------------------------------------------------------------------------
+# parse_sexagesimal
+# Synopsis:
+#	parse_sexagesimal coo
+# Input:
+#	- coo (%s):
+#		Sexagesimal string(s) like 12:34:56, -12*34:56, +12 34 56.7,
+#		12:34.5 (Meade low precision) or 12.5.
+# Description:
+#	Convert sexagesimal strings to decimal values.  Arrays where all
+#	strings share the same layout (such as mount replies or strings from
+#	format_sexagesimal()) are converted column-wise, any other input is
+#	parsed string by string.
+# Return:
+#	Float (scalar input) or array of floats. Unparsable strings give NaN.
+#-----------------------------------------------------------------------------
+
+def parse_sexagesimal(coo):
+	if isinstance(coo, (int, float)):
+		return float(coo)
+	a = numpy.asarray(coo)
+	if a.dtype.kind not in 'SU':
+		a = a.astype(str)
+	if a.dtype.kind == 'U':
+		a = numpy.char.encode(a, 'latin-1')
+	flat = numpy.ascontiguousarray(a.ravel())
+
+	ret = parse_fixed(flat)
+	if ret is None:
+		ret = numpy.array([parse_string(x) for x in flat], dtype=float)
+	ret = ret.reshape(a.shape)
+
+	if ret.ndim == 0:
+		return float(ret)
+	return ret
+
+#-----------------------------------------------------------------------------
+# parse_fixed
+# Description:
+#	Column-wise parser of equal layout strings. Returns None if the strings
+#	do not share the layout of the first one. For internal use.
+#-----------------------------------------------------------------------------
+
+RE_FIELDS = re.compile(r"([+-]?\d+)[*:\xdf](\d+(?:\.\d+)?)(?::(\d+(?:\.\d+)?))?")
+RE_FIXED = re.compile(r"([+-]?)(\d+)[*:\xdf](\d\d)(?::(\d\d)(?:\.(\d+))?)?$")
+
+def parse_fixed(flat):
+	if flat.size == 0:
+		return numpy.zeros(0)
+	w = flat.dtype.itemsize
+	b = flat.view(numpy.uint8).reshape(flat.size, w)
+	if w == 0 or not b[:,w-1].all():
+		return None
+
+	m = RE_FIXED.match(b[0].tostring().decode('latin-1'))
+	if not m:
+		return None
+
+	fields = [m.span(i) for i in range(2, 6)]
+	digit = numpy.zeros(w, dtype=bool)
+	for i0, i1 in fields:
+		digit[max(i0, 0):max(i1, 0)] = True
+	layout = ~digit
+	if m.group(1):
+		layout[0] = False
+		if not ((b[:,0] == ord('+')) | (b[:,0] == ord('-'))).all():
+			return None
+	if not (b[:,layout] == b[0,layout]).all():
+		return None
+	if ((b[:,digit] - ord('0')) > 9).any():
+		return None
+
+	def field(i0, i1):
+		ret = numpy.zeros(flat.size, dtype=numpy.int32)
+		for i in range(i0, i1):
+			ret = ret * 10 + (b[:,i] - ord('0'))
+		return ret
+
+	(d0, d1), (m0, m1), (s0, s1), (f0, f1) = fields
+	value = field(d0, d1) + field(m0, m1) / 60.0
+	if s0 >= 0:
+		value += field(s0, s1) / 3600.0
+	if f0 >= 0:
+		value += field(f0, f1) / (3600.0 * 10**(f1-f0))
+	if m.group(1):
+		value = numpy.where(b[:,0] == ord('-'), -value, value)
+	return value
+
+#-----------------------------------------------------------------------------
+# parse_string
+# Description:
+#	Parse a single sexagesimal string. For internal use.
+#-----------------------------------------------------------------------------
+
+def parse_string(coo):
+	if isinstance(coo, bytes) and not isinstance(coo, str):
+		coo = coo.decode('latin-1')
+	m = RE_SEXAGESIMAL.search(coo)
+	if not m:
+		return numpy.nan
+	sign, d, mn, s = m.groups()
+	value = float(d)
+	if mn:
+		value += float(mn) / 60.0
+	if s:
+		value += float(s) / 3600.0
+	if sign == '-':
+		value = -value
+	return value
+
+#-----------------------------------------------------------------------------
+# match_fields
+# Description:
+#	Match the fields of the last non-empty '#' delimited part of the mount
+#	reply $coo. For internal use.
+#-----------------------------------------------------------------------------
+
+def match_fields(coo):
+	if not coo:
+		return None
+	parts = [x for x in coo.split('#') if x.strip()]
+	if not parts:
+		return None
+	return RE_FIELDS.search(parts[-1])
+
+#-----------------------------------------------------------------------------
+# split_fields
+# Synopsis:
+#	split_fields coo
+# Description:
+#	Split a sexagesimal string of the mount into its degree (with sign),
+#	minute and second strings, ignoring leftover reply delimiters.  The
+#	low precision formats (HH:MM.T, sDD*MM) are converted to seconds, see
+#	is_low_precision().
+# Return:
+#	Tuple of (d, m, s) strings, or None if the string can not be parsed.
+#-----------------------------------------------------------------------------
+
+def split_fields(coo):
+	m = match_fields(coo)
+	if not m:
+		return None
+	d, mn, s = m.groups()
+	if s is None:
+		mn, s = divmod(float(mn) * 60.0, 60.0)
+		mn, s = '%02d' % mn, '%02d' % round(s)
+	return d, mn, s
+
+#-----------------------------------------------------------------------------
+# is_low_precision
+# Description:
+#	True if the mount reply $coo is in a low precision format, i.e. has no
+#	seconds field.
+#-----------------------------------------------------------------------------
+
+def is_low_precision(coo):
+	m = match_fields(coo)
+	return m is not None and m.group(3) is None
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
@@ -2,6 +2,7 @@
 #=============================================================================
 
 import tcpdevice
+import motion
 
 import time
 import re
@@ -100,6 +101,11 @@ class Dome(tcpdevice.TCPDevice):
 		self.timeout['default'] = 120
 		self.timeout['open'] = 180
 		self.timeout['close'] = 180
+		self.timeout['relay'] = 2
+		self.timeout['status'] = 5
+
+		self.status = {}
+		self.poller = motion.Poller()
 
 		return
 
@@ -130,13 +136,17 @@ class Dome(tcpdevice.TCPDevice):
 # Dome::open
 # Description:
 #	Open the dome. If $wait is True, then wait until the operation is done
-#	(or fails or interrupted).
+#	(or fails or interrupted).  Otherwise return a motion.Motion handle
+#	(a Future), which gets True if the dome is opened at the end.
 #-----------------------------------------------------------------------------
 
 	def open(self, wait=True):
 		ret = self.send_open()
 		if not wait:
-			return ret
+			if ret is False:
+				return False
+			return self.track_motion(DOME_STATUS_OPENING_STR,
+				DOME_POSITION_OPENED_STR, self.get_timeout("open"))
 		
 		timeout = self.get_timeout("open")
 		ret = tcpdevice.waitfor(self.get_dome_status, '!=',
@@ -154,13 +164,17 @@ class Dome(tcpdevice.TCPDevice):
 # Dome::close
 # Description:
 #	Close the dome. If $wait is True, then wait until the operation is done
-#	(or fails or interrupted).
+#	(or fails or interrupted).  Otherwise return a motion.Motion handle
+#	(a Future), which gets True if the dome is closed at the end.
 #-----------------------------------------------------------------------------
 
 	def close(self, wait=True):
 		ret = self.send_close()
 		if not wait:
-			return ret
+			if ret is False:
+				return False
+			return self.track_motion(DOME_STATUS_CLOSING_STR,
+				DOME_POSITION_CLOSED_STR, self.get_timeout("close"))
 		
 		timeout = self.get_timeout("close")
 		ret = tcpdevice.waitfor(self.get_dome_status, '!=',
@@ -184,6 +198,25 @@ class Dome(tcpdevice.TCPDevice):
 		ret = self.send_stop()
 		return ret
 
+#-----------------------------------------------------------------------------
+# Dome::track_motion
+# Description:
+#	Return a motion.Motion handle of the dome motion, finished when the
+#	dome status is not $moving any more.  The result is True if the dome
+#	position is $position.  One brief status query serves all pending
+#	handles. Cancel stops the dome. For internal use.
+#-----------------------------------------------------------------------------
+
+	def track_motion(self, moving, position, timeout):
+
+		def check(status):
+			if status[STATUS_IDX_DOME] == moving:
+				return None
+			return (status[STATUS_IDX_POSITION] == position,)
+
+		return self.poller.add(self.get_brief_status, check, self.stop,
+			timeout, delay=0.2)
+
 #-----------------------------------------------------------------------------
 
 #=============================================================================
@@ -252,11 +285,13 @@ class Dome(tcpdevice.TCPDevice):
 # Dome::get_output_channels
 # Description:
 #	Return the status of the 16 output channels. If $channel is specified,
-#	thet return only the status of selected output channel.
+#	thet return only the status of selected output channel.  If $cached is
+#	True, then the last full status report is used when available (and
+#	not older than $maxage seconds, if given).
 #-----------------------------------------------------------------------------
 
-	def get_output_channels(self, channel=None):
-		return self.get_channels(STATUS_IDX_OUTPUT_CH, channel)
+	def get_output_channels(self, channel=None, cached=False, maxage=None):
+		return self.get_channels(STATUS_IDX_OUTPUT_CH, channel, cached, maxage)
 
 #-----------------------------------------------------------------------------
 # Dome::get_input_hv_channels
@@ -391,7 +426,34 @@ class Dome(tcpdevice.TCPDevice):
 		if not m:
 			return None
 		retlist = [m.group(x) for x in range(1,nid+1)]
+		self.status[mode] = (time.time(), retlist)
+
+		return self.select_status(retlist, id)
+
+#-----------------------------------------------------------------------------
+# Dome::get_cached_status
+# Description:
+#	Return the result of the last parsed status report of $mode without
+#	querying the dome.  If $maxage is given and the cached report is
+#	older than $maxage seconds (or there is no cached report), then None
+#	is returned.
+#-----------------------------------------------------------------------------
+
+	def get_cached_status(self, mode, id=None, maxage=None):
+		if mode not in self.status:
+			return None
+		t, retlist = self.status[mode]
+		if maxage is not None and time.time() - t > maxage:
+			return None
+		return self.select_status(retlist, id)
+
+#-----------------------------------------------------------------------------
+# Dome::select_status
+# Description:
+#	Select the $id item(s) of a parsed status report. For internal use.
+#-----------------------------------------------------------------------------
 
+	def select_status(self, retlist, id=None):
 		if id is None:
 			return retlist
 
@@ -414,8 +476,12 @@ class Dome(tcpdevice.TCPDevice):
 #	Channel status parser function. For internal use.
 #-----------------------------------------------------------------------------
 
-	def get_channels(self, chid, channel=None):
-		str = self.get_full_status(chid)
+	def get_channels(self, chid, channel=None, cached=False, maxage=None):
+		str = None
+		if cached:
+			str = self.get_cached_status("full", chid, maxage)
+		if str is None:
+			str = self.get_full_status(chid)
 		if str  is None:
 			return None
 		strlist = str.rstrip(',').split(', ')
@@ -488,12 +554,93 @@ class Dome(tcpdevice.TCPDevice):
 #-----------------------------------------------------------------------------
 
 	def set_relay(self, channel, state):
+		cmd = self.relay_command(channel, state)
+		rcv = self.command_read(cmd)
+		return rcv
+
+#-----------------------------------------------------------------------------
+# Dome::set_relays
+# Synopsis:
+#	set_relays states glitch
+# Input:
+#	- states (dict):
+#		Requested output states as {channel: state, ...}. Channels not
+#		listed keep their current state.
+#	- glitch (0|1):
+#		Allow 'relayAll' even if it briefly toggles channels which should
+#		keep their state. Default: False
+# Description:
+#	Set several output channels at once.  The current states are taken
+#	from the cached full status if it is not older than the 'status'
+#	timeout (otherwise queried once), and
+#	the cheapest command set is selected: either the channels which differ
+#	from the requested states one by one, or a 'relayAll' followed by the
+#	channels which differ from the common state.  The commands are sent in
+#	one burst and confirmed by a single status read.
+# Return:
+#	List of the output channel states after the change, or None on
+#	failure or if a channel is not valid.
+#-----------------------------------------------------------------------------
+
+	def set_relays(self, states, glitch=False):
+		maxage = self.get_timeout('status')
+		current = self.get_output_channels(cached=True, maxage=maxage)
+		if current is None:
+			return None
+		cmds = self.relay_commands(current, states, glitch)
+		if cmds is None:
+			return None
+		if not cmds:
+			return current
+		timeout = self.get_timeout('relay')
+		ret = self.command_pipeline(cmds, timeout)
+		if ret is False:
+			return None
+		return self.get_output_channels()
+
+#-----------------------------------------------------------------------------
+# Dome::relay_commands
+# Description:
+#	Build the shortest list of relay commands switching the outputs from
+#	the $current states to the requested $states, or None if a channel is
+#	not in 1..len($current). For internal use.
+#-----------------------------------------------------------------------------
+
+	def relay_commands(self, current, states, glitch=False):
+		target = list(current)
+		for channel, state in states.items():
+			if channel not in range(1, len(target)+1):
+				return None
+			target[channel-1] = int(bool(state))
+
+		nch = len(target)
+		diff = [x for x in range(nch) if target[x] != current[x]]
+		best = [self.relay_command(x+1, target[x]) for x in diff]
+
+		for state in (0, 1):
+			rest = [x for x in range(nch) if target[x] != state]
+			if not glitch and [x for x in rest if target[x] == current[x]]:
+				continue
+			if 1 + len(rest) >= len(best):
+				continue
+			best = [self.relay_command('all', state)]
+			best += [self.relay_command(x+1, target[x]) for x in rest]
+
+		return best
+
+#-----------------------------------------------------------------------------
+# Dome::relay_command
+# Description:
+#	Build the command string setting $channel (or 'all') to $state. For
+#	internal use.
+#-----------------------------------------------------------------------------
+
+	def relay_command(self, channel, state):
 		if channel == 'all':
-			cmd = 'relayAll %d' % (channel, state)
+			cmd = 'relayAll %d' % (state,)
 		else:
 			cmd = 'relay %d %d' % (channel, state)
-		rcv = self.command_read(cmd)
-		return rcv
+		return cmd
 
 #-----------------------------------------------------------------------------
 # Dome::reset
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import time
+import threading
+
+import numpy
+
+import astrometry
+
+#=============================================================================
+# EphemerisTracker
+#=============================================================================
+#
+# Class: EphemerisTracker
+#
+# Non-sidereal tracking of comets, asteroids and satellites by updating
+# the tracking rate (ST) of the scope from an ephemeris table.
+#
+# The table (time, RA, Dec) is resampled to the update interval, and the
+# RA rate of every interval is computed with vectorized finite
+# differences.  The tracking rate r [Hz] (60 Hz = 1 rev in 24 hours) which
+# makes the pointing follow an RA rate dRA/dt [h/s] is
+#
+#	r = 60 * (SIDEREAL_RATE - 3600 * dRA/dt)
+#
+# Only the rates which differ from the last sent one by more than the
+# threshold are sent.  The updates run in a background thread and are
+# sent with TCPDevice.command_nowait(), so no update waits for a reply.
+# The lateness of every update (send time - scheduled time, the send time
+# taken when the write returned, so a wait for the device lock counts) is
+# recorded for the jitter statistics.
+#
+# The ST command only sets the RA axis rate; the declination motion of
+# the object is not followed.
+#
+# Units: times are Unix time stamps, RA in hours, Dec in degrees.
+#
+#=============================================================================
+
+class EphemerisTracker(object):
+
+#-----------------------------------------------------------------------------
+# EphemerisTracker::__init__
+# Input:
+#	- scope (scope.Scope):
+#		Connected scope.
+#	- interval (%f):
+#		Time between two rate updates [s].
+#	- threshold (%f):
+#		Minimum change of the rate to be sent [Hz].
+#-----------------------------------------------------------------------------
+
+	def __init__(self, scope, interval=5.0, threshold=0.002):
+		self.scope = scope
+		self.interval = interval
+		self.threshold = threshold
+		self.format = 'ST%.4f'
+		self.spin = 0.002
+		self.schedule = None
+		self.thread = None
+		self.stopped = threading.Event()
+		self.log = []
+		return
+
+#-----------------------------------------------------------------------------
+# EphemerisTracker::rates
+# Synopsis:
+#	rates t ra
+# Input:
+#	- t, ra (array):
+#		Ephemeris times and RA [hour].
+# Description:
+#	Resample the ephemeris to self.interval and compute the tracking rate
+#	of every interval.
+# Return:
+#	Tuple of the interval start times and the tracking rates [Hz].
+#-----------------------------------------------------------------------------
+
+	def rates(self, t, ra):
+		t = numpy.asarray(t, dtype=float)
+		ra = numpy.asarray(ra, dtype=float)
+		i = numpy.argsort(t)
+		t, ra = t[i], numpy.degrees(numpy.unwrap(numpy.radians(ra[i] * 15.0))) / 15.0
+
+		n = max(int(numpy.ceil((t[-1] - t[0]) / self.interval)), 1)
+		grid = numpy.minimum(t[0] + self.interval * numpy.arange(n + 1), t[-1])
+		ragrid = numpy.interp(grid, t, ra)
+		dt = numpy.diff(grid)
+		ok = dt > 0
+		dra = numpy.diff(ragrid)[ok] / dt[ok]
+		rate = 60.0 * (astrometry.SIDEREAL_RATE - 3600.0 * dra)
+		return grid[:-1][ok], rate
+
+#-----------------------------------------------------------------------------
+# EphemerisTracker::select
+# Description:
+#	Keep only the rate updates which differ from the last kept rate by
+#	more than self.threshold. The first update is always kept.
+#-----------------------------------------------------------------------------
+
+	def select(self, t, rate):
+		keep = []
+		last = None
+		for i, r in enumerate(rate):
+			if last is None or abs(r - last) > self.threshold:
+				keep.append(i)
+				last = r
+		return t[keep], rate[keep]
+
+#-----------------------------------------------------------------------------
+# EphemerisTracker::start
+# Synopsis:
+#	start t ra
+# Input:
+#	- t, ra (array):
+#		Ephemeris times [Unix time] and RA [hour].
+# Description:
+#	Compute the rate updates and send them in a background thread at
+#	their times.  Updates already in the past are skipped, except the
+#	current one.
+# Return:
+#	Number of scheduled updates.
+#-----------------------------------------------------------------------------
+
+	def start(self, t, ra):
+		self.stop()
+		tu, rate = self.select(*self.rates(t, ra))
+		now = time.time()
+		past = numpy.searchsorted(tu, now, side='right') - 1
+		if past > 0:
+			tu, rate = tu[past:], rate[past:]
+			tu[0] = now
+		self.schedule = (tu, rate)
+		self.log = []
+		self.stopped.clear()
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+		return len(tu)
+
+#-----------------------------------------------------------------------------
+# EphemerisTracker::stop
+# Description:
+#	Stop sending the updates. The last sent rate stays active.
+#-----------------------------------------------------------------------------
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+		return
+
+#-----------------------------------------------------------------------------
+# EphemerisTracker::run
+# Description:
+#	Update loop of the background thread. For internal use.
+#-----------------------------------------------------------------------------
+
+	def run(self):
+		scope = self.scope
+		for t, rate in zip(*self.schedule):
+			while True:
+				wait = t - time.time()
+				if wait <= 0.0:
+					break
+				if wait > self.spin and self.stopped.wait(wait - self.spin):
+					return
+			if self.stopped.is_set():
+				return
+			scope.command_nowait(self.format % (rate,))
+			sent = time.time()
+			scope.tracking = rate > 0
+			scope.estimator.set_tracking_rate(rate, sent)
+			self.log.append((t, sent, rate))
+		return
+
+#-----------------------------------------------------------------------------
+# EphemerisTracker::get_jitter
+# Description:
+#	Timing statistics of the sent updates.
+# Return:
+#	Tuple of the number of updates, mean, standard deviation and maximum
+#	of the lateness [s], or None if nothing was sent yet.
+#-----------------------------------------------------------------------------
+
+	def get_jitter(self):
+		if not self.log:
+			return None
+		late = numpy.array([x[1] - x[0] for x in self.log])
+		return len(late), late.mean(), late.std(), late.max()
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
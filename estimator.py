@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import time
+import math
+from collections import deque
+
+import astrometry
+
+#=============================================================================
+# PositionEstimator
+#=============================================================================
+#
+# Class: PositionEstimator
+#
+# Dead-reckoning estimator of the scope position.  It combines the sparse
+# real RA/Dec samples read from the mount with the commanded motion: the
+# tracking rate, goto slews and manual moves.  The position can be
+# estimated at any time stamp: between two samples it is interpolated,
+# after the last sample it is extrapolated with the motion model.  Every
+# new sample re-anchors the model, and the residual of the prediction is
+# used to correct the tracking drift and its uncertainty.
+#
+# Units: RA in hours, Dec and uncertainties in degrees, rates in Herz
+# (60.0Hz = 1 rev in 24 hours), speeds in degrees per second, times are
+# Unix time stamps.
+#
+#=============================================================================
+
+class PositionEstimator(object):
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::__init__
+# Input:
+#	- sigma (%f):
+#		Uncertainty of a real sample [deg]. Default: 1 arcsec
+#	- latency (%f):
+#		Timing uncertainty of the motion commands [s].
+#	- history (%d):
+#		Number of samples kept for interpolation.
+#-----------------------------------------------------------------------------
+
+	def __init__(self, sigma=1.0/3600, latency=0.3, history=100):
+		self.sigma = sigma
+		self.latency = latency
+		self.samples = deque(maxlen=history)
+		self.anchor = None
+		self.events = []
+		self.rate = 0.0
+		self.drift = 0.0
+		self.drift_sigma = 1.0/54000/60
+		self.drift_time = 60.0
+		self.residual = None
+		return
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
+# Model inputs
+#=============================================================================
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::add_sample
+# Synopsis:
+#	add_sample t ra dec
+# Description:
+#	Add a real position sample.  The prediction residual is stored in
+#	self.residual (RA [h], Dec [deg]) and, if only tracking happened since
+#	the previous sample, used to update the tracking drift.
+#-----------------------------------------------------------------------------
+
+	def add_sample(self, t, ra, dec):
+		ra, dec = float(ra), float(dec)
+		if math.isnan(ra) or math.isnan(dec):
+			return
+		if self.anchor is not None and t < self.anchor[0]:
+			return
+		rate, slew, move = self.rate, None, {}
+		if self.anchor is not None:
+			pra, pdec, sigma, rate, slew, move = self.propagate(t)
+			dra = (ra - pra + 12.0) % 24.0 - 12.0
+			self.residual = (dra, dec - pdec)
+			dt = t - self.anchor[0]
+			moved = [x for x in self.events if x[1] != 'rate']
+			if dt > 0 and not moved and self.anchor[5] is None and \
+					not self.anchor[6]:
+				self.update_drift(dra / dt, dt)
+
+		self.anchor = (t, ra, dec, self.sigma, rate, slew, move)
+		self.events = []
+		self.samples.append((t, ra, dec))
+		return
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::update_drift
+# Description:
+#	Correct the tracking drift with the drift $err [h/s] measured over $dt
+#	seconds. Longer baselines get larger weight. For internal use.
+#-----------------------------------------------------------------------------
+
+	def update_drift(self, err, dt):
+		gain = dt / (dt + self.drift_time)
+		self.drift += gain * err
+		self.drift_sigma = math.sqrt((1.0 - gain) * self.drift_sigma**2 +
+			gain * err**2)
+		return
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::set_tracking_rate
+# Description:
+#	Set the tracking rate [Hz] from time $t (default: now). 0 means that
+#	tracking is off.
+#-----------------------------------------------------------------------------
+
+	def set_tracking_rate(self, rate, t=None):
+		self.add_event(t, 'rate', float(rate))
+		return
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::start_slew
+# Description:
+#	A goto slew to $ra, $dec was started at time $t (default: now) with
+#	$speed [deg/s] on both axes.
+#-----------------------------------------------------------------------------
+
+	def start_slew(self, ra, dec, speed, t=None):
+		self.add_event(t, 'slew', (float(ra), float(dec), float(speed)))
+		return
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::start_move
+# Description:
+#	A manual move in direction $dir (n|e|s|w) was started at time $t
+#	(default: now) with $speed [deg/s].
+#-----------------------------------------------------------------------------
+
+	def start_move(self, dir, speed, t=None):
+		self.add_event(t, 'move', (dir, float(speed)))
+		return
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::stop
+# Description:
+#	Stop the manual move in direction $dir, or every movement (including
+#	slews) if $dir is None, at time $t (default: now).
+#-----------------------------------------------------------------------------
+
+	def stop(self, dir=None, t=None):
+		self.add_event(t, 'stop', dir)
+		return
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::reset
+# Description:
+#	Forget the samples, e.g. after the mount coordinates were synced.
+#-----------------------------------------------------------------------------
+
+	def reset(self):
+		self.samples.clear()
+		self.anchor = None
+		self.events = []
+		self.residual = None
+		return
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::add_event
+# Description:
+#	Append a motion event. For internal use.
+#-----------------------------------------------------------------------------
+
+	def add_event(self, t, kind, arg):
+		if t is None:
+			t = time.time()
+		if kind == 'rate':
+			self.rate = arg
+		if self.anchor is None:
+			return
+		self.events.append((t, kind, arg))
+		self.events.sort(key=lambda x: x[0])
+		return
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
+# Estimation
+#=============================================================================
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::estimate
+# Synopsis:
+#	estimate t
+# Description:
+#	Estimate the position at time $t (default: now).
+# Return:
+#	Tuple of RA [h], Dec [deg] and uncertainty [deg], or None if there is
+#	no sample yet.
+#-----------------------------------------------------------------------------
+
+	def estimate(self, t=None):
+		if t is None:
+			t = time.time()
+		if self.anchor is None:
+			return None
+		if t < self.anchor[0]:
+			return self.interpolate(t)
+		ra, dec, sigma, rate, slew, move = self.propagate(t)
+		return ra, dec, sigma
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::interpolate
+# Description:
+#	Linear interpolation between the real samples. For internal use.
+#-----------------------------------------------------------------------------
+
+	def interpolate(self, t):
+		samples = list(self.samples)
+		t0, ra0, dec0 = samples[0]
+		if t <= t0:
+			return ra0, dec0, self.sigma + self.drift_sigma * 15.0 * (t0 - t)
+		for t1, ra1, dec1 in samples[1:]:
+			if t <= t1:
+				break
+			t0, ra0, dec0 = t1, ra1, dec1
+		f = (t - t0) / (t1 - t0) if t1 > t0 else 0.0
+		dra = (ra1 - ra0 + 12.0) % 24.0 - 12.0
+		ra = (ra0 + f * dra) % 24.0
+		dec = dec0 + f * (dec1 - dec0)
+		return ra, dec, self.sigma
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::propagate
+# Description:
+#	Propagate the anchor sample through the motion events up to time $t.
+#	For internal use.
+# Return:
+#	Tuple of RA, Dec, uncertainty, tracking rate, active slew and active
+#	manual moves.
+#-----------------------------------------------------------------------------
+
+	def propagate(self, t):
+		t0, ra, dec, sigma, rate, slew, move = self.anchor
+		move = dict(move)
+		for i in range(len(self.events) + 1):
+			if i < len(self.events):
+				te, kind, arg = self.events[i]
+				te = min(max(te, t0), t)
+			else:
+				te, kind, arg = t, None, None
+
+			ra, dec, sigma, slew = self.advance(t0, te, ra, dec, sigma,
+				rate, slew, move)
+			t0 = te
+
+			if kind == 'rate':
+				rate = arg
+			elif kind == 'slew':
+				slew = arg
+				sigma += self.latency * arg[2]
+			elif kind == 'move':
+				move[arg[0]] = arg[1]
+				sigma += self.latency * arg[1]
+			elif kind == 'stop':
+				if arg is None:
+					if slew is not None:
+						sigma += abs(self.distance(ra, dec, slew))
+					slew = None
+					move = {}
+				elif arg in move:
+					del move[arg]
+
+		return ra % 24.0, dec, sigma, rate, slew, move
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::advance
+# Description:
+#	Advance the position from $t0 to $t1 with the given motion state. For
+#	internal use.
+#-----------------------------------------------------------------------------
+
+	def advance(self, t0, t1, ra, dec, sigma, rate, slew, move):
+		dt = t1 - t0
+		if dt <= 0:
+			return ra, dec, sigma, slew
+
+		if slew is not None:
+			tra, tdec, speed = slew
+			dra = (tra - ra + 12.0) % 24.0 - 12.0
+			ddec = tdec - dec
+			step = speed * dt
+			ra += math.copysign(min(abs(dra), step / 15.0), dra)
+			dec += math.copysign(min(abs(ddec), step), ddec)
+			sigma += 0.1 * min(max(abs(dra) * 15.0, abs(ddec)), step)
+			if abs(dra) * 15.0 <= step and abs(ddec) <= step:
+				slew = None
+			return ra, dec, sigma, slew
+
+		ra += (self.drift_rate(rate) + self.drift) * dt
+		sigma += self.drift_sigma * 15.0 * dt
+		for dir, speed in move.items():
+			if dir == 'n':
+				dec += speed * dt
+			elif dir == 's':
+				dec -= speed * dt
+			elif dir == 'e':
+				ra += speed * dt / 15.0
+			elif dir == 'w':
+				ra -= speed * dt / 15.0
+			sigma += 0.1 * speed * dt
+		dec = max(min(dec, 90.0), -90.0)
+		return ra, dec, sigma, slew
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::drift_rate
+# Description:
+#	RA drift [h/s] of the scope pointing at tracking rate $rate [Hz]. For
+#	internal use.
+#-----------------------------------------------------------------------------
+
+	def drift_rate(self, rate):
+		return (astrometry.SIDEREAL_RATE - rate / 60.0) / 3600.0
+
+#-----------------------------------------------------------------------------
+# PositionEstimator::distance
+# Description:
+#	Largest axis distance [deg] between a position and a slew target. For
+#	internal use.
+#-----------------------------------------------------------------------------
+
+	def distance(self, ra, dec, slew):
+		dra = (slew[0] - ra + 12.0) % 24.0 - 12.0
+		return max(abs(dra) * 15.0, abs(slew[1] - dec))
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+import ihucontroller
+import topology
+from topology import IHU_HOST, IHU_PORT, IHU_AXES
+
+#=============================================================================
+# FleetError
+#=============================================================================
+#
+# Class: FleetError
+#
+# Raised by a fleet operation when one or more controllers failed, after
+# all controllers are done.  self.errors is the dictionary of controller
+# number: exception of the failed controllers, self.results that of the
+# results of the others (None for the failed ones).
+#
+#=============================================================================
+
+class FleetError(Exception):
+
+	what = 'controller'
+
+	def __init__(self, errors, results):
+		Exception.__init__(self, '%s failure: %s' % (self.what, ', '.join(
+			['%d: %r' % (x, errors[x]) for x in sorted(errors)])))
+		self.errors = errors
+		self.results = results
+		return
+
+#=============================================================================
+# IHUFleet
+#=============================================================================
+#
+# Class: IHUFleet
+#
+# All IHU controllers of the array.  The operations are fanned out to the
+# controllers concurrently through a thread pool (one worker per
+# controller), so the wall-clock time of a fleet operation is that of the
+# slowest controller.  Within one controller all IHUs are served by one
+# command (e.g. one SMTI/MGC for the focusers of all its IHUs).
+#
+# Results are gathered into NumPy arrays indexed by IHU number (row 0 and
+# missing IHUs are NaN).  A controller which fails does not stop the
+# others, but the failure is not hidden: when all controllers are done,
+# FleetError is raised with the exceptions of the failed controllers and
+# the results of the others.  The last exception of every controller is
+# also kept in self.errors (cleared by its next success).  The duration of
+# the last operation per controller is kept in self.timing.
+#
+#=============================================================================
+
+class IHUFleet(object):
+
+#-----------------------------------------------------------------------------
+# IHUFleet::__init__
+# Input:
+#	- max_workers (%d):
+#		Size of the thread pool. Default: the number of controllers.
+#-----------------------------------------------------------------------------
+
+	def __init__(self, max_workers=None):
+		self.max_workers = max_workers
+		self.executor = None
+		self.controllers = {}
+		self.ihus = {}
+		self.errors = {}
+		self.timing = {}
+		self.topology = None
+		return
+
+#-----------------------------------------------------------------------------
+# IHUFleet::from_topology
+# Synopsis:
+#	from_topology topology
+# Description:
+#	Create the fleet of all controllers and IHUs of $topology (a
+#	topology.Topology or a configuration file name).
+#-----------------------------------------------------------------------------
+
+	@classmethod
+	def from_topology(cls, topo, max_workers=None):
+		if not isinstance(topo, topology.Topology):
+			topo = topology.load_topology(topo)
+		fleet = cls(max_workers)
+		fleet.topology = topo
+		for number in sorted(topo.controllers):
+			host, port = topo.get_address(number)
+			fleet.add_controller(number, host, port)
+		for ihu in sorted(topo.ihus):
+			fleet.add_ihu(ihu, topo.get_controller(ihu),
+				motors=topo.get_motor_ids(ihu), limits=topo.get_limits(ihu))
+		return fleet
+
+#-----------------------------------------------------------------------------
+# IHUFleet::add_controller
+# Synopsis:
+#	add_controller number host port
+# Description:
+#	Add controller $number. The default host is IHU_HOST % number.
+# Return:
+#	The IHUcontroller.
+#-----------------------------------------------------------------------------
+
+	def add_controller(self, number, host=None, port=None):
+		c = ihucontroller.IHUcontroller()
+		c.set_port(host or IHU_HOST % number, port or IHU_PORT)
+		if self.topology is not None:
+			c.set_topology(self.topology, number)
+		self.controllers[number] = c
+		return c
+
+#-----------------------------------------------------------------------------
+# IHUFleet::add_ihu
+# Synopsis:
+#	add_ihu ihu controller slot motors limits
+# Description:
+#	Add IHU number $ihu, driven by the $motors (alt, alm, foc ids) of
+#	controller number $controller, or by motors 3*slot-2 .. 3*slot.
+# Return:
+#	The IHU.
+#-----------------------------------------------------------------------------
+
+	def add_ihu(self, ihu, controller, slot=None, motors=None, limits=None):
+		if motors is None:
+			motors = topology.Topology.slot_motors(slot)
+		d = ihucontroller.IHU(self.controllers[controller], *motors,
+			limits=limits)
+		self.ihus[ihu] = (controller, d)
+		return d
+
+#-----------------------------------------------------------------------------
+# IHUFleet::get_ihu
+#-----------------------------------------------------------------------------
+
+	def get_ihu(self, ihu):
+		return self.ihus[ihu][1]
+
+#-----------------------------------------------------------------------------
+# IHUFleet::get_ihus
+# Description:
+#	Sorted list of the selected IHU numbers (default: all).
+#-----------------------------------------------------------------------------
+
+	def get_ihus(self, ihus=None):
+		if ihus is None:
+			return sorted(self.ihus)
+		if type(ihus) is not list and type(ihus) is not tuple:
+			return [ihus]
+		return sorted(ihus)
+
+#-----------------------------------------------------------------------------
+# IHUFleet::group
+# Synopsis:
+#	group ihus axis
+# Description:
+#	Group the selected IHUs by controller. For internal use.
+# Return:
+#	Dictionary of controller number: (IHU numbers, motor ids of $axis).
+#-----------------------------------------------------------------------------
+
+	def group(self, ihus=None, axis='foc'):
+		groups = {}
+		for ihu in self.get_ihus(ihus):
+			controller, d = self.ihus[ihu]
+			numbers, ids = groups.setdefault(controller, ([], []))
+			numbers.append(ihu)
+			ids.append(d.get_motor_id(axis))
+		return groups
+
+#-----------------------------------------------------------------------------
+# IHUFleet::get_executor
+# Description:
+#	Thread pool of the fleet, created on first use. For internal use.
+#-----------------------------------------------------------------------------
+
+	def get_executor(self):
+		if self.executor is None:
+			n = self.max_workers or max(len(self.controllers), 1)
+			self.executor = ThreadPoolExecutor(max_workers=n)
+		return self.executor
+
+#-----------------------------------------------------------------------------
+# IHUFleet::map
+# Synopsis:
+#	map func numbers
+# Description:
+#	Call func(number, controller) for the selected controllers (default:
+#	all) concurrently and wait for all of them.  If any of them raised an
+#	exception, FleetError is raised then, unless $raise_errors is False.
+# Return:
+#	Dictionary of controller number: result (None on exception, if
+#	$raise_errors is False).
+#-----------------------------------------------------------------------------
+
+	def map(self, func, numbers=None, raise_errors=True):
+		if numbers is None:
+			numbers = sorted(self.controllers)
+		executor = self.get_executor()
+
+		def call(number):
+			t0 = time.time()
+			try:
+				return func(number, self.controllers[number])
+			finally:
+				self.timing[number] = time.time() - t0
+
+		futures = dict([(x, executor.submit(call, x)) for x in numbers])
+		ret = {}
+		errors = {}
+		for number, future in futures.items():
+			try:
+				ret[number] = future.result()
+				self.errors.pop(number, None)
+			except Exception as e:
+				self.errors[number] = errors[number] = e
+				ret[number] = None
+		if errors and raise_errors:
+			raise FleetError(errors, ret)
+		return ret
+
+#-----------------------------------------------------------------------------
+# IHUFleet::array
+# Description:
+#	Array indexed by IHU number from the dictionary $values of IHU number:
+#	value (or value tuple). For internal use.
+#-----------------------------------------------------------------------------
+
+	def array(self, values, ncol=None):
+		n = max(self.ihus) + 1 if self.ihus else 1
+		shape = (n,) if ncol is None else (n, ncol)
+		a = numpy.empty(shape)
+		a.fill(numpy.nan)
+		for ihu, value in values.items():
+			if value is not None:
+				a[ihu] = value
+		return a
+
+#-----------------------------------------------------------------------------
+# IHUFleet::get_value
+# Description:
+#	Value of IHU $ihu from $values: a scalar (same for all), a dictionary
+#	or a sequence indexed by IHU number. For internal use.
+#-----------------------------------------------------------------------------
+
+	def get_value(self, values, ihu):
+		if isinstance(values, dict) or hasattr(values, '__len__'):
+			return int(round(values[ihu]))
+		return int(round(values))
+
+#-----------------------------------------------------------------------------
+# IHUFleet::connect
+#-----------------------------------------------------------------------------
+
+	def connect(self):
+		return self.map(lambda n, c: c.connect())
+
+#-----------------------------------------------------------------------------
+# IHUFleet::disconnect
+#-----------------------------------------------------------------------------
+
+	def disconnect(self):
+		try:
+			return self.map(lambda n, c: c.disconnect())
+		finally:
+			if self.executor is not None:
+				self.executor.shutdown()
+				self.executor = None
+
+#-----------------------------------------------------------------------------
+# IHUFleet::snapshot
+# Description:
+#	Take a motor state snapshot of every controller concurrently.
+# Return:
+#	Tuple of the status, position and target arrays, indexed by IHU number
+#	and axis (IHU_AXES order).
+#-----------------------------------------------------------------------------
+
+	def snapshot(self, ihus=None):
+		ihus = self.get_ihus(ihus)
+		numbers = sorted(set([self.ihus[x][0] for x in ihus]))
+		states = self.map(lambda n, c: c.snapshot(), numbers)
+
+		values = ({}, {}, {})
+		for ihu in ihus:
+			controller, d = self.ihus[ihu]
+			state = states[controller]
+			if state is None:
+				continue
+			i = [d.get_motor_id(x) - 1 for x in IHU_AXES]
+			values[0][ihu] = state.status[i]
+			values[1][ihu] = state.position[i]
+			values[2][ihu] = state.target[i]
+		return tuple([self.array(x, len(IHU_AXES)) for x in values])
+
+#-----------------------------------------------------------------------------
+# IHUFleet::get_positions
+# Description:
+#	Current positions of $axis of the selected IHUs, as an array indexed
+#	by IHU number.
+#-----------------------------------------------------------------------------
+
+	def get_positions(self, axis='foc', ihus=None):
+		status, position, target = self.snapshot(ihus)
+		return position[:,IHU_AXES.index(axis)]
+
+#-----------------------------------------------------------------------------
+# IHUFleet::new
+# Synopsis:
+#	new pos axis ihus wait
+# Input:
+#	- pos:
+#		New positions: a scalar, or a dictionary or array indexed by
+#		IHU number.
+#	- axis (%s):
+#		'alt', 'alm' or 'foc'.
+#	- ihus (list):
+#		IHU numbers. Default: all.
+# Description:
+#	Move $axis of the selected IHUs to the new positions, one
+#	IHUcontroller::motor_new per controller, all controllers concurrently.
+# Return:
+#	Array of the final positions indexed by IHU number (NaN if the move
+#	failed, timed out or was out of the step limits).  A controller
+#	failure raises FleetError.
+#-----------------------------------------------------------------------------
+
+	def new(self, pos, axis='foc', ihus=None, timeout=None):
+
+		def target(c, numbers, ids):
+			return [self.get_value(pos, x) for x in numbers]
+
+		return self.move(target, axis, ihus, timeout)
+
+#-----------------------------------------------------------------------------
+# IHUFleet::make
+# Description:
+#	Move $axis of the selected IHUs by $steps relative to their current
+#	positions (see IHUFleet::new).
+#-----------------------------------------------------------------------------
+
+	def make(self, steps, axis='foc', ihus=None, timeout=None):
+
+		def target(c, numbers, ids):
+			pos0 = c.motor_get(ids)
+			return [p + self.get_value(steps, x) for x, p in zip(numbers, pos0)]
+
+		return self.move(target, axis, ihus, timeout)
+
+#-----------------------------------------------------------------------------
+# IHUFleet::move
+# Description:
+#	Move $axis of the selected IHUs to the positions given by
+#	target(controller, IHU numbers, motor ids), one motor_new per
+#	controller.  Targets outside the step limits of the IHU are not
+#	moved. For internal use.
+#-----------------------------------------------------------------------------
+
+	def move(self, target, axis, ihus, timeout):
+		groups = self.group(ihus, axis)
+
+		def move(number, c):
+			numbers, ids = groups[number]
+			pos = target(c, numbers, ids)
+			ok = [i for i, x in enumerate(numbers)
+				if self.get_ihu(x).check_limits(axis, pos[i])]
+			if not ok:
+				return {}
+			numbers = [numbers[i] for i in ok]
+			ret = c.motor_new([ids[i] for i in ok], [pos[i] for i in ok],
+				timeout=timeout)
+			if ret is False:
+				return {}
+			return dict(zip(numbers, ret))
+
+		return self.gather(self.map(move, sorted(groups)))
+
+#-----------------------------------------------------------------------------
+# IHUFleet::plan
+# Synopsis:
+#	plan targets sync timeout
+# Input:
+#	- targets (dict):
+#		Dictionary of IHU number: {axis: position}, any axes of any
+#		IHUs.
+#	- sync (bool):
+#		Synchronized arrival of the motors of each controller (see
+#		IHUcontroller::motor_plan).
+# Description:
+#	Move all axes at once: one IHUcontroller::motor_plan per controller,
+#	all controllers concurrently.
+# Return:
+#	Array of the final positions indexed by IHU number and axis
+#	(IHU_AXES order). Axes not moved (e.g. out of the step limits) or
+#	timed out are NaN.
+#-----------------------------------------------------------------------------
+
+	def plan(self, targets, sync=False, timeout=None):
+		groups = {}
+		for ihu in self.get_ihus(list(targets)):
+			controller, d = self.ihus[ihu]
+			for axis in IHU_AXES:
+				if axis in targets[ihu] and d.check_limits(axis, targets[ihu][axis]):
+					group = groups.setdefault(controller, ([], [], []))
+					group[0].append((ihu, IHU_AXES.index(axis)))
+					group[1].append(d.get_motor_id(axis))
+					group[2].append(int(round(targets[ihu][axis])))
+
+		def move(number, c):
+			keys, ids, pos = groups[number]
+			tracker = c.motor_plan(ids, pos, sync, timeout)
+			if tracker is False:
+				return {}
+			return dict([(k, tracker.position.get(x))
+				for k, x in zip(keys, ids) if x in tracker.settled])
+
+		ret = self.array({}, len(IHU_AXES))
+		for values in self.map(move, sorted(groups)).values():
+			for (ihu, axis), value in (values or {}).items():
+				ret[ihu, axis] = value
+		return ret
+
+#-----------------------------------------------------------------------------
+# IHUFleet::apply_wiring
+# Description:
+#	Set the motor wiring of all IHUs from the topology, one batch (one
+#	SMW) per controller.
+# Return:
+#	Dictionary of controller number: True/False.
+#-----------------------------------------------------------------------------
+
+	def apply_wiring(self):
+		if self.topology is None:
+			return {}
+
+		def wire(number, c):
+			with c.wiring_edit():
+				for ihu in self.topology.get_ihus(number):
+					d = self.get_ihu(ihu)
+					for axis, bit in self.topology.get_wiring(ihu).items():
+						c.set_motor_wiring(d.get_motor_id(axis), bit)
+			return c.wiring_flushed
+
+		return self.map(wire)
+
+#-----------------------------------------------------------------------------
+# IHUFleet::stop
+# Description:
+#	Stop $axis of the selected IHUs.
+#-----------------------------------------------------------------------------
+
+	def stop(self, axis='foc', ihus=None):
+		groups = self.group(ihus, axis)
+
+		def stop(number, c):
+			for id in groups[number][1]:
+				c.motor_stop(id)
+			return True
+
+		return self.map(stop, sorted(groups))
+
+#-----------------------------------------------------------------------------
+# IHUFleet::gather
+# Description:
+#	Merge the per controller {IHU number: value} results into an array
+#	indexed by IHU number. For internal use.
+#-----------------------------------------------------------------------------
+
+	def gather(self, results):
+		values = {}
+		for ret in results.values():
+			if ret:
+				values.update(ret)
+		return self.array(values)
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
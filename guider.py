@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import time
+import ctypes
+import ctypes.util
+from collections import deque
+
+#=============================================================================
+# Clock
+#=============================================================================
+
+CLOCK_MONOTONIC = 1
+
+#-----------------------------------------------------------------------------
+# monotonic_clock
+# Description:
+#	Monotonic high resolution clock for timing the pulses: time.monotonic()
+#	or, on Python 2, clock_gettime(CLOCK_MONOTONIC) via ctypes.  Falls back
+#	to time.time() if neither is available.
+# Return:
+#	The clock function [s].
+#-----------------------------------------------------------------------------
+
+def monotonic_clock():
+	if hasattr(time, 'monotonic'):
+		return time.monotonic
+
+	class timespec(ctypes.Structure):
+		_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+	try:
+		lib = ctypes.CDLL(ctypes.util.find_library('rt') or
+			ctypes.util.find_library('c'), use_errno=True)
+		clock_gettime = lib.clock_gettime
+	except (OSError, AttributeError):
+		return time.time
+	clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+	def clock():
+		t = timespec()
+		if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+			raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+		return t.tv_sec + t.tv_nsec * 1e-9
+
+	return clock
+
+clock = monotonic_clock()
+
+#=============================================================================
+# PulseGuider
+#=============================================================================
+#
+# Class: PulseGuider
+#
+# Pulse guiding engine of a Scope.  Guiding corrections are applied as
+# manual moves at the guide rate: unless an explicit speed is given, the
+# guide rate is selected (set_slew_rate('guide')) before the first pulse
+# and again whenever another move rate has been selected since.  The
+# Mn/Ms/Me/Mw and Qn/Qs/Qe/Qw commands have no reply, so they are sent as
+# raw writes without the sleep and read of command_read(), and the pulses
+# are timed with a monotonic clock: the scheduler sleeps until shortly
+# before the end of the pulse and spins for the rest.  The RA and Dec
+# pulses run at the same time.
+#
+# The writes hold the device lock (only for the write itself), so that a
+# pulse command can not land inside the exchange of another thread and
+# corrupt its reply pairing.  The stop of a pulse may thus wait for a
+# running exchange; the achieved length reports such delays.
+#
+# Every pulse is reported with its requested and achieved length.  The
+# achieved length is measured between the ends of the start and stop
+# writes.
+#
+# Units: corrections in arcsec, pulse lengths in seconds.  Positive RA
+# corrections move east, positive Dec corrections move north.
+#
+#=============================================================================
+
+class PulseGuider(object):
+
+#-----------------------------------------------------------------------------
+# PulseGuider::__init__
+# Input:
+#	- scope (scope.Scope):
+#		Connected scope.
+#	- speed (%f):
+#		Guide speed [deg/s]. Default: the speed of the guide rate of the
+#		scope, which is then selected by the guider.
+#	- min_pulse (%f):
+#		Shorter pulses are skipped [s].
+#	- max_pulse (%f):
+#		Longer pulses are truncated [s].
+#	- history (%d):
+#		Number of pulse reports kept.
+#-----------------------------------------------------------------------------
+
+	def __init__(self, scope, speed=None, min_pulse=0.005, max_pulse=5.0,
+			history=1000):
+		self.scope = scope
+		self.speed = speed
+		self.min_pulse = min_pulse
+		self.max_pulse = max_pulse
+		self.spin = 0.002
+		self.history = deque(maxlen=history)
+		return
+
+#-----------------------------------------------------------------------------
+# PulseGuider::select_rate
+# Description:
+#	Select the guide rate of the scope, unless an explicit speed is given
+#	or it is already selected.
+#-----------------------------------------------------------------------------
+
+	def select_rate(self):
+		if self.speed is None and self.scope.move_rate != 'guide':
+			self.scope.set_slew_rate('guide')
+		return
+
+#-----------------------------------------------------------------------------
+# PulseGuider::get_speed
+# Description:
+#	Guide speed [deg/s].
+#-----------------------------------------------------------------------------
+
+	def get_speed(self):
+		if self.speed is not None:
+			return self.speed
+		self.select_rate()
+		return self.scope.move_speed
+
+#-----------------------------------------------------------------------------
+# PulseGuider::guide
+# Synopsis:
+#	guide corrections
+# Input:
+#	- corrections (list):
+#		List of (RA, Dec) corrections [arcsec], e.g. all requests of the
+#		guider since the last call. They are summed up.
+# Description:
+#	Convert the corrections to one pulse per axis and run them.
+# Return:
+#	List of (dir, requested, achieved) pulse reports.
+#-----------------------------------------------------------------------------
+
+	def guide(self, corrections):
+		dra = sum([x[0] for x in corrections])
+		ddec = sum([x[1] for x in corrections])
+		speed = self.get_speed() * 3600.0
+		return self.pulse(dra / speed, ddec / speed)
+
+#-----------------------------------------------------------------------------
+# PulseGuider::pulse
+# Synopsis:
+#	pulse ra dec
+# Input:
+#	- ra (%f):
+#		RA pulse length [s], positive to the east.
+#	- dec (%f):
+#		Dec pulse length [s], positive to the north.
+# Description:
+#	Run the RA and Dec pulses simultaneously.
+# Return:
+#	List of (dir, requested, achieved) pulse reports.
+#-----------------------------------------------------------------------------
+
+	def pulse(self, ra=0.0, dec=0.0):
+		pulses = []
+		for length, pos, neg in ((ra, 'e', 'w'), (dec, 'n', 's')):
+			length = min(abs(length), self.max_pulse) * (1 if length >= 0 else -1)
+			if abs(length) >= self.min_pulse:
+				pulses.append((pos if length > 0 else neg, abs(length)))
+		if not pulses:
+			return []
+		return self.run(pulses)
+
+#-----------------------------------------------------------------------------
+# PulseGuider::run
+# Description:
+#	Start the $pulses (list of (dir, length)) in one write and stop each
+#	of them at its time. For internal use.
+#-----------------------------------------------------------------------------
+
+	def run(self, pulses):
+		scope = self.scope
+		speed = self.get_speed()
+		acmd = ''.join([scope.formatstr % ('M' + x[0],) for x in pulses])
+		with scope.lock:
+			if not scope.write(acmd):
+				return []
+			t0 = clock()
+		now = time.time()
+		for dir, length in pulses:
+			scope.estimator.start_move(dir, speed, now)
+
+		reports = []
+		for length, dir in sorted([(x[1], x[0]) for x in pulses]):
+			self.sleep_until(t0 + length)
+			with scope.lock:
+				scope.write(scope.formatstr % ('Q' + dir,))
+				achieved = clock() - t0
+			scope.estimator.stop(dir, time.time())
+			reports.append((dir, length, achieved))
+
+		self.history.extend(reports)
+		return reports
+
+#-----------------------------------------------------------------------------
+# PulseGuider::sleep_until
+# Description:
+#	Wait until the monotonic clock reaches $t: sleep until self.spin
+#	seconds before, then spin. For internal use.
+#-----------------------------------------------------------------------------
+
+	def sleep_until(self, t):
+		while True:
+			wait = t - clock()
+			if wait <= 0.0:
+				return
+			if wait > self.spin:
+				time.sleep(wait - self.spin)
+
+#-----------------------------------------------------------------------------
+# PulseGuider::get_statistics
+# Description:
+#	Mean and standard deviation of the pulse length errors (achieved minus
+#	requested) [s] over the pulse history.
+#-----------------------------------------------------------------------------
+
+	def get_statistics(self):
+		err = [x[2] - x[1] for x in self.history]
+		if not err:
+			return None, None
+		mean = sum(err) / len(err)
+		std = (sum([(x - mean)**2 for x in err]) / len(err)) ** 0.5
+		return mean, std
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
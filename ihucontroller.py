@@ -2,12 +2,156 @@
 #=============================================================================
 
 import tcpdevice
+import motion
+import journal
+import topology
+from topology import IHU_HOST, IHU_PORT, IHU_AXES
 
 import time
 import subprocess
+import numpy
+from contextlib import contextmanager
 from optparse import OptionParser
 from os import environ
 
+#=============================================================================
+# Class: MotorSnapshot
+#=============================================================================
+#
+# State of all motors of a controller at one time: status (1: moving),
+# position and target arrays indexed by motor id - 1.
+#
+#=============================================================================
+
+class MotorSnapshot(object):
+
+	__slots__ = ('time', 'status', 'position', 'target')
+
+#-----------------------------------------------------------------------------
+# MotorSnapshot::__init__
+#-----------------------------------------------------------------------------
+
+	def __init__(self, time, status, position, target):
+		self.time = time
+		self.status = status
+		self.position = position
+		self.target = target
+		return
+
+#-----------------------------------------------------------------------------
+# MotorSnapshot::age
+# Description:
+#	Age of the snapshot [s].
+#-----------------------------------------------------------------------------
+
+	def age(self):
+		return time.time() - self.time
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
+# Class: SettleTracker
+#=============================================================================
+#
+# Completion tracking of a move of several motors.  The tracker is updated
+# with motor state snapshots (one GMSA/GMPM/GMTM burst per poll) and
+# reports each motor as soon as it stops: its final position is taken from
+# the same snapshot, and the optional callback(id, position) is called, so
+# dependent work (e.g. an exposure after a focuser move) can start while
+# the other motors are still moving.
+#
+# The timeout of each motor is derived from its step distance at the first
+# poll: margin + |target - position| / speed.  Unless $timeout is given,
+# which is then used for all motors.
+#
+#=============================================================================
+
+class SettleTracker(object):
+
+#-----------------------------------------------------------------------------
+# SettleTracker::__init__
+# Input:
+#	- ids (list):
+#		Motor ids.
+#	- speed (%f):
+#		Nominal motor speed [step/s].
+#	- margin (%f):
+#		Time added to the travel time [s].
+#	- timeout (%f):
+#		Fixed timeout of all motors [s]. Default: derived from the
+#		distances.
+#	- callback (callable):
+#		Called with the id and final position of each settled motor.
+#-----------------------------------------------------------------------------
+
+	def __init__(self, ids, speed, margin=2.0, timeout=None, callback=None):
+		self.ids = list(ids)
+		self.speed = float(speed)
+		self.margin = margin
+		self.callback = callback
+		self.start = time.time()
+		self.deadline = dict([(x, self.start + (timeout or margin)) for x in ids])
+		self.fixed = timeout is not None
+		self.first = True
+		self.pending = list(ids)
+		self.settled = {}
+		self.timedout = []
+		self.position = {}
+		return
+
+#-----------------------------------------------------------------------------
+# SettleTracker::update
+# Synopsis:
+#	update state t
+# Description:
+#	Update the tracker from the snapshot $state (None if the poll failed)
+#	taken at time $t.
+# Return:
+#	True if no motor is pending any more.
+#-----------------------------------------------------------------------------
+
+	def update(self, state, t):
+		if state is not None:
+			if self.first and not self.fixed:
+				for id in self.pending:
+					dist = abs(int(state.target[id-1]) - int(state.position[id-1]))
+					self.deadline[id] = t + self.margin + dist / self.speed
+			self.first = False
+			for id in self.pending:
+				self.position[id] = int(state.position[id-1])
+			done = [x for x in self.pending if not state.status[x-1]]
+			for id in done:
+				self.pending.remove(id)
+				self.settled[id] = t
+				if self.callback is not None:
+					self.callback(id, self.position[id])
+		late = [x for x in self.pending if t > self.deadline[x]]
+		for id in late:
+			self.pending.remove(id)
+			self.timedout.append(id)
+		return not self.pending
+
+#-----------------------------------------------------------------------------
+# SettleTracker::get_positions
+# Description:
+#	Last polled positions of the motors in the order of self.ids (None if
+#	never polled).
+#-----------------------------------------------------------------------------
+
+	def get_positions(self):
+		return [self.position.get(x) for x in self.ids]
+
+#-----------------------------------------------------------------------------
+# SettleTracker::__nonzero__
+# Description:
+#	True if all motors are settled.
+#-----------------------------------------------------------------------------
+
+	def __nonzero__(self):
+		return len(self.settled) == len(self.ids)
+
+#-----------------------------------------------------------------------------
+
 #=============================================================================
 # Class: IHUcontroller
 #=============================================================================
@@ -22,7 +166,40 @@ class IHUcontroller(tcpdevice.TCPDevice):
 
 	def __init__(self, nmotor=24):
 		tcpdevice.TCPDevice.__init__(self)
+		self.set_format('%s\n')
 		self.nmotor = nmotor
+		self.motor_bits = [0] + [1 << (x-1) for x in range(1, nmotor+1)]
+		self.motor_all = (1 << nmotor) - 1
+		self.motor_index = {}
+		self.poller = motion.Poller()
+		self.state = None
+		self.timeout['snapshot'] = 2
+		self.motor_speed = 500.0
+		self.settle_margin = 2.0
+		self.max_args = 4
+		self.timeout['set'] = 2
+		self.journal = None
+		self.nport = nmotor / 3
+		self.init_latency = {}
+		self.timeout['init'] = 2
+		self.topology = None
+		self.number = None
+		self.wiring = None
+		self.wiring_dirty = False
+		self.wiring_batch = 0
+		self.wiring_flushed = None
+		return
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::set_topology
+# Description:
+#	Use the IHU registry $topology (topology.Topology) for the port
+#	lookups; $number is the number of this controller in the registry.
+#-----------------------------------------------------------------------------
+
+	def set_topology(self, topology, number):
+		self.topology = topology
+		self.number = number
 		return
 
 #-----------------------------------------------------------------------------
@@ -51,35 +228,89 @@ class IHUcontroller(tcpdevice.TCPDevice):
 			ids = ids
 		return ids
 
+#-----------------------------------------------------------------------------
+# IHUcontroller::motor_mask
+# Description:
+#	Integer bitmask of the selected motors (bit id-1 for motor id), built
+#	from the precomputed id->bit table.
+#-----------------------------------------------------------------------------
+
+	def motor_mask(self, ids=None):
+		if ids is None:
+			return self.motor_all
+		if type(ids) is int:
+			return self.motor_bits[ids]
+		mask = 0
+		for id in ids:
+			mask |= self.motor_bits[id]
+		return mask
+
 #-----------------------------------------------------------------------------
 # IHUcontroller::motor_bit
+# Description:
+#	Motor selection string ('0b' and one bit per motor, motor 1 last).
 #-----------------------------------------------------------------------------
 
 	def motor_bit(self, ids=None):
-		ids = self.get_ids(ids, listonly=True)
-		if ids is None:
-			bitlist = ['1' for x in range(self.nmotor,0,-1)]
-		else:
-			bitlist = ['1' if x in ids else '0' for x in range(self.nmotor,0,-1)]
-		bits = '0b' +  ''.join(bitlist)
-		return bits
+		return '0b' + format(self.motor_mask(ids), '0%db' % self.nmotor)
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::decode_mask
+# Description:
+#	Convert a bit string (motor 1 last, optionally with '0b' prefix) to an
+#	integer bitmask. Integers are returned unchanged.
+#-----------------------------------------------------------------------------
+
+	def decode_mask(self, bits):
+		if type(bits) in (int, long):
+			return bits
+		return int(bits.strip(), 2)
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::decode_array
+# Description:
+#	Per-motor array (index id-1) of the bits of $bits (bitmask or bit
+#	string).
+#-----------------------------------------------------------------------------
+
+	def decode_array(self, bits):
+		value = self.decode_mask(bits)
+		return (value >> numpy.arange(self.nmotor)) & 1
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::mask_index
+# Description:
+#	Bit positions of the motors in $mask in increasing motor order,
+#	cached per mask. For internal use.
+#-----------------------------------------------------------------------------
+
+	def mask_index(self, mask):
+		index = self.motor_index.get(mask)
+		if index is None:
+			index = [x for x in range(self.nmotor) if mask >> x & 1]
+			self.motor_index[mask] = index
+		return index
 
 #-----------------------------------------------------------------------------
 # IHUcontroller::motor_result
+# Description:
+#	Select the bits of the selected motors from $rbits (bit string with
+#	motor 1 last, or integer bitmask).
+# Return:
+#	List of 0/1 values in increasing motor order.
 #-----------------------------------------------------------------------------
 
 	def motor_result(self, rbits, ids=None):
-		mbits = self.motor_bit(ids);
-		rbits1 = rbits[::-1]
-		mbits1 = mbits[::-1]
-		result = []
-		for rbit, mbit in zip(rbits1,mbits1):
-			if mbit == '1':
-				result.append(int(rbit))
-		return result
+		value = self.decode_mask(rbits)
+		ids = self.get_ids(ids, listonly=True)
+		return [value >> x & 1 for x in self.mask_index(self.motor_mask(ids))]
 
 #-----------------------------------------------------------------------------
 # IHUcontroller::build_command
+# Description:
+#	Build the command string of $cmd for the selected motors and
+#	arguments.  If $split is given (True: self.max_args), a list of
+#	commands is returned, with at most $split motor arguments in each.
 #-----------------------------------------------------------------------------
 
 	def build_command(self, cmd, motors=None, args='', split=None):
@@ -87,12 +318,12 @@ class IHUcontroller(tcpdevice.TCPDevice):
 		args = self.get_ids(args)
 
 		if split:
-			motors_split = utils.split(motors, split)
-			args_split = utils.split(args, split)
-			cmds = []
-			for motor, arg in zip(motors_split, args_split):
-				cmds.append(self.build_command(cmd, motor, arg))
-			return cmds
+			if split is True:
+				split = self.max_args
+			if type(motors) is not list or type(args) is not list:
+				return [self.build_command(cmd, motors, args)]
+			return [self.build_command(cmd, motors[i:i+split], args[i:i+split])
+				for i in range(0, len(motors), split)]
 
 		if type(motors) is list and args == '':
 			cmd += 'M'
@@ -102,8 +333,8 @@ class IHUcontroller(tcpdevice.TCPDevice):
 		elif type(motors) is list and type(args) is list:
 			cmd += 'I'
 			motorid = self.motor_bit(motors)
-			args.reverse()
-			arg = ','.join([str(x) for x in args])
+			pairs = sorted(zip(motors, args), reverse=True)
+			arg = ','.join([str(x[1]) for x in pairs])
 
 		elif type(motors) is list:
 			cmd += 'C'
@@ -146,74 +377,326 @@ class IHUcontroller(tcpdevice.TCPDevice):
 	def init_ihu(self, ids):
 		ports = []
 		for id in ids:
-			port = (id+2)/3
+			port = self.motor_port(id)
 			ports.append(port)
 		rcv = self.init_port(ports)
 		return rcv
 
-	def init_port(self, ids):
-		ids = self.get_ids(ids, listonly=True)
-		for rep in range(1,3): 
-			rcv = []
-			for id in ids:
-				cmd = 'II %d' % id
-				ret = self.command_read(cmd) 
-				rcv.append(ret)
-			time.sleep(1)
-		return rcv
+#-----------------------------------------------------------------------------
+# IHUcontroller:motor_port
+# Description:
+#	Port (motor driver board) of motor $id, from the topology if it is
+#	set and knows the motor, otherwise three motors per port.
+#-----------------------------------------------------------------------------
+
+	def motor_port(self, id):
+		if self.topology is not None:
+			owner = self.topology.find_motor(self.number, id)
+			if owner is not None:
+				return self.topology.get_port(owner[0])
+		return topology.Topology.motor_port(id)
+
+#-----------------------------------------------------------------------------
+# IHUcontroller:init_port
+# Synopsis:
+#	init_port ids timeout retries
+# Description:
+#	Initialize the selected ports.  The II commands of all ports are sent
+#	in one pipelined burst, and the readiness of the ports is polled
+#	instead of fixed sleeps.  If a reply of the burst is missing, the
+#	replies can not be matched to the ports, and the whole burst counts as
+#	unacknowledged.  The protocol has no init done flag: a port counts as
+#	ready once it acknowledged II, answers a position read of its motors
+#	(GMPM) and all its motors are at rest (GMSA), both polled in one
+#	burst.  Ports which are not ready within $timeout seconds of the
+#	acknowledgement are initialized again, at most $retries times.
+# Return:
+#	Dictionary of port: init latency [s] (acknowledgement to ready), None
+#	for the ports which failed. Also kept in self.init_latency.
+#-----------------------------------------------------------------------------
+
+	def init_port(self, ids, timeout=5.0, retries=2, poll=0.1):
+		ports = self.get_ids(ids, listonly=True)
+		latency = {}
+		todo = list(ports)
+		for rep in range(retries+1):
+			if not todo:
+				break
+			cmds = ['II %d' % x for x in todo]
+			rcv = self.command_pipeline(cmds, self.get_timeout('init')) or []
+			t0 = time.time()
+			if len(rcv) < len(cmds):
+				self.unread += len(cmds) - len(rcv)
+				continue
+			waiting = [x for x, r in zip(todo, rcv) if r]
+			while waiting and time.time() - t0 < timeout:
+				time.sleep(poll)
+				ready = self.get_ready_ports(waiting)
+				now = time.time()
+				for port in ready:
+					latency[port] = now - t0
+					waiting.remove(port)
+			todo = [x for x in todo if x not in latency]
+
+		self.invalidate()
+		for port in ports:
+			self.init_latency[port] = latency.get(port)
+		return dict([(x, latency.get(x)) for x in ports])
+
+#-----------------------------------------------------------------------------
+# IHUcontroller:get_ready_ports
+# Description:
+#	Ports of $ports which answer a position read of all their motors and
+#	whose motors are all at rest, see init_port(). For internal use.
+#-----------------------------------------------------------------------------
+
+	def get_ready_ports(self, ports):
+		motors = [self.port_motors(x) for x in ports]
+		cmds = ['GMSA'] + [self.build_command('GMP', x) for x in motors]
+		rcv = self.command_pipeline(cmds, self.get_timeout('snapshot'))
+		if not rcv or len(rcv) < len(cmds) or not rcv[0].strip():
+			return []
+		try:
+			status = self.decode_mask(rcv[0].strip()[::-1])
+		except ValueError:
+			return []
+
+		ready = []
+		for port, ids, pos in zip(ports, motors, rcv[1:]):
+			try:
+				if len([int(x) for x in pos.split(',')]) != len(ids):
+					continue
+			except ValueError:
+				continue
+			if not status & self.motor_mask(ids):
+				ready.append(port)
+		return ready
+
+#-----------------------------------------------------------------------------
+# IHUcontroller:port_motors
+# Description:
+#	Motor ids of port $port.
+#-----------------------------------------------------------------------------
+
+	def port_motors(self, port):
+		return [x+1 for x in range(self.nmotor) if self.motor_port(x+1) == port]
+
+#-----------------------------------------------------------------------------
+# IHUcontroller:port_mask
+# Description:
+#	Bitmask of the motors of port $port.
+#-----------------------------------------------------------------------------
+
+	def port_mask(self, port):
+		return self.motor_mask(self.port_motors(port))
+
+#-----------------------------------------------------------------------------
+# IHUcontroller:get_status_mask
+# Description:
+#	Status of all motors (GMSA) as an integer bitmask, None on failure.
+#-----------------------------------------------------------------------------
+
+	def get_status_mask(self):
+		rcv = self.command_pipeline(['GMSA'])
+		if not rcv or not rcv[0].strip():
+			return None
+		try:
+			return self.decode_mask(rcv[0].strip()[::-1])
+		except ValueError:
+			return None
 
 #-----------------------------------------------------------------------------
 # IHUcontroller::init_all
 # Description:
-#	Initialize the controller and all ports in one command.
+#	Initialize the controller, wait until it answers the status query,
+#	then initialize all ports (see init_port).
+# Return:
+#	Dictionary of port: init latency [s] (None for the failed ports), or
+#	False if the controller does not get ready.
+#-----------------------------------------------------------------------------
+
+	def init_all(self, timeout=5.0, poll=0.1):
+		self.init_controller()
+		end = time.time() + timeout
+		while self.get_status_mask() is None:
+			if time.time() > end:
+				return False
+			time.sleep(poll)
+		return self.init_port(range(1, self.nport+1), timeout)
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::set_journal
+# Synopsis:
+#	set_journal filename
+# Description:
+#	Record the commanded targets and the confirmed positions of the motors
+#	in the journal file $filename (see journal.MotorJournal). None stops
+#	the recording.
+#-----------------------------------------------------------------------------
+
+	def set_journal(self, filename):
+		if filename is None:
+			self.journal = None
+		else:
+			self.journal = journal.MotorJournal(filename, self.nmotor)
+		return self.journal
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::warm_start
+# Synopsis:
+#	warm_start filename init
+# Description:
+#	Compare the journal with one snapshot of the controller after a
+#	restart, then record the snapshot.  If $init is True, only the ports
+#	of the motors which do not match are initialized.
+# Return:
+#	Tuple of the lists of matching, mismatching and unknown motor ids
+#	(see MotorJournal::compare), or False if the snapshot failed.
+#-----------------------------------------------------------------------------
+
+	def warm_start(self, filename=None, init=True):
+		if filename is not None:
+			self.set_journal(filename)
+		log = self.journal
+		if log is None:
+			return False
+		# Compare before the snapshot is recorded in the journal
+		self.journal = None
+		state = self.snapshot()
+		self.journal = log
+		if state is None:
+			return False
+		match, mismatch, unknown = log.compare(state)
+		log.update(state)
+		ports = sorted(set([self.motor_port(x) for x in mismatch + unknown]))
+		if init and ports:
+			self.init_port(ports)
+		return match, mismatch, unknown
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::load_wiring
+# Description:
+#	Read the wiring bits of all motors (GMWB) into the wiring cache, if
+#	not loaded yet or $force is True.
+# Return:
+#	The wiring bitmask, or None if the read failed.
+#-----------------------------------------------------------------------------
+
+	def load_wiring(self, force=False):
+		if self.wiring is None or force:
+			rcv = self.command_pipeline(['GMWB'])
+			self.wiring = self.parse_wiring(rcv)
+			self.wiring_dirty = False
+		return self.wiring
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::parse_wiring
+# Description:
+#	Wiring bitmask from the GMWB replies $rcv (None if not valid). For
+#	internal use.
 #-----------------------------------------------------------------------------
 
-	def init_all(self, id=None):
-		self.init()
-		time.sleep(1)
-		for i in range(1,9):
-			self.init(i)
+	def parse_wiring(self, rcv):
+		if not rcv:
+			return None
+		try:
+			return self.decode_mask('0b' + rcv[-1].strip()[-self.nmotor:])
+		except ValueError:
+			return None
 
 #-----------------------------------------------------------------------------
 # IHUcontroller::get_motor_wiring
 # Description:
-#	Return the wiring info of the selected motors.  The wiring bit is 0 for
-#	normal, and 1 for reverse wiring.
+#	Return the wiring info of the selected motors from the wiring cache.
+#	The wiring bit is 0 for normal, and 1 for reverse wiring.
 #-----------------------------------------------------------------------------
 
 	def get_motor_wiring(self, ids=None, raw=False):
-		rcv = self.command_read('GMWB')
-		wbits = '0b' + rcv[-24:]
+		value = self.load_wiring()
+		if value is None:
+			return False
 		if raw:
-			return wbits
+			return '0b' + format(value, '0%db' % self.nmotor)
 		ids = self.get_ids(ids, listonly=True)
-		result = self.motor_result(wbits, ids)
+		result = self.motor_result(value, ids)
 		return result
 
 #-----------------------------------------------------------------------------
 # IHUcontroller::set_motor_wiring
 # Description:
 #	Change the wiring (rotation direction) of the selected motors.  The
-#	wiring bit is 0 for normal and 1 for reverse wiring.
+#	wiring bit is 0 for normal and 1 for reverse wiring.  The change is
+#	made in the wiring cache and written to the controller at once, or
+#	at the end of the batch (see wiring_edit).
+# Return:
+#	True/False (see flush_wiring)
 #-----------------------------------------------------------------------------
 
 	def set_motor_wiring(self, ids, bits):
-		rcv = self.get_motor_wiring(raw=True)[-24:]
-		cbits = [int(x) for x in list(rcv)]
+		value = self.load_wiring()
+		if value is None:
+			return False
 		ids = self.get_ids(ids, listonly=True)
-		if ids is None:
-			ids = [x for x in range(1, self.nmotor+1)]
 		if type(bits) is not list:
 			nbits = [bits for x in ids]
 		else:
 			nbits = bits
-		bitlist = dict(zip(ids, nbits))
-		for id,bit in bitlist.iteritems():
-			cbits[self.nmotor-id] = bit
-		bitstr = ''.join([str(x) for x in cbits])
-		cmd = "SMW 0b%s" % bitstr
-		rcv = self.command_read(cmd)
-		return rcv
+		for id, bit in zip(ids, nbits):
+			if bit:
+				value |= self.motor_bits[id]
+			else:
+				value &= ~self.motor_bits[id]
+		if value != self.wiring:
+			self.wiring = value
+			self.wiring_dirty = True
+		if self.wiring_batch:
+			return True
+		return self.flush_wiring()
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::flush_wiring
+# Description:
+#	Write the changed wiring cache with one SMW and read it back with GMWB
+#	in the same pipelined burst.
+# Return:
+#	True if the controller has the cached bits. On failure the cache is
+#	dropped, to be reloaded on next use.
+#-----------------------------------------------------------------------------
+
+	def flush_wiring(self):
+		if not self.wiring_dirty:
+			return True
+		cmd = "SMW 0b%s" % format(self.wiring, '0%db' % self.nmotor)
+		rcv = self.command_pipeline([cmd, 'GMWB'])
+		if not rcv or len(rcv) < 2 or self.parse_wiring(rcv) != self.wiring:
+			self.wiring = None
+			self.wiring_dirty = False
+			return False
+		self.wiring_dirty = False
+		return True
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::wiring_edit
+# Description:
+#	Context manager of a batch of wiring changes: set_motor_wiring() only
+#	changes the cache within the block, and the result is written with
+#	one SMW when the (outermost) block exits.  The flush result is in
+#	self.wiring_flushed.
+#
+#		with c.wiring_edit():
+#			c.set_motor_wiring(1, 1)
+#			c.set_motor_wiring([4, 5], 0)
+#-----------------------------------------------------------------------------
+
+	@contextmanager
+	def wiring_edit(self):
+		self.wiring_batch += 1
+		try:
+			yield self
+		finally:
+			self.wiring_batch -= 1
+			if not self.wiring_batch:
+				self.wiring_flushed = self.flush_wiring()
 
 #-----------------------------------------------------------------------------
 # IHUcontroller::motor_wake
@@ -257,6 +740,7 @@ class IHUcontroller(tcpdevice.TCPDevice):
 			cmd = 'MF %d' % id
 		else:
 			cmd = 'MB %d' % id
+		self.invalidate()
 		rcv = self.command_read(cmd)
 		return rcv
 
@@ -268,6 +752,7 @@ class IHUcontroller(tcpdevice.TCPDevice):
 
 	def motor_stop(self, id):
 		cmd = 'MQ %d' % id
+		self.invalidate()
 		rcv = self.command_read(cmd)
 		return rcv
 
@@ -291,8 +776,7 @@ class IHUcontroller(tcpdevice.TCPDevice):
 	def get_motor_status(self, ids=None):
 		cmd = 'GMSA'
 		rcv = self.command_read(cmd)
-		sbits = rcv[::-1]
-		status = self.motor_result(sbits, ids)		
+		status = self.motor_result(rcv.strip()[::-1], ids)
 		return status
 
 #-----------------------------------------------------------------------------
@@ -323,25 +807,62 @@ class IHUcontroller(tcpdevice.TCPDevice):
 # IHUcontroller::set_motor_position
 # Description:
 #	Set the current position counter of the selected motors.
+# Return:
+#	True/False (see set_motor_values)
 #-----------------------------------------------------------------------------
 
 	def set_motor_position(self, ids, pos):
-		cmds = self.build_command('SMP', ids, pos, split=4)
-		for cmd in cmds:
-			rcv = self.command_read(cmd)
-		return rcv
+		return self.set_motor_values('SMP', 'GMP', ids, pos)
 
 #-----------------------------------------------------------------------------
 # IHUcontroller::set_motor_target
 # Description:
 #	Set the target position of the selected motors.
+# Return:
+#	True/False (see set_motor_values)
 #-----------------------------------------------------------------------------
 
 	def set_motor_target(self, ids, pos):
-		cmds = self.build_command('SMT', ids, pos, split=4)
-		for cmd in cmds:
-			rcv = self.command_read(cmd)
-		return rcv
+		return self.set_motor_values('SMT', 'GMT', ids, pos)
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::set_motor_values
+# Synopsis:
+#	set_motor_values cmd getcmd ids pos
+# Description:
+#	Send the $cmd (SMP/SMT) commands of the selected motors, split into
+#	chunks of at most self.max_args arguments, and the $getcmd (GMP/GMT)
+#	query of all of them in one pipelined burst, and check that the
+#	values are set. For internal use.
+# Return:
+#	True if all values are confirmed, otherwise False.
+#-----------------------------------------------------------------------------
+
+	def set_motor_values(self, cmd, getcmd, ids, pos):
+		cmds = self.build_command(cmd, ids, pos, split=True)
+		cmds.append(self.build_command(getcmd, ids))
+		self.invalidate()
+		rcv = self.command_pipeline(cmds, self.get_timeout('set'))
+		if not rcv or len(rcv) < len(cmds):
+			return False
+
+		ids = self.get_ids(ids, listonly=True)
+		pos = self.get_ids(pos)
+		if type(pos) is not list:
+			pos = [pos for x in ids]
+		expected = dict(zip(ids, [int(x) for x in pos]))
+		try:
+			got = [int(x) for x in rcv[-1].split(',')]
+		except ValueError:
+			return False
+		if got != [expected[x] for x in sorted(ids)]:
+			return False
+		if self.journal is not None:
+			if cmd == 'SMT':
+				self.journal.record_target(ids, [expected[x] for x in ids])
+			else:
+				self.journal.record_position(ids, [expected[x] for x in ids])
+		return True
 
 #-----------------------------------------------------------------------------
 # IHUcontroller::motor_goto
@@ -352,24 +873,102 @@ class IHUcontroller(tcpdevice.TCPDevice):
 	def motor_goto(self, ids=None):
 		bits = self.motor_bit(ids)
 		cmd = 'MGC %s' % bits
-		rcv = self.command_read(cmd)
-		return rcv
+		self.invalidate()
+		rcv = self.command_pipeline([cmd])
+		if not rcv:
+			return False
+		return rcv[0]
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::settle_tracker
+# Description:
+#	Return a SettleTracker of the selected motors with the speed and
+#	margin of the controller. For internal use.
+#-----------------------------------------------------------------------------
+
+	def settle_tracker(self, ids=None, timeout=None, callback=None):
+		ids = self.get_ids(ids, listonly=True)
+		return SettleTracker(ids, self.motor_speed, self.settle_margin,
+			timeout, callback)
 
 #-----------------------------------------------------------------------------
 # IHUcontroller::motor_settle
 # Description:
 #	Wait until the selected motors are settled down (finish moving) or
-#	timeout occurs.
+#	timed out.  Each poll is one snapshot of all motors; $callback(id,
+#	position) is called for each motor when it stops.  The timeouts are
+#	derived from the step distances unless $timeout is given.
+# Return:
+#	The SettleTracker, which is true if all motors are settled.  Its
+#	get_positions() gives the final positions from the last poll.
 #-----------------------------------------------------------------------------
 
-	def motor_settle(self, ids=None, timeout=10):
-		
-		def get_status():
-			return self.get_motor_status(ids)
+	def motor_settle(self, ids=None, timeout=None, callback=None, poll=0.2):
+		tracker = self.settle_tracker(ids, timeout, callback)
+		time.sleep(poll)
+		while not tracker.update(self.snapshot(), time.time()):
+			time.sleep(poll)
+		return tracker
 
-		ids = self.get_ids(ids, listonly=True)
-		status = [0 for x in ids]
-		return tcpdevice.waitfor(get_status, '==', status, timeout=timeout)
+#-----------------------------------------------------------------------------
+
+#=============================================================================
+# Motor state snapshot
+#=============================================================================
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::snapshot
+# Description:
+#	Query the status, position and target of all motors in one pipelined
+#	burst (GMSA, GMPM and GMTM over all motors).  The result is stored in
+#	self.state.
+# Return:
+#	MotorSnapshot, or None if the query failed.
+#-----------------------------------------------------------------------------
+
+	def snapshot(self):
+		cmds = ['GMSA', self.build_command('GMP'), self.build_command('GMT')]
+		t0 = time.time()
+		rcv = self.command_pipeline(cmds, self.get_timeout('snapshot'))
+		t1 = time.time()
+		if not rcv or len(rcv) < 3:
+			return None
+		try:
+			status = self.decode_array(rcv[0].strip()[::-1]).astype(numpy.int8)
+			pos = numpy.array(rcv[1].split(','), dtype=numpy.int32)
+			target = numpy.array(rcv[2].split(','), dtype=numpy.int32)
+		except ValueError:
+			return None
+		if len(pos) != self.nmotor or len(target) != self.nmotor:
+			return None
+		self.state = MotorSnapshot(0.5*(t0+t1), status, pos, target)
+		if self.journal is not None:
+			self.journal.update(self.state)
+		return self.state
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::get_snapshot
+# Description:
+#	Return self.state if it is not older than $maxage seconds, otherwise
+#	take a new snapshot.
+#-----------------------------------------------------------------------------
+
+	def get_snapshot(self, maxage=1.0):
+		state = self.state
+		if state is not None and state.age() <= maxage:
+			return state
+		return self.snapshot()
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::invalidate
+# Description:
+#	Drop the stored snapshot after commands which change the motor state.
+#	For internal use.
+#-----------------------------------------------------------------------------
+
+	def invalidate(self):
+		self.state = None
+		return
 
 #-----------------------------------------------------------------------------
 
@@ -381,16 +980,100 @@ class IHUcontroller(tcpdevice.TCPDevice):
 # IHUcontroller::motor_new
 # Description:
 #	Move the selected motors to the new positions.  If $wait is True, then
-#	wait until the motors are settled.
+#	wait until the motors are settled and return their final positions
+#	(False on timeout).  False is also returned, and no MGC sent, if the
+#	targets are not confirmed.  Otherwise return a motion.Motion handle (a
+#	Future), which gets the final positions when the motors are settled.
+#	$callback(id, position) is called for each motor when it stops (see
+#	motor_settle).
+#-----------------------------------------------------------------------------
+
+	def motor_new(self, ids=None, pos=0, wait=True, timeout=None,
+			callback=None):
+		if not self.set_motor_target(ids, pos):
+			return False
+		if self.motor_goto(ids) is False:
+			return False
+		if not wait:
+			return self.track_motors(ids, timeout, callback)
+		tracker = self.motor_settle(ids, timeout, callback)
+		if not tracker:
+			return False
+		return tracker.get_positions()
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::track_motors
+# Description:
+#	Return a motion.Motion handle of the move of the selected motors.  The
+#	state of all motors is read with one snapshot per polling cycle, shared
+#	by all pending moves, and fed to a SettleTracker.  The handle gets
+#	the final positions, or a TimeoutError if a motor does not settle.
+#	Cancel stops the motors. For internal use.
 #-----------------------------------------------------------------------------
 
-	def motor_new(self, ids=None, pos=0, wait=True):
-		rcv = self.set_motor_target(ids, pos)
-		rcv = self.motor_goto(ids)
-		if not wait:
-			return rcv
-		self.motor_settle(ids)
-		return self.motor_get(ids)
+	def track_motors(self, ids=None, timeout=None, callback=None):
+		tracker = self.settle_tracker(ids, timeout, callback)
+
+		def check(state):
+			if not tracker.update(state, time.time()):
+				return None
+			if tracker.timedout:
+				raise motion.TimeoutError('motor timeout: %s' % tracker.timedout)
+			return (tracker.get_positions(),)
+
+		def stop():
+			for id in tracker.ids:
+				self.motor_stop(id)
+
+		return self.poller.add(self.snapshot, check, stop, delay=0.2)
+
+#-----------------------------------------------------------------------------
+# IHUcontroller::motor_plan
+# Synopsis:
+#	motor_plan ids pos sync timeout callback
+# Description:
+#	Move any set of motors (e.g. all axes of several IHUs) to the new
+#	positions $pos with one target burst and one MGC, and wait for all of
+#	them in a single settle loop (see motor_settle).
+#	If $sync is True, the motors arrive at the same time: the controller
+#	has no per-motor speed setting, so the start of the shorter moves is
+#	delayed by the travel time difference at self.motor_speed (one MGC per
+#	start time, issued from the settle loop).
+# Return:
+#	The SettleTracker, or False if the targets can not be set.
+#-----------------------------------------------------------------------------
+
+	def motor_plan(self, ids, pos, sync=False, timeout=None, callback=None,
+			poll=0.2):
+		ids = self.get_ids(ids, listonly=True)
+		if not self.set_motor_target(ids, pos):
+			return False
+
+		starts = {0.0: ids}
+		state = None
+		if sync:
+			state = self.snapshot()
+		if state is not None:
+			i = numpy.array(ids) - 1
+			travel = numpy.abs(state.target[i] - state.position[i]) / self.motor_speed
+			delay = numpy.round((travel.max() - travel) / poll) * poll
+			starts = {}
+			for id, d in zip(ids, delay):
+				starts.setdefault(d, []).append(id)
+		starts = sorted(starts.items())
+
+		tracker = self.settle_tracker(ids, timeout, callback)
+		t0 = time.time()
+		while True:
+			now = time.time()
+			while starts and now - t0 >= starts[0][0]:
+				self.motor_goto(starts.pop(0)[1])
+			if not starts:
+				time.sleep(poll)
+				if tracker.update(self.snapshot(), time.time()):
+					return tracker
+			else:
+				time.sleep(min(poll, max(t0 + starts[0][0] - time.time(), 0.0)))
 
 #-----------------------------------------------------------------------------
 # IHUcontroller::motor_make
@@ -398,14 +1081,14 @@ class IHUcontroller(tcpdevice.TCPDevice):
 #	 is True, then wait until the motors are settled.
 #-----------------------------------------------------------------------------
 
-	def motor_make(self, ids=None, pos=0, wait=True):
+	def motor_make(self, ids=None, pos=0, wait=True, callback=None):
 		pos = self.get_ids(pos)
 		pos0 = self.motor_get(ids)
 		if type(pos) is list:
 			pos1 = [sum(x) for x in zip(pos, pos0)]
 		else:
 			pos1 = [x+pos for x in pos0]
-		return self.motor_new(ids, pos1, wait)
+		return self.motor_new(ids, pos1, wait, callback=callback)
 
 #-----------------------------------------------------------------------------
 # IHUcontroller::motor_get
@@ -446,14 +1129,39 @@ class IHU(object):
 # IHU::__init__
 #-----------------------------------------------------------------------------
 
-	def __init__(self, controller, alt, alm, foc):
+	def __init__(self, controller, alt, alm, foc, maxage=1.0, limits=None):
 		self.controller = controller
 		self.motor_id = {}
 		self.motor_id['alt'] = int(alt)
 		self.motor_id['alm'] = int(alm)
 		self.motor_id['foc'] = int(foc)
+		self.maxage = maxage
+		self.limits = limits or {}
 		return
 
+#-----------------------------------------------------------------------------
+# IHU::check_limits
+# Description:
+#	Check the position $pos of $axis against the step limits (if any).
+#-----------------------------------------------------------------------------
+
+	def check_limits(self, axis, pos):
+		if axis not in self.limits:
+			return True
+		min, max = self.limits[axis]
+		return min <= pos <= max
+
+#-----------------------------------------------------------------------------
+# IHU::get_state
+# Description:
+#	Motor state snapshot of the controller, not older than self.maxage
+#	seconds (see IHUcontroller::get_snapshot). All IHUs of the controller
+#	share the snapshot.
+#-----------------------------------------------------------------------------
+
+	def get_state(self):
+		return self.controller.get_snapshot(self.maxage)
+
 #-----------------------------------------------------------------------------
 # IHU::get_motor_id
 #-----------------------------------------------------------------------------
@@ -492,6 +1200,9 @@ class IHU(object):
 
 	def get_status(self, axis):
 		id = self.get_motor_id(axis)
+		state = self.get_state()
+		if state is not None:
+			return int(state.status[id-1])
 		ret = self.controller.get_motor_status(id)
 		return self.get_result(ret)
 
@@ -519,9 +1230,24 @@ class IHU(object):
 
 	def get_position(self, axis):
 		id = self.get_motor_id(axis)
+		state = self.get_state()
+		if state is not None:
+			return int(state.position[id-1])
 		ret = self.controller.motor_get(id)
 		return self.get_result(ret)
 
+#-----------------------------------------------------------------------------
+# IHU::get_target
+#-----------------------------------------------------------------------------
+
+	def get_target(self, axis):
+		id = self.get_motor_id(axis)
+		state = self.get_state()
+		if state is not None:
+			return int(state.target[id-1])
+		ret = self.controller.get_motor_target(id)
+		return self.get_result(ret)
+
 #-----------------------------------------------------------------------------
 # IHU::set_position
 #-----------------------------------------------------------------------------
@@ -544,18 +1270,44 @@ class IHU(object):
 # IHU::new
 #-----------------------------------------------------------------------------
 
-	def new(self, axis, pos, wait=True):
+	def new(self, axis, pos, wait=True, callback=None):
 		id = self.get_motor_id(axis)
-		ret = self.controller.motor_new(id, pos, wait)
+		if not self.check_limits(axis, pos):
+			return False
+		ret = self.controller.motor_new(id, pos, wait, callback=callback)
 		return self.get_result(ret)
 
+#-----------------------------------------------------------------------------
+# IHU::plan
+# Synopsis:
+#	plan targets sync
+# Description:
+#	Move several axes at once; $targets is a dictionary of axis: position
+#	(see IHUcontroller::motor_plan).
+# Return:
+#	Dictionary of axis: final position, or False on timeout.
+#-----------------------------------------------------------------------------
+
+	def plan(self, targets, sync=False, callback=None):
+		axes = [x for x in IHU_AXES if x in targets]
+		if [x for x in axes if not self.check_limits(x, targets[x])]:
+			return False
+		ids = [self.get_motor_id(x) for x in axes]
+		tracker = self.controller.motor_plan(ids, [targets[x] for x in axes],
+			sync, callback=callback)
+		if not tracker:
+			return False
+		return dict(zip(axes, tracker.get_positions()))
+
 #-----------------------------------------------------------------------------
 # IHU::make
 #-----------------------------------------------------------------------------
 
-	def make(self, axis, pos, wait=True):
+	def make(self, axis, pos, wait=True, callback=None):
 		id = self.get_motor_id(axis)
-		ret = self.controller.motor_make(id, pos, wait)
+		if axis in self.limits:
+			return self.new(axis, self.get_position(axis) + pos, wait, callback)
+		ret = self.controller.motor_make(id, pos, wait, callback)
 		return self.get_result(ret)
 
 #-----------------------------------------------------------------------------
@@ -582,6 +1334,8 @@ def read_command_line():
 			action='store', type='int')
 	parser.add_option('--ihu', dest='ihu', default=None,
 			action='store', type='int')
+	parser.add_option('--config', dest='config',
+			default=environ.get('IHU_TOPOLOGY'), action='store', type='str')
 
 	parser.add_option('--alt', dest='altdev', default=False,
 			action='store_true')
@@ -648,43 +1402,43 @@ def read_command_line():
 	else:
 		options.action = None
 
-	if options.ihu is not None:
-		options.controller, options.id = find_ihu(options.ihu)
-
 	options.target = None
 	if str is not None:
 		options.target = int(str)
 
 	return options
 
-#-----------------------------------------------------------------------------
-#-----------------------------------------------------------------------------
-
-def find_ihu(ihu):
-	ihus = {}
-	ihus[1] = (1,1)
-	ihus[2] = (1,2)
-	ihus[3] = (1,3)
-	ihus[4] = (1,4)
-	return ihus[ihu]
-	
 #-----------------------------------------------------------------------------
 
 if __name__=='__main__' :
 
 	options = read_command_line()
-	
-	host = '192.168.9.2%d' % options.controller
-	port = 5000
+	topo = topology.load_topology(options.config)
+
+	limits = None
+	if options.ihu is not None:
+		controller = topo.get_controller(options.ihu)
+		motors = topo.get_motor_ids(options.ihu)
+		limits = topo.get_limits(options.ihu)
+	else:
+		controller = options.controller
+		motors = topo.slot_motors(options.id)
+
+	if controller in topo.controllers:
+		host, port = topo.get_address(controller)
+	else:
+		host, port = IHU_HOST % controller, IHU_PORT
+	if options.host is not None:
+		host = options.host
+	if options.port is not None:
+		port = int(options.port)
 
 	c = IHUcontroller()
 	c.set_port(host, port)
+	c.set_topology(topo, controller)
 	c.connect()
 
-	m1 = (options.id) * 3 - 2
-	m2 = m1 + 1
-	m3 = m1 + 2
-	d = IHU(c, m1, m2, m3)
+	d = IHU(c, *motors, limits=limits)
 
 	dev = options.dev
 	action = options.action
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import os
+import time
+
+import numpy
+
+#=============================================================================
+# Journal file layout
+#=============================================================================
+#
+# Header (16 bytes) followed by one 32 byte record per motor (motor id - 1
+# order), little endian:
+#
+#	seq:		update counter, odd while the record is being written
+#	flags:		JOURNAL_TARGET / JOURNAL_POSITION, the valid fields
+#	target:		last commanded target position
+#	position:	last confirmed position (motor at rest)
+#	ttime:		time of the target [Unix time]
+#	ptime:		time of the position [Unix time]
+#
+#=============================================================================
+
+JOURNAL_MAGIC = 'IHUJ'
+JOURNAL_VERSION = 1
+
+JOURNAL_TARGET = 1
+JOURNAL_POSITION = 2
+
+JOURNAL_HEADER = numpy.dtype([('magic', 'S4'), ('version', '<u4'),
+	('nmotor', '<u4'), ('pad', '<u4')])
+JOURNAL_RECORD = numpy.dtype([('seq', '<u4'), ('flags', '<u4'),
+	('target', '<i4'), ('position', '<i4'), ('ttime', '<f8'), ('ptime', '<f8')])
+
+#=============================================================================
+# MotorJournal
+#=============================================================================
+#
+# Class: MotorJournal
+#
+# Persistent journal of the motor state of an IHU controller, for a warm
+# restart without re-initializing the motors and re-reading the positions
+# one by one.  The journal is a memory-mapped file: the commanded targets
+# and the confirmed positions are written in place, without any system
+# call but the flush.
+#
+# The records are crash safe: the update counter of a record is odd while
+# it is being written, so a record torn by a crash is detected and not
+# trusted.  On startup the journal is compared with one snapshot of the
+# controller (IHUcontroller::warm_start): the motors whose position
+# counter matches the journal need no initialization, the others are
+# flagged.
+#
+#=============================================================================
+
+class MotorJournal(object):
+
+#-----------------------------------------------------------------------------
+# MotorJournal::__init__
+# Input:
+#	- filename (%s):
+#		Journal file. Created (or recreated, if it does not match) with
+#		no valid records.
+#	- nmotor (%d):
+#		Number of motors of the controller.
+#-----------------------------------------------------------------------------
+
+	def __init__(self, filename, nmotor=24):
+		self.filename = filename
+		self.nmotor = nmotor
+		size = JOURNAL_HEADER.itemsize + nmotor * JOURNAL_RECORD.itemsize
+		if not os.path.exists(filename) or os.path.getsize(filename) != size:
+			self.create()
+		self.map = numpy.memmap(filename, dtype=numpy.uint8, mode='r+',
+			shape=(size,))
+		self.header = self.map[:JOURNAL_HEADER.itemsize].view(JOURNAL_HEADER)
+		self.records = self.map[JOURNAL_HEADER.itemsize:].view(JOURNAL_RECORD)
+		if (self.header['magic'][0] != JOURNAL_MAGIC or
+				self.header['version'][0] != JOURNAL_VERSION or
+				self.header['nmotor'][0] != nmotor):
+			del self.header, self.records, self.map
+			self.create()
+			self.__init__(filename, nmotor)
+		return
+
+#-----------------------------------------------------------------------------
+# MotorJournal::create
+# Description:
+#	Write an empty journal file. For internal use.
+#-----------------------------------------------------------------------------
+
+	def create(self):
+		header = numpy.zeros(1, dtype=JOURNAL_HEADER)
+		header['magic'] = JOURNAL_MAGIC
+		header['version'] = JOURNAL_VERSION
+		header['nmotor'] = self.nmotor
+		records = numpy.zeros(self.nmotor, dtype=JOURNAL_RECORD)
+		f = open(self.filename, 'wb')
+		f.write(header.tobytes() + records.tobytes())
+		f.flush()
+		os.fsync(f.fileno())
+		f.close()
+		return
+
+#-----------------------------------------------------------------------------
+# MotorJournal::write
+# Description:
+#	Write $field (and its time $tfield) of the motors $ids with the
+#	update counter protocol and flush. For internal use.
+#-----------------------------------------------------------------------------
+
+	def write(self, ids, values, field, tfield, flag, t=None):
+		i = numpy.atleast_1d(numpy.asarray(ids, dtype=int)) - 1
+		if not len(i):
+			return
+		r = self.records
+		r['seq'][i] |= 1
+		r[field][i] = values
+		r[tfield][i] = t or time.time()
+		r['flags'][i] |= flag
+		r['seq'][i] += 1
+		self.map.flush()
+		return
+
+#-----------------------------------------------------------------------------
+# MotorJournal::record_target
+# Synopsis:
+#	record_target ids pos
+# Description:
+#	Record the commanded targets $pos (list or scalar) of the motors $ids.
+#-----------------------------------------------------------------------------
+
+	def record_target(self, ids, pos, t=None):
+		self.write(ids, pos, 'target', 'ttime', JOURNAL_TARGET, t)
+		return
+
+#-----------------------------------------------------------------------------
+# MotorJournal::record_position
+# Description:
+#	Record the confirmed positions $pos of the motors $ids.
+#-----------------------------------------------------------------------------
+
+	def record_position(self, ids, pos, t=None):
+		self.write(ids, pos, 'position', 'ptime', JOURNAL_POSITION, t)
+		return
+
+#-----------------------------------------------------------------------------
+# MotorJournal::update
+# Description:
+#	Record the positions of the motors at rest in the snapshot $state
+#	(ihucontroller.MotorSnapshot).
+#-----------------------------------------------------------------------------
+
+	def update(self, state):
+		rest = numpy.flatnonzero(state.status == 0)
+		changed = rest[(self.records['position'][rest] != state.position[rest]) |
+			(self.records['flags'][rest] & JOURNAL_POSITION == 0)]
+		self.record_position(changed + 1, state.position[changed], state.time)
+		return
+
+#-----------------------------------------------------------------------------
+# MotorJournal::valid
+# Description:
+#	Boolean array of the motors (id - 1) with a valid, not torn position.
+#-----------------------------------------------------------------------------
+
+	def valid(self):
+		r = self.records
+		return (r['seq'] & 1 == 0) & (r['flags'] & JOURNAL_POSITION != 0)
+
+#-----------------------------------------------------------------------------
+# MotorJournal::compare
+# Synopsis:
+#	compare state
+# Description:
+#	Compare the journal with the snapshot $state of the controller.
+# Return:
+#	Tuple of the lists of motor ids which match (at rest at the journal
+#	position), mismatch (at rest elsewhere, or not at the journal target),
+#	and are unknown (no valid record, or moving).
+#-----------------------------------------------------------------------------
+
+	def compare(self, state):
+		r = self.records
+		valid = self.valid()
+		rest = state.status == 0
+		same = (r['position'] == state.position)
+		target = (r['flags'] & JOURNAL_TARGET == 0) | (r['target'] == state.target)
+		match = valid & rest & same & target
+		mismatch = valid & rest & ~(same & target)
+		unknown = ~valid | ~rest
+		ids = lambda x: [int(i) + 1 for i in numpy.flatnonzero(x)]
+		return ids(match), ids(mismatch), ids(unknown)
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import numpy
+
+import coordinates
+
+#=============================================================================
+# Limits
+#=============================================================================
+#
+# Class: Limits
+#
+# Local model of the pointing limits of the mount: the minimum and maximum
+# altitude (as set with set_alt_limit) and an optional azimuth dependent
+# horizon mask (buildings, trees, the dome slit).  With the site location
+# it tells whether targets are reachable, without asking the mount.  All
+# queries accept NumPy arrays of targets (and times), so thousands of
+# candidates can be filtered in one call.
+#
+# The horizon mask file has two columns: azimuth and minimum altitude
+# [deg].  The mask is interpolated linearly in azimuth (wrapping at 360),
+# and never goes below the minimum altitude limit.
+#
+# Units: RA in hours, Dec, azimuth and altitude in degrees, times are Unix
+# time stamps.
+#
+#=============================================================================
+
+class Limits(object):
+
+#-----------------------------------------------------------------------------
+# Limits::__init__
+# Input:
+#	- site (astrometry.Site):
+#		Site location, needed for the equatorial queries.
+#	- altlim (tuple):
+#		Minimum and maximum altitude [deg].
+#-----------------------------------------------------------------------------
+
+	def __init__(self, site=None, altlim=(0.0, 90.0)):
+		self.site = site
+		self.mask = None
+		self.set_altlim(*altlim)
+		return
+
+#-----------------------------------------------------------------------------
+# Limits::from_meade
+# Description:
+#	Create the limits from the Meade Go/Gh replies (see
+#	Scope.get_alt_limit). Unparsable values give the default limits.
+#-----------------------------------------------------------------------------
+
+	@classmethod
+	def from_meade(cls, site, low, high):
+		low = coordinates.parse_sexagesimal(low or '')
+		high = coordinates.parse_sexagesimal(high or '')
+		if numpy.isnan(low):
+			low = 0.0
+		if numpy.isnan(high):
+			high = 90.0
+		return cls(site, (low, high))
+
+#-----------------------------------------------------------------------------
+# Limits::set_altlim
+# Description:
+#	Set the minimum and maximum altitude [deg].
+#-----------------------------------------------------------------------------
+
+	def set_altlim(self, min, max):
+		self.altlim = (float(min), float(max))
+		return
+
+#-----------------------------------------------------------------------------
+# Limits::set_mask
+# Synopsis:
+#	set_mask az alt
+# Description:
+#	Set the horizon mask from the minimum altitudes $alt [deg] at azimuths
+#	$az [deg]. None removes the mask.
+#-----------------------------------------------------------------------------
+
+	def set_mask(self, az, alt=None):
+		if az is None:
+			self.mask = None
+			return
+		az = numpy.mod(numpy.asarray(az, dtype=float).ravel(), 360.0)
+		alt = numpy.asarray(alt, dtype=float).ravel()
+		i = numpy.argsort(az)
+		self.mask = (az[i], alt[i])
+		return
+
+#-----------------------------------------------------------------------------
+# Limits::load_mask
+# Description:
+#	Load the horizon mask from $filename (azimuth, altitude columns).
+#-----------------------------------------------------------------------------
+
+	def load_mask(self, filename):
+		data = numpy.loadtxt(filename, ndmin=2)
+		self.set_mask(data[:,0], data[:,1])
+		return
+
+#-----------------------------------------------------------------------------
+# Limits::horizon
+# Description:
+#	Minimum altitude [deg] at azimuth $az [deg].
+#-----------------------------------------------------------------------------
+
+	def horizon(self, az):
+		az = numpy.asarray(az, dtype=float)
+		if self.mask is None:
+			return numpy.zeros(az.shape) + self.altlim[0]
+		alt = numpy.interp(numpy.mod(az, 360.0), self.mask[0], self.mask[1],
+			period=360.0)
+		return numpy.maximum(alt, self.altlim[0])
+
+#-----------------------------------------------------------------------------
+# Limits::allowed
+# Synopsis:
+#	allowed az alt
+# Description:
+#	Check the horizontal positions $az, $alt [deg] against the limits.
+# Return:
+#	Boolean (array).
+#-----------------------------------------------------------------------------
+
+	def allowed(self, az, alt):
+		alt = numpy.asarray(alt, dtype=float)
+		return (alt >= self.horizon(az)) & (alt <= self.altlim[1])
+
+#-----------------------------------------------------------------------------
+# Limits::reachable
+# Synopsis:
+#	reachable ra dec t
+# Description:
+#	Check if the targets at $ra [hour], $dec [deg] are within the limits at
+#	$t (default: now).  The inputs are broadcast against each other.
+#	Without a horizon mask only the sine of the altitude is computed.
+# Return:
+#	Boolean (array).
+#-----------------------------------------------------------------------------
+
+	def reachable(self, ra, dec, t=None):
+		if self.mask is None:
+			sinalt = self.site.sin_altitude(ra, dec, t)
+			lim = numpy.sin(numpy.radians(self.altlim))
+			return (sinalt >= lim[0]) & (sinalt <= lim[1])
+		az, alt = self.site.altaz(ra, dec, t)
+		return self.allowed(az, alt)
+
+#-----------------------------------------------------------------------------
+# Limits::reachable_window
+# Synopsis:
+#	reachable_window ra dec t0 t1 step
+# Description:
+#	Check if the targets are within the limits during the whole time window
+#	from $t0 to $t1, sampled at least every $step seconds.
+# Return:
+#	Boolean array of the shape of the targets.
+#-----------------------------------------------------------------------------
+
+	def reachable_window(self, ra, dec, t0, t1, step=60.0):
+		ra = numpy.asarray(ra, dtype=float)
+		dec = numpy.asarray(dec, dtype=float)
+		n = max(int(numpy.ceil((t1 - t0) / step)), 1)
+		grid = t0 + (t1 - t0) * numpy.arange(n + 1) / float(n)
+		ok = self.reachable(ra[...,None], dec[...,None], grid)
+		return ok.all(axis=-1)
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import time
+import threading
+from concurrent.futures import Future, TimeoutError
+
+#=============================================================================
+# Motion
+#=============================================================================
+#
+# Module: motion
+#
+# Non-blocking handles for long-running device operations (scope slews and
+# homing, dome open/close, IHU motor moves).  The operation is started by
+# the device, and a Motion object (a concurrent.futures.Future) is returned
+# to track it.  The handle supports the usual Future interface: result()
+# and exception() with timeout, done(), add_done_callback() and cancel(),
+# which stops the device motion (halt, stop, motor_stop).
+#
+# The handles are completed by a Poller, one per device.  The poller runs
+# a background thread while there are pending operations, and in every
+# cycle calls each distinct status query only once, whatever the number
+# of operations waiting for it (e.g. one GMSA for all pending IHU moves).
+#
+# An operation which does not finish before its own timeout is stopped
+# (as on cancel) and gets a concurrent.futures.TimeoutError exception.
+#
+#=============================================================================
+
+class Motion(Future):
+
+#-----------------------------------------------------------------------------
+# Motion::__init__
+# Input:
+#	- query (callable):
+#		Status query of the device. Operations using the same query
+#		object share its result in each polling cycle.
+#	- check (callable):
+#		Called with the query result; returns None while the operation
+#		is running, or a tuple holding the result of the operation.
+#	- stop (callable):
+#		Stops the motion on cancel and timeout. Default: cancel is not
+#		possible.
+#	- timeout (%f):
+#		Maximum duration of the operation [s]. Default: no timeout
+#	- delay (%f):
+#		Time before the first status query [s].
+#-----------------------------------------------------------------------------
+
+	def __init__(self, query, check, stop=None, timeout=None, delay=0.0):
+		Future.__init__(self)
+		self.query = query
+		self.check = check
+		self.stop = stop
+		self.start = time.time()
+		self.begin = self.start + delay
+		self.deadline = None
+		if timeout is not None:
+			self.deadline = self.start + timeout
+		return
+
+#-----------------------------------------------------------------------------
+# Motion::cancel
+# Description:
+#	Stop the device motion and cancel the operation.
+# Return:
+#	True/False
+#-----------------------------------------------------------------------------
+
+	def cancel(self):
+		if self.stop is None or self.done():
+			return False
+		self.stop()
+		return Future.cancel(self)
+
+#-----------------------------------------------------------------------------
+# Motion::update
+# Description:
+#	Complete the operation from the status $status of its query, or with
+#	a timeout error, after stopping the device motion as cancel() does.
+#	Returns True if the operation is finished. For internal use.
+#-----------------------------------------------------------------------------
+
+	def update(self, status, t):
+		if self.done():
+			return True
+		try:
+			ret = None
+			if status is not None:
+				ret = self.check(status)
+			if ret is not None:
+				self.set_result(ret[0])
+				return True
+		except Exception as e:
+			self.set_exception(e)
+			return True
+		if self.deadline is not None and t > self.deadline:
+			if self.stop is not None:
+				try:
+					self.stop()
+				except Exception:
+					pass
+			self.set_exception(TimeoutError('motion timeout'))
+			return True
+		return False
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
+# Poller
+#=============================================================================
+#
+# Class: Poller
+#
+# Shared completion poller of the Motion operations of a device.
+#
+#=============================================================================
+
+class Poller(object):
+
+#-----------------------------------------------------------------------------
+# Poller::__init__
+# Input:
+#	- interval (%f):
+#		Time between two polling cycles [s].
+#-----------------------------------------------------------------------------
+
+	def __init__(self, interval=0.2):
+		self.interval = interval
+		self.pending = []
+		self.lock = threading.Lock()
+		self.thread = None
+		return
+
+#-----------------------------------------------------------------------------
+# Poller::add
+# Synopsis:
+#	add query check stop timeout delay
+# Description:
+#	Create a Motion handle (see Motion::__init__ for the arguments) and
+#	poll it until it is finished.
+# Return:
+#	The Motion handle.
+#-----------------------------------------------------------------------------
+
+	def add(self, query, check, stop=None, timeout=None, delay=0.0):
+		motion = Motion(query, check, stop, timeout, delay)
+		with self.lock:
+			self.pending.append(motion)
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.run)
+				self.thread.daemon = True
+				self.thread.start()
+		return motion
+
+#-----------------------------------------------------------------------------
+# Poller::run
+# Description:
+#	Polling loop of the background thread. Exits when there are no more
+#	pending operations. For internal use.
+#-----------------------------------------------------------------------------
+
+	def run(self):
+		while True:
+			with self.lock:
+				pending = [x for x in self.pending if not x.done()]
+				self.pending = pending
+				if not pending:
+					self.thread = None
+					return
+
+			t = time.time()
+			status = {}
+			for motion in pending:
+				if t < motion.begin:
+					continue
+				if motion.query not in status:
+					try:
+						status[motion.query] = motion.query()
+					except Exception:
+						status[motion.query] = None
+				motion.update(status[motion.query], time.time())
+
+			time.sleep(self.interval)
+
+#-----------------------------------------------------------------------------
+# Poller::wait
+# Description:
+#	Wait until all pending operations are finished or $timeout passed.
+# Return:
+#	True if all operations are finished.
+#-----------------------------------------------------------------------------
+
+	def wait(self, timeout=None):
+		end = None
+		if timeout is not None:
+			end = time.time() + timeout
+		while True:
+			with self.lock:
+				pending = list(self.pending)
+			pending = [x for x in pending if not x.done()]
+			if not pending:
+				return True
+			wait = None
+			if end is not None:
+				wait = end - time.time()
+				if wait <= 0.0:
+					return False
+			try:
+				pending[0].exception(wait)
+			except Exception:
+				pass
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import numpy
+
+#=============================================================================
+# Pointing model terms
+#=============================================================================
+#
+# Standard terms of an equatorial mount (TPOINT naming).  With hour angle
+# h, declination d and latitude p the pointing error (mount - true) is
+#
+#	dH = IH + CH sec d + NP tan d - MA cos h tan d + ME sin h tan d
+#		+ TF cos p sin h sec d
+#	dD = ID + MA sin h + ME cos h + TF (cos p cos h sin d - sin p cos d)
+#
+#	IH, ID:	index errors (zero points) of the axes
+#	CH:		collimation error
+#	NP:		non-perpendicularity of the axes
+#	MA, ME:	polar axis misalignment (east-west, elevation)
+#	TF:		tube flexure
+#
+# The terms are enabled in the order of TERMS as the number of samples
+# grows: (number of samples, number of terms) in TERMS_MIN.
+#
+#=============================================================================
+
+TERMS = ('IH', 'ID', 'MA', 'ME', 'CH', 'NP', 'TF')
+TERMS_MIN = ((2, 2), (4, 4), (8, 7))
+
+#=============================================================================
+# PointingModel
+#=============================================================================
+#
+# Class: PointingModel
+#
+# Pointing model of the mount fitted from sync pairs.  Every sync (Scope
+# set_coo) gives a pair of the position reported by the mount and the true
+# (solved) position.  The pairs are logged together with the local
+# sidereal time and the horizontal coordinates, and the terms are fitted
+# by linear least squares in one NumPy call.  The model converts the true
+# coordinates of a target to mount coordinates, so a goto lands on target
+# on the first slew.
+#
+# A sync moves the zero point of the mount coordinates by the pointing
+# error at the synced position.  The logged mount positions are shifted by
+# the same amount, so the old samples stay consistent with the new frame.
+#
+# Units: RA, hour angle and LST in hours, other angles in degrees.
+#
+#=============================================================================
+
+class PointingModel(object):
+
+#-----------------------------------------------------------------------------
+# PointingModel::__init__
+# Input:
+#	- latitude (%f):
+#		Site latitude [deg].
+#	- nmax (%d):
+#		Number of most recent sync pairs used in the fit.
+#	- maxdec (%f):
+#		Hour angle equations are not used above this |Dec| [deg].
+#-----------------------------------------------------------------------------
+
+	def __init__(self, latitude=0.0, nmax=200, maxdec=85.0):
+		self.latitude = latitude
+		self.nmax = nmax
+		self.maxdec = maxdec
+		self.samples = []
+		self.terms = ()
+		self.coeffs = numpy.zeros(0)
+		self.rms = None
+		return
+
+#-----------------------------------------------------------------------------
+# PointingModel::add_sync
+# Synopsis:
+#	add_sync t lst ra dec true_ra true_dec az alt
+# Input:
+#	- t (%f):
+#		Time of the sync [Unix time].
+#	- lst (%f):
+#		Local sidereal time [hour].
+#	- ra, dec (%f):
+#		Position reported by the mount before the sync.
+#	- true_ra, true_dec (%f):
+#		True (solved) position.
+#	- az, alt (%f):
+#		Horizontal coordinates of the true position (for the log).
+# Description:
+#	Log a sync pair, shift the mount frame of the earlier pairs and refit
+#	the model.
+#-----------------------------------------------------------------------------
+
+	def add_sync(self, t, lst, ra, dec, true_ra, true_dec, az=None, alt=None):
+		sample = [t, lst, ra, dec, true_ra, true_dec,
+			numpy.nan if az is None else az, numpy.nan if alt is None else alt]
+		if numpy.isnan(sample[2:6]).any():
+			return False
+		dra = (ra - true_ra + 12.0) % 24.0 - 12.0
+		ddec = dec - true_dec
+		self.samples.append(sample)
+		for x in self.samples:
+			x[2] = (x[2] - dra) % 24.0
+			x[3] = x[3] - ddec
+		del self.samples[:-self.nmax]
+		self.fit()
+		return True
+
+#-----------------------------------------------------------------------------
+# PointingModel::design
+# Description:
+#	Design matrices of the hour angle and declination errors for hour
+#	angle $ha [hour] and declination $dec [deg] (arrays). For internal
+#	use.
+#-----------------------------------------------------------------------------
+
+	def design(self, ha, dec):
+		h = numpy.radians(numpy.asarray(ha, dtype=float) * 15.0)
+		d = numpy.radians(numpy.asarray(dec, dtype=float))
+		p = numpy.radians(self.latitude)
+		sinh, cosh = numpy.sin(h), numpy.cos(h)
+		sind, cosd = numpy.sin(d), numpy.cos(d)
+		cosd = numpy.where(numpy.abs(cosd) < 1e-6, 1e-6, cosd)
+		secd, tand = 1.0 / cosd, sind / cosd
+		zero, one = numpy.zeros(h.shape), numpy.ones(h.shape)
+
+		ah = {'IH': one, 'ID': zero, 'CH': secd, 'NP': tand,
+			'MA': -cosh * tand, 'ME': sinh * tand,
+			'TF': numpy.cos(p) * sinh * secd}
+		ad = {'IH': zero, 'ID': one, 'CH': zero, 'NP': zero,
+			'MA': sinh, 'ME': cosh,
+			'TF': numpy.cos(p) * cosh * sind - numpy.sin(p) * cosd}
+		return ah, ad
+
+#-----------------------------------------------------------------------------
+# PointingModel::fit
+# Description:
+#	Least squares fit of the terms to the logged pairs.  The number of
+#	fitted terms grows with the number of pairs (TERMS_MIN): zero points
+#	from 2 pairs, polar alignment from 4, all terms from 8.
+#-----------------------------------------------------------------------------
+
+	def fit(self):
+		n = len(self.samples)
+		nterm = 0
+		for nmin, k in TERMS_MIN:
+			if n >= nmin:
+				nterm = k
+		terms = TERMS[:nterm]
+		if not terms:
+			self.terms, self.coeffs, self.rms = (), numpy.zeros(0), None
+			return False
+
+		s = numpy.array(self.samples)
+		ha = (s[:,1] - s[:,4] + 12.0) % 24.0 - 12.0
+		dec = s[:,5]
+		# Hour angle error: mount HA - true HA = true RA - mount RA
+		dh = ((s[:,4] - s[:,2] + 12.0) % 24.0 - 12.0) * 15.0
+		dd = s[:,3] - s[:,5]
+
+		ah, ad = self.design(ha, dec)
+		keep = numpy.abs(dec) < self.maxdec
+		a = numpy.vstack([
+			numpy.array([ah[x][keep] for x in terms]).T,
+			numpy.array([ad[x] for x in terms]).T])
+		b = numpy.concatenate([dh[keep], dd])
+		coeffs, res, rank, sv = numpy.linalg.lstsq(a, b, rcond=None)
+		if rank < len(terms):
+			return False
+		self.terms = terms
+		self.coeffs = coeffs
+		self.rms = float(numpy.sqrt(numpy.mean((a.dot(coeffs) - b)**2)))
+		return True
+
+#-----------------------------------------------------------------------------
+# PointingModel::error
+# Synopsis:
+#	error ha dec
+# Description:
+#	Pointing error (mount - true) in hour angle [deg] and declination
+#	[deg] at true $ha [hour], $dec [deg]. Arrays are accepted.
+#-----------------------------------------------------------------------------
+
+	def error(self, ha, dec):
+		ah, ad = self.design(ha, dec)
+		dh = sum([c * ah[x] for x, c in zip(self.terms, self.coeffs)])
+		dd = sum([c * ad[x] for x, c in zip(self.terms, self.coeffs)])
+		return dh, dd
+
+#-----------------------------------------------------------------------------
+# PointingModel::apply
+# Synopsis:
+#	apply ra dec lst
+# Description:
+#	Convert the true position $ra [hour], $dec [deg] to mount coordinates
+#	at local sidereal time $lst [hour]. Arrays are accepted.
+# Return:
+#	Tuple of mount RA and Dec.
+#-----------------------------------------------------------------------------
+
+	def apply(self, ra, dec, lst):
+		if not len(self.terms):
+			return ra, dec
+		ra = numpy.asarray(ra, dtype=float)
+		dec = numpy.asarray(dec, dtype=float)
+		ha = (lst - ra + 12.0) % 24.0 - 12.0
+		dh, dd = self.error(ha, dec)
+		return (ra - dh / 15.0) % 24.0, dec + dd
+
+#-----------------------------------------------------------------------------
+# PointingModel::save
+# Description:
+#	Save the logged sync pairs to $filename.
+#-----------------------------------------------------------------------------
+
+	def save(self, filename):
+		numpy.savetxt(filename, numpy.array(self.samples).reshape(-1, 8),
+			header='time lst[h] mount_ra[h] mount_dec[deg] ra[h] dec[deg] az[deg] alt[deg]')
+		return
+
+#-----------------------------------------------------------------------------
+# PointingModel::load
+# Description:
+#	Load sync pairs from $filename and refit the model.
+#-----------------------------------------------------------------------------
+
+	def load(self, filename):
+		samples = numpy.loadtxt(filename, ndmin=2)
+		self.samples = [list(x) for x in samples[-self.nmax:]]
+		return self.fit()
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import time
+import numpy
+
+import slewmodel
+import limits
+
+#=============================================================================
+# Scheduler
+#=============================================================================
+#
+# Class: Scheduler
+#
+# Target sequence optimizer.  It takes a batch of targets (RA, Dec,
+# exposure duration and optional visibility windows) and returns the order
+# in which they should be fed to Scope.move_coo so that the total slew and
+# wait time is small.
+#
+# The slew costs come from a slew time model (slewmodel.SlewModel) as one
+# vectorized cost matrix.  The visibility of every target (its window and
+# the altitude limits of the mount) is computed on a time grid, from which
+# the earliest possible start of every target after any time can be looked
+# up directly.  The order is built by a time-aware greedy pass, then
+# improved by 2-opt moves until no improvement is found or the time budget
+# runs out.
+#
+# Units: RA in hours, Dec and altitudes in degrees, times are Unix time
+# stamps, durations are in seconds.
+#
+#=============================================================================
+
+class Scheduler(object):
+
+#-----------------------------------------------------------------------------
+# Scheduler::__init__
+# Input:
+#	- site (astrometry.Site):
+#		Site location, needed for the altitude limits.
+#	- model (slewmodel.SlewModel):
+#		Slew time model.
+#	- speed (%f):
+#		Maximum slew rate [deg/s].
+#	- altlim (tuple):
+#		Minimum and maximum altitude [deg].
+#	- step (%f):
+#		Time resolution of the visibility grid [s].
+#	- skylimits (limits.Limits):
+#		Pointing limits model (with horizon mask). If given, $altlim is
+#		not used.
+#-----------------------------------------------------------------------------
+
+	def __init__(self, site, model=None, speed=4.0, altlim=(0.0, 90.0),
+			step=60.0, skylimits=None):
+		self.site = site
+		if model is None:
+			model = slewmodel.SlewModel()
+		self.model = model
+		self.speed = speed
+		if skylimits is None:
+			skylimits = limits.Limits(site, altlim)
+		self.limits = skylimits
+		self.step = step
+		return
+
+#-----------------------------------------------------------------------------
+# Scheduler::from_scope
+# Description:
+#	Create a scheduler with the site, slew model, slew speed and limits
+#	model of a Scope.
+#-----------------------------------------------------------------------------
+
+	@classmethod
+	def from_scope(cls, scope, step=60.0):
+		lim = scope.get_limits()
+		return cls(scope.get_site(), scope.slew_model, scope.slew_speed,
+			step=step, skylimits=lim)
+
+#-----------------------------------------------------------------------------
+# Scheduler::slew_matrix
+# Description:
+#	Matrix of slew durations [s] between all pairs of targets.
+#-----------------------------------------------------------------------------
+
+	def slew_matrix(self, ra, dec):
+		return self.model.predict_matrix(ra, dec, self.speed)
+
+#-----------------------------------------------------------------------------
+# Scheduler::earliest_start
+# Synopsis:
+#	earliest_start ra dec duration start end t0 nbin
+# Description:
+#	Compute, on a grid of $nbin bins of self.step seconds from $t0, the
+#	first bin from which every target can be observed for its whole
+#	duration (within its window and altitude limits).
+# Return:
+#	Integer array (ntarget, nbin+1); the value nbin means never.
+#-----------------------------------------------------------------------------
+
+	def earliest_start(self, ra, dec, duration, start, end, t0, nbin):
+		grid = t0 + self.step * numpy.arange(nbin + 1)
+		ok = self.limits.reachable(ra[:,None], dec[:,None], grid[None,:])
+		ok &= (grid[None,:] >= start[:,None] - self.step)
+		ok &= (grid[None,:] <= end[:,None])
+
+		# All bins from b to b+n must be visible: count the invisible bins.
+		n = numpy.ceil(duration / self.step).astype(int)
+		bad = numpy.cumsum(~ok, axis=1)
+		bad = numpy.hstack([numpy.zeros((len(ra), 1), dtype=bad.dtype), bad])
+		idx = numpy.arange(nbin + 1)
+		last = numpy.minimum(idx[None,:] + n[:,None], nbin)
+		rows = numpy.arange(len(ra))[:,None]
+		fits = bad[rows, last + 1] - bad[rows, idx[None,:]] == 0
+		fits &= grid[None,:] + duration[:,None] <= end[:,None] + self.step
+
+		# Next fitting bin at or after every bin (reverse running minimum).
+		first = numpy.where(fits, idx[None,:], nbin)
+		first = numpy.minimum.accumulate(first[:,::-1], axis=1)[:,::-1]
+		return first
+
+#-----------------------------------------------------------------------------
+# Scheduler::plan
+# Synopsis:
+#	plan ra dec duration start end t0 position budget
+# Input:
+#	- ra, dec (array):
+#		Target coordinates.
+#	- duration (array/%f):
+#		Time spent on each target [s].
+#	- start, end (array):
+#		Visibility windows [Unix time]. Default: no window.
+#	- t0 (%f):
+#		Start time of the sequence. Default: now
+#	- position (tuple):
+#		Current scope RA, Dec. Default: the first target.
+#	- budget (%f):
+#		Time budget of the optimization [s].
+# Return:
+#	Tuple of the target indices in observing order and their start times.
+#	Targets which can not be observed are left out.
+#-----------------------------------------------------------------------------
+
+	def plan(self, ra, dec, duration=0.0, start=None, end=None, t0=None,
+			position=None, budget=1.0):
+		deadline = time.time() + budget
+		ra = numpy.asarray(ra, dtype=float).ravel()
+		dec = numpy.asarray(dec, dtype=float).ravel()
+		n = len(ra)
+		if t0 is None:
+			t0 = time.time()
+		duration = numpy.zeros(n) + duration
+		start = numpy.zeros(n) + (-numpy.inf if start is None else start)
+		if end is None:
+			end = t0 + 12 * 3600.0
+		end = numpy.zeros(n) + end
+		if position is None:
+			position = (ra[0], dec[0])
+
+		horizon = min(end.max(), t0 + 48 * 3600.0) - t0
+		nbin = max(int(numpy.ceil(horizon / self.step)), 1)
+		first = self.earliest_start(ra, dec, duration, start, end, t0, nbin)
+
+		# Node n is the start position, node n+1 a free end point.
+		cost = numpy.zeros((n + 2, n + 2))
+		cost[:n+1,:n+1] = self.slew_matrix(numpy.append(ra, position[0]),
+			numpy.append(dec, position[1]))
+
+		self.t0 = t0
+		self.nbin = nbin
+		self.first = first
+		self.cost = cost
+		self.duration = duration
+		self.start = start
+		self.end = end
+
+		order = self.greedy(n)
+		order = self.improve(order, deadline)
+		times = self.evaluate(order)[1]
+		return numpy.array(order, dtype=int), numpy.array(times)
+
+#-----------------------------------------------------------------------------
+# Scheduler::begin
+# Description:
+#	Earliest start times of the targets $j when arriving at times $t.
+#	Returns inf for targets which can not be observed any more. For
+#	internal use.
+#-----------------------------------------------------------------------------
+
+	def begin(self, j, t):
+		b = ((t - self.t0) // self.step).astype(int)
+		numpy.clip(b, 0, self.nbin, out=b)
+		fb = self.first[j, b]
+		ret = numpy.maximum(t, self.t0 + self.step * fb)
+		numpy.maximum(ret, self.start[j], out=ret)
+		never = (fb >= self.nbin) | (ret + self.duration[j] > self.end[j])
+		ret[never] = numpy.inf
+		return ret
+
+#-----------------------------------------------------------------------------
+# Scheduler::greedy
+# Description:
+#	Time-aware nearest neighbour pass: always go to the target which can
+#	be started first. For internal use.
+#-----------------------------------------------------------------------------
+
+	def greedy(self, n):
+		cand = numpy.arange(n)
+		order = []
+		node = n
+		t = self.t0
+		while len(cand):
+			b = self.begin(cand, t + self.cost[node, cand])
+			k = numpy.argmin(b)
+			if not numpy.isfinite(b[k]):
+				break
+			node = cand[k]
+			order.append(int(node))
+			t = b[k] + self.duration[node]
+			cand = cand[numpy.isfinite(b)]
+			cand = cand[cand != node]
+		return order
+
+#-----------------------------------------------------------------------------
+# Scheduler::evaluate
+# Description:
+#	Start times of the targets in $order and the end time of the sequence
+#	(inf if any target can not be observed). For internal use.
+#-----------------------------------------------------------------------------
+
+	def evaluate(self, order):
+		n = self.cost.shape[0] - 2
+		cost = self.cost
+		first = self.first
+		t = self.t0
+		node = n
+		times = []
+		for j in order:
+			t += cost.item(node, j)
+			b = min(max(int((t - self.t0) // self.step), 0), self.nbin)
+			fb = first.item(j, b)
+			if fb >= self.nbin:
+				return numpy.inf, times
+			if fb != b:
+				t = max(t, self.t0 + self.step * fb)
+			t = max(t, self.start.item(j))
+			if t + self.duration.item(j) > self.end.item(j):
+				return numpy.inf, times
+			times.append(t)
+			t += self.duration.item(j)
+			node = j
+		return t, times
+
+#-----------------------------------------------------------------------------
+# Scheduler::improve
+# Description:
+#	2-opt improvement of $order.  The candidate reversals are ranked with
+#	the vectorized slew cost change, and accepted if the sequence stays
+#	feasible and finishes earlier. For internal use.
+#-----------------------------------------------------------------------------
+
+	def improve(self, order, deadline):
+		n = self.cost.shape[0] - 2
+		if len(order) < 3:
+			return order
+		best, times = self.evaluate(order)
+		improved = True
+		while improved and time.time() < deadline:
+			improved = False
+			tour = numpy.array([n] + list(order) + [n + 1])
+			a = tour[:-1]
+			b = tour[1:]
+			edge = self.cost[a, b]
+			moves = []
+			for i in range(len(a) - 2):
+				d = self.cost[a[i], a[i+2:]] + self.cost[b[i], b[i+2:]] - \
+					edge[i] - edge[i+2:]
+				j = numpy.argmin(d)
+				if d[j] < -1e-6:
+					moves.append((d[j], i, i + 2 + j))
+				if time.time() > deadline:
+					break
+			moves.sort()
+			used = []
+			for delta, i, j in moves:
+				if time.time() > deadline:
+					break
+				if [x for x in used if i <= x[1] and x[0] <= j]:
+					continue
+				new = order[:i] + order[i:j][::-1] + order[j:]
+				t, times = self.evaluate(new)
+				if t < best - 1e-6:
+					order = new
+					best = t
+					used.append((i, j))
+					improved = True
+		return order
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
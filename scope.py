@@ -2,8 +2,20 @@
 #=============================================================================
 
 import tcpdevice
+import coordinates
+import astrometry
+import estimator
+import slewmodel
+import motion
+import limits
+import guider
+import clocksync
+import pointing
+import ephemeris
 
 import time
+import math
+import threading
 import re
 from optparse import OptionParser
 
@@ -16,6 +28,42 @@ MOVE_STATUS_FAILED	=	0
 MOVE_STATUS_OK		=	1
 MOVE_STATUS_MOVING	=	2
 
+POSITION_QUERY = ('GR', 'GD', 'GZ', 'GA', 'GS')
+
+TRACKING_RATE_ON = 60.1
+
+SIDEREAL_SPEED = 15.0 / 3600
+
+#=============================================================================
+# ScopePosition
+#=============================================================================
+#
+# Class: ScopePosition
+#
+# Record of a scope position sample: RA, Dec, azimuth, altitude and sidereal
+# time as returned by the mount (hh:mm:ss/dd:mm:ss strings), time stamped
+# with the host time at the middle of the query and the round trip time.
+#
+#=============================================================================
+
+class ScopePosition(object):
+
+	__slots__ = ('time', 'rtt', 'ra', 'dec', 'az', 'alt', 'lst')
+
+	def __init__(self, time, rtt, ra, dec, az, alt, lst):
+		self.time = time
+		self.rtt = rtt
+		self.ra = ra
+		self.dec = dec
+		self.az = az
+		self.alt = alt
+		self.lst = lst
+		return
+
+	def __repr__(self):
+		return "ScopePosition(time=%.3f, ra=%s, dec=%s, az=%s, alt=%s, lst=%s)" % \
+			(self.time, self.ra, self.dec, self.az, self.alt, self.lst)
+
 #=============================================================================
 # Scope
 #=============================================================================
@@ -40,15 +88,25 @@ MOVE_STATUS_MOVING	=	2
 #	home(self, wait=True):
 #	park(self, wait=True):
 #	move_coo(self, coo1, coo2, sys='equ2', wait=True):
-#	get_coo(self, check_precision=True, coosys='equ2'):
+#	stage_target(self, coo1, coo2):
+#	go(self, wait=True):
+#	get_coo(self, check_precision=True, coosys='equ2', numeric=False):
+#	get_position(self, check_precision=True):
+#	get_lst(self, local=True):
+#	get_estimate(self, t=None):
+#	get_limits(self):
+#	load_horizon(self, filename):
+#	is_reachable(self, coo1, coo2, coosys='equ2', t=None):
 #	set_coo(self, ra, dec, coosys='equ2'):
 #	halt(self):
+#	guide(self, ra=0.0, dec=0.0):
 #	get_tracking(self):
 #	set_tracking(self, on):
 #	start_tracking(self):
 #	stop_tracking(self):
 #	get_tracking_rate(self):
 #	set_tracking_rate(self, rate):
+#	track_ephemeris(self, t, ra):
 #	off(self):
 #	on(self):
 #	get_alt_limit(self):
@@ -59,6 +117,7 @@ MOVE_STATUS_MOVING	=	2
 #	set_datetime(self, date, time, sys='local'):
 #	get_timezone(self):
 #	set_timezone(self, tz):
+#	sync_clock(self, threshold=1.0, utc_offset=None):
 #
 #=============================================================================
 
@@ -76,10 +135,41 @@ class Scope(tcpdevice.TCPDevice):
 		self.status = {}
 		self.status['home'] = 0
 		self.status['move'] = 0
+		self.position = None
+		self.estimator = estimator.PositionEstimator()
+		self.target = [None, None]
+		self.target_writes = 0
+		self.tracking = None
+		self.site = None
+		self.limits = None
+		self.check_limits = True
+		self.slew_speed = 4.0
+		self.move_speed = self.slew_speed
+		self.move_rate = None
+		self.low_precision = False
+		self.slew_model = slewmodel.SlewModel()
+		self.staged = None
+		self.poller = motion.Poller()
+		self.guider = guider.PulseGuider(self)
+		self.clock = clocksync.ClockSync(self)
+		self.pointing = pointing.PointingModel()
+		self.use_pointing = True
+		self.ephemeris = ephemeris.EphemerisTracker(self)
+
+		self.local_altaz = True
+		self.altaz_check = 600
+		self.altaz_check_time = 0
+		self.altaz_tolerance = 0.1
+		self.altaz_offset = None
 
 		self.timeout['default'] = 120
 		self.timeout['home'] = 240
 		self.timeout['move'] = 180
+		self.timeout['query'] = 2
+		self.timeout['clock'] = 10
+		self.timeout['position'] = 60
+
+		self.delimiter = '#'
 
 		return
 
@@ -91,7 +181,7 @@ class Scope(tcpdevice.TCPDevice):
 		ret = tcpdevice.TCPDevice.connect(self)
 		if not ret:
 			return False
-		self.get_coo(check_precision=True, coosys='altaz')
+		self.get_position(check_precision=True)
 		return True
 
 #-----------------------------------------------------------------------------
@@ -110,7 +200,8 @@ class Scope(tcpdevice.TCPDevice):
 #	then the functions waits until the homing is finished or failed or
 #	timeout occured.
 # Return:
-#	- True/False
+#	- True/False, or a motion.Motion handle (a Future) of the homing if
+#	  $wait=False.
 #-----------------------------------------------------------------------------
 
 	def home(self, wait=True):
@@ -120,7 +211,14 @@ class Scope(tcpdevice.TCPDevice):
 			return False
 
 		if not wait:
-			return True
+
+			def check(status):
+				if status == HOME_STATUS_SEARCH:
+					return None
+				return (status == HOME_STATUS_OK,)
+
+			return self.poller.add(self.get_home_status, check, self.halt,
+				self.get_timeout('home'), delay=0.2)
 
 		timeout = self.get_timeout('home');
 		ret = tcpdevice.waitfor(self.get_home_status, '!=', HOME_STATUS_SEARCH,
@@ -165,37 +263,330 @@ class Scope(tcpdevice.TCPDevice):
 #		Wait flag. Default: True
 # Description:
 #	Move the telescope to the target coordinate. Wait until the scope
-#	reaches the coordinate (or fails) if $wait = True.
+#	reaches the coordinate (or fails) if $wait = True.  The waiting is
+#	driven by the slew time model (self.slew_model): the status is polled
+#	densely only around the predicted arrival, and the timeout is derived
+#	from the prediction.  Every completed slew is recorded to refine the
+#	model.  If self.check_limits is True, targets outside the local
+#	limits model (see get_limits()) are rejected before any command is
+#	sent.  If self.use_pointing is True, the target is converted to mount
+#	coordinates with the pointing model fitted from the syncs (see
+#	set_coo()) before it is uploaded.
 # Return:
-#	True/False
+#	True/False, or a motion.Motion handle (a Future) of the slew if
+#	$wait=False.
 # Note:
 #	Only the Equatorial II coordinate system is fully implemented.
 #-----------------------------------------------------------------------------
 
 	def move_coo(self, coo1, coo2, sys='equ2', wait=True):
-		coo1 = self.float2dms(coo1)
-		coo2 = self.float2dms(coo2)
+		if self.check_limits and not self.is_reachable(coo1, coo2, sys):
+			return False
+
+		start = None
+		if sys == 'equ2':
+			coo1, coo2 = self.to_mount(coo1, coo2)
+			if wait:
+				start = self.get_slew_start()
+			else:
+				start = self.get_estimate()
+
 		self.set_target_ra(coo1)
 		self.set_target_dec(coo2)
+		return self.slew(sys, start, wait)
+
+#-----------------------------------------------------------------------------
+# Scope::stage_target
+# Synopsis:
+#	stage_target coo1 coo2
+# Input:
+#	- coo1 (%hms)
+#		Target RA in hh:mm:ss.s format (or decimal hours).
+#	- coo2 (%dms)
+#		Target Dec in dd:mm:ss.s format (or decimal degrees).
+# Description:
+#	Upload the next target in a background thread, e.g. while the current
+#	exposure is running: the Sr and Sd commands are sent and the stored
+#	target is read back with Gr/Gd and compared, all under the device
+#	lock.  The slew is started later by go(), which then sends only the
+#	MS command.  A new call replaces the previously staged target.  The
+#	staged coordinates are kept apart from self.target; if the target
+#	registers are written in the meantime (set_coo, move_coo, set_target_*),
+#	go() checks them again before the slew.  A target below the limits
+#	(if self.check_limits is set) is rejected, and the previously staged
+#	target is dropped.
+# Return:
+#	The staging thread, or False if the target is not reachable.
+#-----------------------------------------------------------------------------
+
+	def stage_target(self, coo1, coo2):
+		if self.staged is not None:
+			self.staged['thread'].join()
+		if self.check_limits and not self.is_reachable(coo1, coo2):
+			self.staged = None
+			return False
+		coo1, coo2 = self.to_mount(coo1, coo2)
+		staged = {'coo': (coo1, coo2), 'ok': None}
+		thread = threading.Thread(target=self.upload_target, args=(staged,))
+		thread.daemon = True
+		staged['thread'] = thread
+		self.staged = staged
+		thread.start()
+		return thread
+
+#-----------------------------------------------------------------------------
+# Scope::upload_target
+# Description:
+#	Send the staged target coordinates and verify them, and take the start
+#	position of the slew (see get_slew_start()), so that go() can send MS
+#	at once. Runs in the staging thread. For internal use.
+#-----------------------------------------------------------------------------
+
+	def upload_target(self, staged):
+		coo1, coo2 = staged['coo']
+		ra = self.format_coo(coo1, 'h')
+		dec = self.format_coo(coo2, 'd')
+		target = tuple(coordinates.parse_sexagesimal([ra, dec]))
+		ok = False
+		with self.lock:
+			for i in range(2):
+				self.command_read('Sr%s' % (ra,))
+				self.command_read('Sd%s' % (dec,))
+				ok = self.verify_target(target)
+				if ok:
+					break
+			staged['writes'] = self.target_writes
+		staged['target'] = target
+		if 'start' not in staged:
+			staged['start'] = self.get_slew_start()
+		staged['ok'] = ok
+		return
+
+#-----------------------------------------------------------------------------
+# Scope::verify_target
+# Description:
+#	Read back the target coordinates stored in the mount (Gr, Gd in one
+#	burst) and compare them with $target (default: self.target).
+# Return:
+#	True/False
+#-----------------------------------------------------------------------------
+
+	def verify_target(self, target=None):
+		if target is None:
+			target = self.target
+		if None in target:
+			return False
+		ra, dec = coordinates.parse_sexagesimal(self.query_coo(('Gr', 'Gd')))
+		if math.isnan(ra) or math.isnan(dec):
+			return False
+		dra = (ra - target[0] + 12.0) % 24.0 - 12.0
+		return abs(dra) * 3600.0 < 1.5 and abs(dec - target[1]) * 3600.0 < 1.5
+
+#-----------------------------------------------------------------------------
+# Scope::go
+# Synopsis:
+#	go wait
+# Description:
+#	Start the slew to the target staged by stage_target().  If the upload
+#	is still running, wait for it first.  Only the MS command is sent, the
+#	waiting works as in move_coo().  The start position of the slew was
+#	taken at staging, so nothing is queried before MS.  If the target
+#	registers were written since the upload, they are read back (Gr/Gd)
+#	and the staged target is uploaded again if needed, and the start is
+#	taken from the estimator.  The check and MS are sent under the device
+#	lock, so no other thread can change the target in between.
+# Return:
+#	True/False (or a motion.Motion handle if $wait=False). False also if
+#	nothing was staged or the upload could not be verified.
+#-----------------------------------------------------------------------------
+
+	def go(self, wait=True):
+		staged = self.staged
+		if staged is None:
+			return False
+		staged['thread'].join()
+		self.staged = None
+		if not staged['ok']:
+			return False
+
+		start = staged['start']
+		with self.lock:
+			if self.target_writes != staged['writes']:
+				start = self.get_estimate()
+				if not self.verify_target(staged['target']):
+					self.upload_target(staged)
+					if not staged['ok']:
+						return False
+			self.target = list(staged['target'])
+			t0 = time.time()
+			ret = self.move_target('equ2')
+		if not ret:
+			return False
+		return self.follow_slew(t0, start, wait)
+
+#-----------------------------------------------------------------------------
+# Scope::to_mount
+# Description:
+#	Convert the true RA, Dec of a target to mount coordinates with the
+#	pointing model (see set_coo()). The input is returned unchanged if
+#	there is no model or self.use_pointing is False.
+#-----------------------------------------------------------------------------
+
+	def to_mount(self, coo1, coo2):
+		if not self.use_pointing or not len(self.pointing.terms):
+			return coo1, coo2
+		site = self.get_site()
+		if site is None:
+			return coo1, coo2
+		ra = coordinates.parse_sexagesimal(coo1)
+		dec = coordinates.parse_sexagesimal(coo2)
+		ra, dec = self.pointing.apply(ra, dec, site.lst())
+		return float(ra), float(dec)
+
+#-----------------------------------------------------------------------------
+# Scope::get_slew_start
+# Description:
+#	Estimated current position as the start point of a slew.  The
+#	position is queried from the mount (one get_position burst) if there is
+#	no estimate, or its uncertainty is above $threshold degrees (e.g.
+#	after a slew). For internal use.
+# Return:
+#	The estimate (ra, dec, sigma), or None if the start is not known
+#	within $threshold.
+#-----------------------------------------------------------------------------
+
+	def get_slew_start(self, threshold=1.0):
+		start = self.get_estimate()
+		if start is None or start[2] >= threshold:
+			self.get_position(check_precision=False)
+			start = self.get_estimate()
+		if start is None or start[2] >= threshold:
+			return None
+		return start
+
+#-----------------------------------------------------------------------------
+# Scope::slew
+# Synopsis:
+#	slew sys start wait
+# Description:
+#	Start the slew to the already uploaded target and, if $wait=True, wait
+#	for its end, driven by the slew time model.  $start is the estimated
+#	start position (see get_slew_start()) or None.  The duration of every
+#	finished slew with a known start is recorded to train the model. For
+#	internal use.
+# Return:
+#	True/False, or a motion.Motion handle if $wait=False.
+#-----------------------------------------------------------------------------
+
+	def slew(self, sys, start, wait):
+		t0 = time.time()
 		ret = self.move_target(sys)
 		if not ret:
 			return False
+		return self.follow_slew(t0, start, wait)
+
+#-----------------------------------------------------------------------------
+# Scope::follow_slew
+# Description:
+#	Wait for (or track) the slew started at $t0 from $start, see slew().
+#	For internal use.
+#-----------------------------------------------------------------------------
+
+	def follow_slew(self, t0, start, wait):
+		known = start is not None and None not in self.target
+		predicted = None
+		if known:
+			predicted = float(self.slew_model.predict(start[0], start[1],
+				self.target[0], self.target[1], self.slew_speed))
 		
 		if not wait:
-			return True
-			
-		timeout = self.get_timeout('move_coo');
-		ret = tcpdevice.waitfor(self.get_move_status, '!=', MOVE_STATUS_MOVING,
-			timeout)
-		if not ret:
+			return self.track_move(t0, predicted)
+
+		ret, duration = self.wait_move(t0, predicted)
+		if ret is None:
 			return False
 
-		ret = self.get_move_status()
 		if ret == MOVE_STATUS_OK:
+			if known and duration is not None:
+				self.slew_model.record(start[0], start[1], self.target[0],
+					self.target[1], self.slew_speed, duration)
 			return True
 		
 		return False
 
+#-----------------------------------------------------------------------------
+# Scope::track_move
+# Synopsis:
+#	track_move start predicted
+# Description:
+#	Return a motion.Motion handle of the current slew, started at $start.
+#	As in wait_move(), polling begins shortly before the predicted arrival
+#	and the timeout is derived from the prediction. Cancel halts the scope.
+#-----------------------------------------------------------------------------
+
+	def track_move(self, start, predicted=None):
+		timeout = self.get_timeout('move')
+		delay = 0.2
+		if predicted is not None:
+			timeout = min(timeout, self.slew_model.timeout(predicted))
+			delay = max(predicted - self.slew_model.lead(predicted), delay)
+
+		def check(status):
+			if status == MOVE_STATUS_MOVING:
+				return None
+			return (status == MOVE_STATUS_OK,)
+
+		return self.poller.add(self.get_move_status, check, self.halt,
+			timeout - (time.time() - start), delay - (time.time() - start))
+
+#-----------------------------------------------------------------------------
+# Scope::wait_move
+# Synopsis:
+#	wait_move start predicted
+# Input:
+#	- start (%f):
+#		Start time of the slew [Unix time].
+#	- predicted (%f):
+#		Predicted duration of the slew [s], or None if unknown.
+# Description:
+#	Wait until the current slew finishes.  With a prediction, poll sparsely
+#	(four polls) until shortly before the predicted arrival and densely
+#	from there, with a timeout derived from the prediction; otherwise poll
+#	all along with the 'move' timeout.
+# Return:
+#	Tuple of the final move status (None on timeout) and the observed
+#	slew duration.  If the slew ended before a sparse poll, the duration
+#	is an upper bound (the time of that poll).  It is still recorded: it
+#	pulls an over-estimating model down until the dense polls bracket the
+#	arrival again.
+#-----------------------------------------------------------------------------
+
+	def wait_move(self, start, predicted=None):
+		timeout = self.get_timeout('move')
+		init = 0.2
+		poll = 0.2
+		if predicted is not None:
+			timeout = min(timeout, self.slew_model.timeout(predicted))
+			init = max(predicted - self.slew_model.lead(predicted), init)
+			poll = 0.1
+
+		end = start + timeout
+		sparse = max(init / 4.0, poll)
+		t = start + min(sparse, init)
+		while True:
+			time.sleep(max(t - time.time(), 0.0))
+			now = time.time()
+			if now >= end:
+				return None, None
+			ret = self.get_move_status()
+			if ret != MOVE_STATUS_MOVING:
+				return ret, time.time() - start
+			now = time.time()
+			if now < start + init:
+				t = min(now + sparse, start + init)
+			else:
+				t = now + poll
+
 #-----------------------------------------------------------------------------
 # Scope::get_coo
 # Synopsis:
@@ -206,30 +597,253 @@ class Scope(tcpdevice.TCPDevice):
 #		precision.
 #	- coosys (equ1|equ2|altaz)
 #		Coordinate system.
+#	- numeric (0|1):
+#		If True, return decimal hours/degrees instead of strings.
 # Description:
-#	Query the current scope coordinates.
+#	Query the current scope coordinates.  If self.local_altaz is True, then
+#	the horizontal coordinates are computed locally from RA, Dec and the
+#	site location (see get_local_altaz).
 # Return:
 #	Tuple of containing coo2 and coo2 in hh:mm.ss or dd:mm:ss format.
 #-----------------------------------------------------------------------------
 
-	def get_coo(self, check_precision=True, coosys='equ2'):
+	def get_coo(self, check_precision=True, coosys='equ2', numeric=False):
+		if coosys == 'altaz' and self.local_altaz:
+			ret = self.get_local_altaz()
+			if ret is not None:
+				if numeric:
+					return ret
+				return (coordinates.format_sexagesimal(ret[0], coordinates.FORMAT_DEG),
+					coordinates.format_sexagesimal(ret[1], coordinates.FORMAT_ALT))
+
 		if coosys == 'altaz':
-			get_coo1 = self.get_az
-			get_coo2 = self.get_alt
+			cmds = ['GZ', 'GA']
 		else:
-			get_coo1 = self.get_ra
-			get_coo2 = self.get_dec
+			cmds = ['GR', 'GD']
 
-		coo1 = get_coo1()
-		coo2 = get_coo2()
+		coo1, coo2 = self.query_coo(cmds)
 
-		if check_precision and coo1 == '00:00:00' and coo2 == '00:00:00':
+		if check_precision and (self.low_precision or
+				(coo1 == '00:00:00' and coo2 == '00:00:00')):
 			self.toggle_precision()
-			coo1 = get_coo1()
-			coo2 = get_coo2()
+			coo1, coo2 = self.query_coo(cmds)
+
+		if coosys != 'altaz':
+			self.set_radec(coo1, coo2)
 
+		if numeric:
+			return tuple(coordinates.parse_sexagesimal([coo1, coo2]))
 		return coo1, coo2
 
+#-----------------------------------------------------------------------------
+# Scope::get_position
+# Synopsis:
+#	get_position check_precision
+# Input:
+#	- check_precision (0|1):
+#		If True, than check if the coordinate display is set to high
+#		precision.
+# Description:
+#	Query RA, Dec, azimuth, altitude and sidereal time in one pipelined
+#	burst.  The result is also stored in self.position.
+# Return:
+#	ScopePosition record, or None if the query failed.
+#-----------------------------------------------------------------------------
+
+	def get_position(self, check_precision=True):
+		pos = self.query_position()
+		if pos is None:
+			return None
+
+		if check_precision and (self.low_precision or
+				(pos.ra == '00:00:00' and pos.dec == '00:00:00')):
+			self.toggle_precision()
+			pos = self.query_position()
+			if pos is None:
+				return None
+
+		self.position = pos
+		self.set_radec(pos.ra, pos.dec, pos.time)
+		return pos
+
+#-----------------------------------------------------------------------------
+# Scope::get_local_altaz
+# Synopsis:
+#	get_local_altaz t
+# Description:
+#	Compute the current azimuth and altitude from RA, Dec and the site
+#	location without querying GZ/GA.  If the tracking state is known, the
+#	RA and Dec are taken from the position estimator as long as its last
+#	sample is not older than the 'position' timeout and its uncertainty is
+#	within self.altaz_tolerance, so no query is needed at all.  Every
+#	self.altaz_check seconds the result is cross-checked against the mount;
+#	if they differ by more than self.altaz_tolerance degrees, None is
+#	returned so that the caller falls back to the mount values.
+# Return:
+#	Tuple of azimuth and altitude [deg], or None.
+#-----------------------------------------------------------------------------
+
+	def get_local_altaz(self, t=None):
+		site = self.get_site()
+		if site is None:
+			return None
+
+		if t is None:
+			t = time.time()
+		check = self.altaz_check and t - self.altaz_check_time > self.altaz_check
+		if not check and self.altaz_offset is not None:
+			daz, dalt = self.altaz_offset
+			if not max(abs(daz), abs(dalt)) <= self.altaz_tolerance:
+				return None
+
+		est = self.estimator.estimate(t)
+		anchor = self.estimator.anchor
+		if est is None or self.tracking is None or \
+				t - anchor[0] > self.get_timeout('position') or \
+				est[2] > self.altaz_tolerance:
+			self.get_coo(check_precision=False, numeric=True)
+			est = self.estimator.estimate(t)
+		if est is None:
+			return None
+
+		az, alt = site.altaz(est[0], est[1], t)
+		az, alt = float(az), float(alt)
+
+		if check:
+			self.altaz_check_time = t
+			maz, malt = coordinates.parse_sexagesimal(self.query_coo(['GZ', 'GA']))
+			daz = (maz - az + 180.0) % 360.0 - 180.0
+			self.altaz_offset = (daz * math.cos(math.radians(alt)), malt - alt)
+			if not max(abs(x) for x in self.altaz_offset) <= self.altaz_tolerance:
+				return None
+
+		return az, alt
+
+#-----------------------------------------------------------------------------
+# Scope::get_estimate
+# Synopsis:
+#	get_estimate t
+# Description:
+#	Estimate the scope position at time $t (default: now) without querying
+#	the mount.  The estimator is fed by every RA/Dec query (get_coo,
+#	get_position) and by the tracking and motion commands; see
+#	estimator.PositionEstimator.
+# Return:
+#	Tuple of RA [h], Dec [deg] and uncertainty [deg], or None if there is
+#	no position sample yet.
+#-----------------------------------------------------------------------------
+
+	def get_estimate(self, t=None):
+		return self.estimator.estimate(t)
+
+#-----------------------------------------------------------------------------
+# Scope::get_lst
+# Synopsis:
+#	get_lst local
+# Description:
+#	Return the local sidereal time.  If $local is True, then it is computed
+#	from the host clock and the site longitude, otherwise it is queried
+#	from the mount.
+# Return:
+#	Sidereal time (hh:mm:ss)
+#-----------------------------------------------------------------------------
+
+	def get_lst(self, local=True):
+		site = None
+		if local:
+			site = self.get_site()
+		if site is None:
+			return self.get_sidereal_time()
+		return coordinates.format_hms(site.lst())
+
+#-----------------------------------------------------------------------------
+# Scope::get_site
+# Description:
+#	Return the site location (astrometry.Site). It is queried from the
+#	mount only once.
+#-----------------------------------------------------------------------------
+
+	def get_site(self):
+		if self.site is None:
+			long, lat = self.get_geocoo()
+			if long == '00:00:00' and lat == '00:00:00':
+				return None
+			self.site = astrometry.Site.from_meade(long, lat)
+		return self.site
+
+#-----------------------------------------------------------------------------
+# Scope::get_limits
+# Description:
+#	Return the local limits model (limits.Limits) of the mount.  It is
+#	seeded from the altitude limits and the site queried from the mount
+#	only once, and kept up to date by set_alt_limit() and set_geocoo().
+#	A horizon mask can be added with load_horizon().
+#-----------------------------------------------------------------------------
+
+	def get_limits(self):
+		if self.limits is None:
+			low, high = self.get_alt_limit()
+			self.limits = limits.Limits.from_meade(None, low, high)
+		if self.limits.site is None:
+			self.limits.site = self.get_site()
+			if self.limits.site is None:
+				return None
+		return self.limits
+
+#-----------------------------------------------------------------------------
+# Scope::load_horizon
+# Description:
+#	Load the azimuth dependent horizon mask of the limits model from
+#	$filename (azimuth, minimum altitude columns).
+#-----------------------------------------------------------------------------
+
+	def load_horizon(self, filename):
+		lim = self.get_limits()
+		if lim is None:
+			return False
+		lim.load_mask(filename)
+		return True
+
+#-----------------------------------------------------------------------------
+# Scope::is_reachable
+# Synopsis:
+#	is_reachable coo1 coo2 sys t
+# Description:
+#	Check the target against the local limits model at $t (default: now)
+#	without querying the mount.  The coordinates are interpreted as in
+#	move_coo(); arrays of decimal values are accepted too.
+# Return:
+#	Boolean (array). True if the limits are not known.
+#-----------------------------------------------------------------------------
+
+	def is_reachable(self, coo1, coo2, sys='equ2', t=None):
+		lim = self.get_limits()
+		if lim is None:
+			return True
+		coo1 = coordinates.parse_sexagesimal(coo1)
+		coo2 = coordinates.parse_sexagesimal(coo2)
+		if sys == 'altaz':
+			return lim.allowed(coo1, coo2)
+		if sys == 'equ1':
+			coo1 = lim.site.lst(t) - coo1
+		return lim.reachable(coo1, coo2, t)
+
+#-----------------------------------------------------------------------------
+# Scope::set_radec
+# Description:
+#	Feed a queried RA and Dec with its time stamp to the position
+#	estimator. For internal use.
+#-----------------------------------------------------------------------------
+
+	def set_radec(self, ra, dec, t=None):
+		if t is None:
+			t = time.time()
+		ra, dec = coordinates.parse_sexagesimal([ra, dec])
+		self.estimator.add_sample(t, ra, dec)
+		return
+
+#-----------------------------------------------------------------------------
+
 #-----------------------------------------------------------------------------
 # Scope::set_coo
 # Synopsis:
@@ -242,12 +856,13 @@ class Scope(tcpdevice.TCPDevice):
 #	- sys (equ1|equ2|altaz):
 #		Coordinate system. Default: equ2
 # Description:
-#	Overwrites the current coordinates with $coo1 and $coo2.
+#	Overwrites the current coordinates with $coo1 and $coo2, e.g. with the
+#	solved position of an image.  The position reported by the mount
+#	before the sync and the true position are logged as a sync pair of
+#	the pointing model (self.pointing), which is refitted.
 #-----------------------------------------------------------------------------
 
 	def set_coo(self, coo1, coo2, coosys='equ2'):
-		coo1 = self.float2dms(coo1)
-		coo2 = self.float2dms(coo2)
 		self.set_target_ra(coo1)
 		self.set_target_dec(coo2)
 		self.sync_target()
@@ -280,9 +895,13 @@ class Scope(tcpdevice.TCPDevice):
 
 	def get_tracking(self):
 		mount, tracking, alignment = self.get_alignment_status()
-		if tracking == 'T':
-			return True
-		return False
+		if tracking is None:
+			return False
+		if self.tracking != (tracking == 'T'):
+			self.tracking = tracking == 'T'
+			rate = TRACKING_RATE_ON if self.tracking else 0.0
+			self.estimator.set_tracking_rate(rate)
+		return self.tracking
 
 #-----------------------------------------------------------------------------
 # Scope::set_tracking
@@ -299,9 +918,11 @@ class Scope(tcpdevice.TCPDevice):
 		if ison == on:
 			return
 		if on:
-			rcv = self.command_read('ST60.1')
+			rcv = self.command_read('ST%.1f' % TRACKING_RATE_ON)
 		else:
 			rcv = self.command_read('ST0.0')
+		self.tracking = bool(on)
+		self.estimator.set_tracking_rate(TRACKING_RATE_ON if on else 0.0)
 		return rcv
 
 #-----------------------------------------------------------------------------
@@ -331,7 +952,14 @@ class Scope(tcpdevice.TCPDevice):
 #-----------------------------------------------------------------------------
 
 	def get_tracking_rate(self):
-		return self.command_read('GT')
+		rcv = self.command_read('GT')
+		try:
+			rate = float(rcv)
+		except:
+			return rcv
+		if rate != self.estimator.rate:
+			self.estimator.set_tracking_rate(rate)
+		return rcv
 
 #-----------------------------------------------------------------------------
 # Scope::set_tracking_rate
@@ -343,8 +971,33 @@ class Scope(tcpdevice.TCPDevice):
 
 	def set_tracking_rate(self, rate):
 		cmd = 'ST%s' % rate 
+		self.tracking = float(rate) > 0
+		self.estimator.set_tracking_rate(rate)
 		return self.command_read(cmd)
 
+#-----------------------------------------------------------------------------
+# Scope::track_ephemeris
+# Synopsis:
+#	track_ephemeris t ra
+# Input:
+#	- t (array):
+#		Ephemeris times [Unix time].
+#	- ra (array):
+#		RA of the object [hour].
+# Description:
+#	Follow a non-sidereal object by updating the tracking rate from its
+#	ephemeris in the background (see ephemeris.EphemerisTracker).  Only the
+#	RA motion is followed.  An empty ephemeris stops the updates.
+# Return:
+#	Number of scheduled rate updates.
+#-----------------------------------------------------------------------------
+
+	def track_ephemeris(self, t, ra):
+		if not len(t):
+			self.ephemeris.stop()
+			return 0
+		return self.ephemeris.start(t, ra)
+
 #-----------------------------------------------------------------------------
 # Scope::set_tracking_rate
 #-----------------------------------------------------------------------------
@@ -414,6 +1067,8 @@ class Scope(tcpdevice.TCPDevice):
 	def set_alt_limit(self, min, max):
 		self.set_low_limit(min)
 		self.set_high_limit(max)
+		if self.limits is not None:
+			self.limits.set_altlim(min, max)
 		return self.get_alt_limit()
 
 #-----------------------------------------------------------------------------
@@ -451,6 +1106,9 @@ class Scope(tcpdevice.TCPDevice):
 	def set_geocoo(self, long, lat):
 		self.set_longitude(long)
 		self.set_latitude(lat)
+		self.site = None
+		if self.limits is not None:
+			self.limits.site = None
 		return self.get_geocoo()
 
 #-----------------------------------------------------------------------------
@@ -471,7 +1129,7 @@ class Scope(tcpdevice.TCPDevice):
 
 	def get_datetime(self, sys='local'):
 		date = self.get_local_date()
-		time = sefl.get_local_time()
+		time = self.get_local_time()
 		return date, time
 
 #-----------------------------------------------------------------------------
@@ -520,6 +1178,29 @@ class Scope(tcpdevice.TCPDevice):
 		self.set_utc_offset(tz)
 		return self.get_utc_offset()
 
+#-----------------------------------------------------------------------------
+# Scope::sync_clock
+# Synopsis:
+#	Scope::sync_clock threshold utc_offset
+# Input:
+#	- threshold (%f):
+#		Maximum accepted clock offset [s].
+#	- utc_offset (%f):
+#		If given, also set the UTC offset [hour] (hours to add to the
+#		local time to get UTC).
+# Description:
+#	Measure the offset of the telescope clock from the host clock and set
+#	the telescope clock only if the offset exceeds $threshold (see
+#	clocksync.ClockSync).  self.clock.next_check() tells, from the
+#	measured drift rate, when the next check is due.
+# Return:
+#	Clock offset (telescope - host) before the synchronization [s], or
+#	None if it could not be measured.
+#-----------------------------------------------------------------------------
+
+	def sync_clock(self, threshold=1.0, utc_offset=None):
+		return self.clock.sync(threshold, utc_offset)
+
 #-----------------------------------------------------------------------------
 
 #=============================================================================
@@ -582,7 +1263,7 @@ class Scope(tcpdevice.TCPDevice):
 #-----------------------------------------------------------------------------
 
 	def set_latitude(self, lat):
-		cmd = "St%s*%s*%s" % tuple(long.split(':'))
+		cmd = "St%s*%s*%s" % tuple(lat.split(':'))
 		rcv = self.command_read(cmd) 
 		return rcv
 
@@ -629,7 +1310,8 @@ class Scope(tcpdevice.TCPDevice):
 		y, m, d = date.split('-')
 		y = y[-2:]
 		cmd = "SC%s/%s/%s" % (m, d, y)
-		return
+		rcv = self.command_read(cmd)
+		return rcv
 
 #-----------------------------------------------------------------------------
 # Scope::set_local_time
@@ -643,9 +1325,10 @@ class Scope(tcpdevice.TCPDevice):
 #-----------------------------------------------------------------------------
 
 	def set_local_time(self, time):
-		h, m, s = date.split(':')
+		h, m, s = time.split(':')
 		cmd = "SL%s:%s:%s" % (h, m, s)
-		return
+		rcv = self.command_read(cmd)
+		return rcv
 
 #-----------------------------------------------------------------------------
 # Scope::get_sidereal_time
@@ -656,10 +1339,10 @@ class Scope(tcpdevice.TCPDevice):
 #-----------------------------------------------------------------------------
 
 	def get_sidereal_time(self):
-		rcv = self.command.read('GS')
+		rcv = self.command_read('GS')
 		h, m, s = self.parse_time(rcv)
 		time = "%s:%s:%s" % (h, m, s)
-		return rcv
+		return time
 
 #-----------------------------------------------------------------------------
 # Scope::get_utc_offset
@@ -708,6 +1391,37 @@ class Scope(tcpdevice.TCPDevice):
 # Telescope coordinates
 #=============================================================================
 
+#-----------------------------------------------------------------------------
+# Scope::query_coo
+# Description:
+#	Send the coordinate query commands $cmds in one burst and return the
+#	replies in dd:mm:ss format.  self.low_precision is set if any reply is
+#	in a low precision format (see Scope::toggle_precision).
+#-----------------------------------------------------------------------------
+
+	def query_coo(self, cmds):
+		rcv = self.command_pipeline(cmds, self.get_timeout('query'))
+		if not rcv:
+			rcv = []
+		rcv = rcv + [None] * (len(cmds) - len(rcv))
+		self.low_precision = any([coordinates.is_low_precision(x) for x in rcv])
+		return tuple(["%s:%s:%s" % self.parse_coo(x) for x in rcv])
+
+#-----------------------------------------------------------------------------
+# Scope::query_position
+# Description:
+#	Query all position values in one burst and return a ScopePosition
+#	record time stamped to the middle of the round trip.
+#-----------------------------------------------------------------------------
+
+	def query_position(self):
+		t0 = time.time()
+		coo = self.query_coo(POSITION_QUERY)
+		t1 = time.time()
+		if not self.is_connected():
+			return None
+		return ScopePosition(0.5*(t0+t1), t1-t0, *coo)
+
 #-----------------------------------------------------------------------------
 # Scope::get_ra
 # Description:
@@ -806,6 +1520,8 @@ class Scope(tcpdevice.TCPDevice):
 
 	def set_target_ra(self, ra):
 		ra = self.format_coo(ra, 'h')
+		self.target[0] = coordinates.parse_sexagesimal(ra)
+		self.target_writes += 1
 		cmd = "Sr%s" % (ra,)
 		rcv = self.command_read(cmd)
 		return rcv 
@@ -816,6 +1532,8 @@ class Scope(tcpdevice.TCPDevice):
 
 	def set_target_dec(self, dec):
 		dec = self.format_coo(dec, 'd')
+		self.target[1] = coordinates.parse_sexagesimal(dec)
+		self.target_writes += 1
 		cmd = "Sd%s" % (dec,)
 		rcv = self.command_read(cmd)
 		return rcv 
@@ -833,8 +1551,9 @@ class Scope(tcpdevice.TCPDevice):
 #-----------------------------------------------------------------------------
 
 	def set_target_az(self, az):
-		alt = self.format_coo(az)
-		cmd = "Sz%s" % (az)
+		az = self.format_coo(az, 'a')
+		self.target_writes += 1
+		cmd = "Sz%s" % (az,)
 		rcv = self.command_read(cmd)
 		return rcv 
 
@@ -844,6 +1563,7 @@ class Scope(tcpdevice.TCPDevice):
 
 	def set_target_alt(self, alt):
 		alt = self.format_coo(alt)
+		self.target_writes += 1
 		cmd = "Sa%s" % (alt,)
 		rcv = self.command_read(cmd)
 		return rcv 
@@ -871,10 +1591,32 @@ class Scope(tcpdevice.TCPDevice):
 #-----------------------------------------------------------------------------
 
 	def sync_target(self):
+		self.log_sync()
 		rcv = self.command_read('CM')
+		self.estimator.reset()
+		if None not in self.target:
+			self.estimator.add_sample(time.time(), *self.target)
 		return rcv
 
 #-----------------------------------------------------------------------------
+# Scope::log_sync
+# Description:
+#	Query the mount position and log it with the target coordinates as a
+#	sync pair of the pointing model. For internal use.
+#-----------------------------------------------------------------------------
+
+	def log_sync(self):
+		site = self.get_site()
+		if site is None or None in self.target:
+			return False
+		ra, dec = self.get_coo(check_precision=False, numeric=True)
+		t = time.time()
+		az, alt = site.altaz(self.target[0], self.target[1], t)
+		self.pointing.latitude = site.latitude
+		return self.pointing.add_sync(t, site.lst(t), ra, dec,
+			self.target[0], self.target[1], az, alt)
+
+#-----------------------------------------------------------------------------
 
 
 #=============================================================================
@@ -885,7 +1627,8 @@ class Scope(tcpdevice.TCPDevice):
 # Scope::move_target
 # Descirption:
 #	Move the scope to the target coordinates. (Target coordinates are to be
-#	set with 'set_target' functions).
+#	set with 'set_target' functions).  The slew is passed to the position
+#	estimator only if the mount accepted it.
 #-----------------------------------------------------------------------------
 
 	def move_target(self, sys='equ2'):
@@ -897,15 +1640,20 @@ class Scope(tcpdevice.TCPDevice):
 		else:
 			cmd = 'MS'
 
+		t0 = time.time()
 		try:
 			rcv = self.command_read(cmd, sleep=0.6)
+			if int(rcv[0]) != 0:
+				return False
 		except:
 			return False
 
-		if int(rcv[0]) == 0:
-			return True
-
-		return False
+		if sys == 'equ2' and None not in self.target:
+			self.estimator.start_slew(self.target[0], self.target[1],
+				self.slew_speed, t0)
+		else:
+			self.estimator.reset()
+		return True
 
 #-----------------------------------------------------------------------------
 # Scope::move_dir
@@ -922,6 +1670,7 @@ class Scope(tcpdevice.TCPDevice):
 			cmd = "M%s" % (dir,)
 		else:
 			return
+		self.estimator.start_move(dir, self.move_speed)
 		rcv = self.command_read(cmd)
 		return rcv
 
@@ -943,9 +1692,28 @@ class Scope(tcpdevice.TCPDevice):
 			cmd = "Q%s" % (dir,)
 		else:
 			return
+		self.estimator.stop(dir)
 		rcv = self.command_read(cmd)
 		return rcv
 
+#-----------------------------------------------------------------------------
+# Scope::guide
+# Synopsis:
+#	guide ra dec
+# Input:
+#	- ra, dec (%f):
+#		Guiding correction [arcsec], positive to the east/north.
+# Description:
+#	Apply a guiding correction with timed pulses at the current move rate
+#	(see guider.PulseGuider). Unlike move_dir()/stop_move(), the pulses
+#	are not limited by the command reply sleeps.
+# Return:
+#	List of (dir, requested, achieved) pulse reports.
+#-----------------------------------------------------------------------------
+
+	def guide(self, ra=0.0, dec=0.0):
+		return self.guider.guide([(ra, dec)])
+
 #-----------------------------------------------------------------------------
 
 #=============================================================================
@@ -959,6 +1727,8 @@ class Scope(tcpdevice.TCPDevice):
 #-----------------------------------------------------------------------------
 
 	def seek_home(self):
+		self.estimator.reset()
+		self.tracking = None
 		try:
 			self.command_read('hF')
 		except:
@@ -1014,6 +1784,9 @@ class Scope(tcpdevice.TCPDevice):
 #-----------------------------------------------------------------------------
 
 	def move_park(self):
+		self.estimator.reset()
+		self.tracking = False
+		self.estimator.set_tracking_rate(0.0)
 		try:
 			self.command_read('hP')
 		except:
@@ -1103,19 +1876,29 @@ class Scope(tcpdevice.TCPDevice):
 #	- dec (0|1)
 #		Apply the slew rate to the Dec axis.
 # Description:
-#	Set the slew rate of the selected axis.
+#	Set the slew rate of the selected axis. The selected rate is kept in
+#	self.move_rate ('center', 'guide', 'find' or 'max'; None until set)
+#	and its speed in self.move_speed.
 #-----------------------------------------------------------------------------
 
 	def set_slew_rate(self, rate=None, ra=None, dec=None):
 		if rate:
 			if rate == 'center' or rate == 'c':
 				cmd = 'RC'
+				self.move_rate = 'center'
+				self.move_speed = 16 * SIDEREAL_SPEED
 			elif rate == 'guide' or rate == 'g':
 				cmd = 'RG'
+				self.move_rate = 'guide'
+				self.move_speed = 2 * SIDEREAL_SPEED
 			elif rate == 'find' or rate == 'f':
 				cmd = 'RM'
+				self.move_rate = 'find'
+				self.move_speed = 1.0
 			elif rate == 'max' or rate == 'm':
 				cmd = 'RS'
+				self.move_rate = 'max'
+				self.move_speed = self.slew_speed
 			else:
 				return
 			rcv = self.command_read(cmd)
@@ -1144,6 +1927,7 @@ class Scope(tcpdevice.TCPDevice):
 	def set_max_slew_rate(self, N):
 		cmd = 'SW%d' % (N,)
 		rcv = self.command_read(cmd)
+		self.slew_speed = float(N)
 		return rcv
 
 #-----------------------------------------------------------------------------
@@ -1206,22 +1990,17 @@ class Scope(tcpdevice.TCPDevice):
 #-----------------------------------------------------------------------------
 
 	def parse_coo(self, coo):
-		try:
-			d, m, s =  tuple(re.split("\*|:", coo))
-		except:
-			d, m, s = ('00', '00', '00')
-		if '#' in d:
-			tmp = d.split('#')[1]
-			d = tmp
-		return d, m, s
+		ret = coordinates.split_fields(coo)
+		if ret is None:
+			return ('00', '00', '00')
+		return ret
 
 #-----------------------------------------------------------------------------
 # parse_time
 #-----------------------------------------------------------------------------
 
 	def parse_time(self, time):
-		h, m, s = time.split(":")
-		return h, m, s
+		return self.parse_coo(time)
 
 #-----------------------------------------------------------------------------
 # parse_date
@@ -1233,36 +2012,31 @@ class Scope(tcpdevice.TCPDevice):
 
 #-----------------------------------------------------------------------------
 # format_coo
+# Synopsis:
+#	format_coo coo unit
+# Input:
+#	- coo (%f/%dms):
+#		Coordinate as decimal value or in dd:mm:ss format.
+#	- unit (d|h|a):
+#		Output format: sDD*MM:SS (d), HH:MM:SS (h) or DDD*MM:SS (a).
+# Description:
+#	Convert a coordinate to the Meade wire format.
 #-----------------------------------------------------------------------------
 
 	def format_coo(self, coo, unit='d'):
-		d, m, s =  coo.split(':')
-		str =  "%s:%s:%s" % (d, m, s)
-
-		if d[0] == '-':
-			sig = '-'
-		else:
-			sig = '+'
-		
-		id = abs(int(d))	
-		if id < 10:
-			d = "0%d" % (id,)
-		else:
-			d = "%d" % (id,)
-			
-		if unit == 'd':
-			str =  "%s%s*%s:%s" % (sig, d, m, s)
-		else:
-			str =  "%s:%s:%s" % (d, m, s)
-
-		return str
+		value = coordinates.parse_sexagesimal(coo)
+		if unit == 'h':
+			return coordinates.format_hms(value)
+		elif unit == 'a':
+			return coordinates.format_az(value)
+		return coordinates.format_dms(value)
 
 #-----------------------------------------------------------------------------
 # format_time
 #-----------------------------------------------------------------------------
 
 	def format_time(self, time):
-		h, m, s =  coo.split(':')
+		h, m, s =  time.split(':')
 		str =  "%s:%s:%s" % (h, m, s)
 		return str
 
@@ -1271,7 +2045,7 @@ class Scope(tcpdevice.TCPDevice):
 #-----------------------------------------------------------------------------
 
 	def format_date(self, date):
-		y, m, d =  coo.split('-')
+		y, m, d =  date.split('-')
 		y = y[-2:]
 		str =  "%s/%s/%s" % (m, d, y)
 		return str
@@ -1279,19 +2053,14 @@ class Scope(tcpdevice.TCPDevice):
 #-----------------------------------------------------------------------------
 # float2dms
 # Description:
-#	Convert a float or integer coordinate to dd:mm:ss format.
+#	Convert a float or integer coordinate to dd:mm:ss format (rounded to
+#	the nearest second, with '-' sign for negative values).
 #-----------------------------------------------------------------------------
 
 	def float2dms(self, dd):
 		if type(dd) is str:
 			return dd
-		deg = int(dd)
-		minsec = divmod((dd-deg)*60.0, 60)[-1]
-		min = int(minsec)
-		secs = divmod((minsec-min)*60.0, 60)[-1]
-		sec = int(secs)
-		dms = "%02d:%02d:%02d" % (deg, min, sec)
-		return dms
+		return coordinates.format_sexagesimal(dd)
 
 #-----------------------------------------------------------------------------
 
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+#=============================================================================
+
+import numpy
+
+#=============================================================================
+# SlewModel
+#=============================================================================
+#
+# Class: SlewModel
+#
+# Model of the goto slew duration, fitted from recorded slews.  The
+# duration of a slew depends on the largest axis distance d [deg] and the
+# maximum slew rate v [deg/s] (set_max_slew_rate).  With a trapezoidal
+# velocity profile it is well described by
+#
+#	t = c0 + c1 * d/v + c2 * sqrt(d)
+#
+# where c0 is the settle/command overhead, c1 ~ 1 for the constant speed
+# part and c2 covers the acceleration phase of short slews.  The
+# coefficients are fitted by least squares once enough slews are recorded;
+# until then a conservative default is used.
+#
+# Units: RA in hours, Dec in degrees, durations in seconds.  The prediction
+# functions accept NumPy arrays and broadcast them, so slew cost matrices
+# can be built in one call.
+#
+#=============================================================================
+
+class SlewModel(object):
+
+#-----------------------------------------------------------------------------
+# SlewModel::__init__
+# Input:
+#	- nmin (%d):
+#		Number of recorded slews needed before the model is fitted.
+#	- nmax (%d):
+#		Number of most recent slews used in the fit.
+#-----------------------------------------------------------------------------
+
+	def __init__(self, nmin=5, nmax=500):
+		self.nmin = nmin
+		self.nmax = nmax
+		self.coeffs = numpy.array([5.0, 1.0, 1.0])
+		self.std = None
+		self.records = []
+		return
+
+#-----------------------------------------------------------------------------
+# SlewModel::distance
+# Synopsis:
+#	distance ra1 dec1 ra2 dec2
+# Description:
+#	Largest axis distance [deg] of the slews from $ra1, $dec1 to $ra2,
+#	$dec2. The RA difference is taken the short way around.
+#-----------------------------------------------------------------------------
+
+	def distance(self, ra1, dec1, ra2, dec2):
+		dra = numpy.abs(numpy.mod(numpy.subtract(ra2, ra1) + 12.0, 24.0) - 12.0)
+		ddec = numpy.abs(numpy.subtract(dec2, dec1))
+		return numpy.maximum(dra * 15.0, ddec)
+
+#-----------------------------------------------------------------------------
+# SlewModel::features
+# Description:
+#	Design matrix columns for distance $d and speed $v. For internal use.
+#-----------------------------------------------------------------------------
+
+	def features(self, d, v):
+		d = numpy.asarray(d, dtype=float)
+		v = numpy.asarray(v, dtype=float)
+		return [numpy.ones(numpy.broadcast(d, v).shape), d / v, numpy.sqrt(d)]
+
+#-----------------------------------------------------------------------------
+# SlewModel::predict
+# Synopsis:
+#	predict ra1 dec1 ra2 dec2 speed
+# Description:
+#	Predicted duration [s] of the slews from $ra1, $dec1 to $ra2, $dec2 at
+#	maximum slew rate $speed [deg/s].
+#-----------------------------------------------------------------------------
+
+	def predict(self, ra1, dec1, ra2, dec2, speed):
+		d = self.distance(ra1, dec1, ra2, dec2)
+		return self.predict_distance(d, speed)
+
+#-----------------------------------------------------------------------------
+# SlewModel::predict_distance
+# Description:
+#	Predicted duration [s] of slews of $d degrees at $speed [deg/s].
+#-----------------------------------------------------------------------------
+
+	def predict_distance(self, d, speed):
+		f = self.features(d, speed)
+		t = self.coeffs[0] * f[0] + self.coeffs[1] * f[1] + self.coeffs[2] * f[2]
+		return numpy.maximum(t, 0.0)
+
+#-----------------------------------------------------------------------------
+# SlewModel::predict_matrix
+# Synopsis:
+#	predict_matrix ra dec speed
+# Description:
+#	Matrix of predicted slew durations [s] between all pairs of the
+#	positions $ra, $dec (RA in 0-24h).  Computed in place in single
+#	precision, so that matrices of several thousand targets are cheap.
+#-----------------------------------------------------------------------------
+
+	def predict_matrix(self, ra, dec, speed):
+		ra = numpy.asarray(ra, dtype=numpy.float32)
+		dec = numpy.asarray(dec, dtype=numpy.float32)
+		d = numpy.subtract.outer(ra, ra)
+		numpy.abs(d, out=d)
+		numpy.minimum(d, 24.0 - d, out=d)
+		d *= 15.0
+		ddec = numpy.subtract.outer(dec, dec)
+		numpy.abs(ddec, out=ddec)
+		numpy.maximum(d, ddec, out=d)
+		del ddec
+
+		c0, c1, c2 = self.coeffs
+		t = numpy.sqrt(d)
+		t *= c2
+		d *= c1 / speed
+		t += d
+		t += c0
+		numpy.maximum(t, 0.0, out=t)
+		return t
+
+#-----------------------------------------------------------------------------
+# SlewModel::timeout
+# Description:
+#	Timeout [s] for a slew with predicted duration $t: generous until the
+#	model is fitted, a few standard deviations afterwards.
+#-----------------------------------------------------------------------------
+
+	def timeout(self, t):
+		if self.std is None:
+			return 2.0 * t + 10.0
+		return 1.1 * t + max(4.0 * self.std, 2.0)
+
+#-----------------------------------------------------------------------------
+# SlewModel::lead
+# Description:
+#	Time [s] before the predicted arrival from when the slew status should
+#	be polled densely.
+#-----------------------------------------------------------------------------
+
+	def lead(self, t):
+		if self.std is None:
+			return 0.5 * t
+		return 0.05 * t + max(2.0 * self.std, 0.5)
+
+#-----------------------------------------------------------------------------
+# SlewModel::record
+# Synopsis:
+#	record ra1 dec1 ra2 dec2 speed duration
+# Description:
+#	Record an observed slew and refit the model.
+#-----------------------------------------------------------------------------
+
+	def record(self, ra1, dec1, ra2, dec2, speed, duration):
+		d = float(self.distance(ra1, dec1, ra2, dec2))
+		self.records.append((d, float(speed), float(duration)))
+		del self.records[:-self.nmax]
+		self.fit()
+		return
+
+#-----------------------------------------------------------------------------
+# SlewModel::fit
+# Description:
+#	Least squares fit of the coefficients to the recorded slews.
+#-----------------------------------------------------------------------------
+
+	def fit(self):
+		if len(self.records) < self.nmin:
+			return False
+		d, v, t = numpy.array(self.records).T
+		a = numpy.array(self.features(d, v)).T
+		coeffs, res, rank, sv = numpy.linalg.lstsq(a, t, rcond=None)
+		if rank < a.shape[1]:
+			return False
+		self.coeffs = coeffs
+		dof = max(len(t) - a.shape[1], 1)
+		self.std = float(numpy.sqrt(numpy.sum((a.dot(coeffs) - t)**2) / dof))
+		return True
+
+#-----------------------------------------------------------------------------
+# SlewModel::save
+# Description:
+#	Save the recorded slews (distance, speed, duration) to $filename.
+#-----------------------------------------------------------------------------
+
+	def save(self, filename):
+		numpy.savetxt(filename, numpy.array(self.records).reshape(-1, 3),
+			header='distance[deg] speed[deg/s] duration[s]')
+		return
+
+#-----------------------------------------------------------------------------
+# SlewModel::load
+# Description:
+#	Load recorded slews from $filename and refit the model.
+#-----------------------------------------------------------------------------
+
+	def load(self, filename):
+		records = numpy.loadtxt(filename, ndmin=2)
+		self.records = [tuple(x) for x in records[-self.nmax:]]
+		return self.fit()
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
@@ -3,6 +3,8 @@
 
 import struct
 import socket
+import select
+import threading
 import time
 from optparse import OptionParser
 
@@ -36,6 +38,9 @@ class TCPDevice(object):
 		self.timeout = {}
 		self.timeout['default'] = 120
 		self.formatstr = ''
+		self.delimiter = '\n'
+		self.lock = threading.RLock()
+		self.unread = 0
 		return
 
 #-----------------------------------------------------------------------------
@@ -151,6 +156,51 @@ class TCPDevice(object):
 			rcv = None
 		return rcv
 
+#-----------------------------------------------------------------------------
+# Device::read_replies
+# Synopsis:
+#	Device::read_replies n timeout
+# Input:
+#	- n (%d):
+#		Number of expected replies.
+#	- timeout (%f):
+#		Maximum time to wait for the replies [s].
+# Description:
+#	Read the device socket until $n replies separated by the reply
+#	delimiter arrived or timeout occurs.  Unlike read(), the function
+#	returns as soon as the last reply is received.
+# Return:
+#	List of the received replies. The list is shorter than $n if timeout
+#	occured.
+#-----------------------------------------------------------------------------
+
+	def read_replies(self, n, timeout=1.0):
+		if self.socket is None:
+			return []
+		buf = ''
+		replies = []
+		end = time.time() + timeout
+		while len(replies) < n:
+			wait = end - time.time()
+			if wait <= 0.0:
+				break
+			try:
+				ready = select.select([self.socket], [], [], wait)[0]
+				if not ready:
+					break
+				rcv = self.socket.recv(1024)
+			except:
+				break
+			if not rcv:
+				break
+			buf += rcv
+			parts = buf.split(self.delimiter)
+			buf = parts.pop()
+			replies.extend(parts)
+		if buf and len(replies) < n:
+			replies.append(buf)
+		return [x.strip('\r\n').lstrip('=') for x in replies]
+
 #-----------------------------------------------------------------------------
 
 #=============================================================================
@@ -203,14 +253,88 @@ class TCPDevice(object):
 #-----------------------------------------------------------------------------
 
 	def command_read(self, cmd, sleep=0.3):
-		if not self.command(cmd):
-			return False
-		time.sleep(sleep)
-		rcv = self.read()
+		with self.lock:
+			self.flush_replies()
+			if not self.command(cmd):
+				return False
+			time.sleep(sleep)
+			rcv = self.read()
 		if rcv:
 			rcv = rcv.rstrip('#\r').lstrip('=')
 		return rcv
 
+#-----------------------------------------------------------------------------
+# Device::command_pipeline
+# Synopsis:
+#	Device::command_pipeline cmds timeout
+#	- cmds (list):
+#		List of commands to be sent to the device.
+#	- timeout (%f):
+#		Maximum time to wait for the replies [s].
+# Description:
+#	Send all commands in $cmds in a single write and collect the replies
+#	in one pass, instead of sleeping after every command as command_read()
+#	does.  The whole burst costs one round trip.  Like command_read(), the
+#	exchange holds self.lock, so that background threads sharing the
+#	socket do not mix up their replies.
+# Return:
+#	List of replies in the order of the commands, or False if the write
+#	failed.
+#-----------------------------------------------------------------------------
+
+	def command_pipeline(self, cmds, timeout=1.0):
+		if not cmds:
+			return []
+		acmd = ''.join([self.formatstr % (cmd,) for cmd in cmds])
+		with self.lock:
+			self.flush_replies()
+			if not self.write(acmd):
+				return False
+			return self.read_replies(len(cmds), timeout)
+
+#-----------------------------------------------------------------------------
+# Device::command_nowait
+# Synopsis:
+#	Device::command_nowait cmd
+#	- cmd (%s):
+#		Command to be sent to the device.
+# Description:
+#	Send $cmd without waiting for its reply.  The reply is discarded
+#	later, before the next command which reads its own reply (see
+#	flush_replies()).
+# Return:
+#	True/False
+#-----------------------------------------------------------------------------
+
+	def command_nowait(self, cmd):
+		with self.lock:
+			if not self.command(cmd):
+				return False
+			self.unread += 1
+		return True
+
+#-----------------------------------------------------------------------------
+# Device::flush_replies
+# Description:
+#	Discard the replies of the commands sent by command_nowait(), waiting
+#	at most $timeout seconds for them to arrive. For internal use.
+#-----------------------------------------------------------------------------
+
+	def flush_replies(self, timeout=0.2):
+		if not self.unread or self.socket is None:
+			return
+		wait = timeout
+		while True:
+			try:
+				ready = select.select([self.socket], [], [], wait)[0]
+				if not ready or not self.socket.recv(1024):
+					break
+			except:
+				break
+			wait = 0.0
+		self.unread = 0
+		return
+
 #-----------------------------------------------------------------------------
 
 #=============================================================================
@@ -226,7 +350,13 @@ class TCPDevice(object):
 		return self.timeout['default']
 
 #-----------------------------------------------------------------------------
-# TCPDevice::waitfor
+
+#=============================================================================
+# Module functions
+#=============================================================================
+
+#-----------------------------------------------------------------------------
+# waitfor
 # Synopsis:
 #	waitfor method condition value timeout poll init debug
 # Input:
@@ -238,21 +368,21 @@ class TCPDevice(object):
 #	allowed time defined in $timeout is passed, returns False,
 #-----------------------------------------------------------------------------
 
-	def waitfor(method, condition, value, timeout=30.0, poll=0.2, init=0.2, 
-		debug=False):
-		end = time.time() + timeout
-		if init > 0.0:
-			time.sleep(init)
-		while time.time() < end:
-			ret = method()
-			e = 'ret %s value' % condition
-			status = eval(e)
-			if debug:
-				print e, ret, value, status
-			if status:
-				return True
-			time.sleep(poll)
-		return False
+def waitfor(method, condition, value, timeout=30.0, poll=0.2, init=0.2, 
+	debug=False):
+	end = time.time() + timeout
+	if init > 0.0:
+		time.sleep(init)
+	while time.time() < end:
+		ret = method()
+		e = 'ret %s value' % condition
+		status = eval(e)
+		if debug:
+			print e, ret, value, status
+		if status:
+			return True
+		time.sleep(poll)
+	return False
 
 #-----------------------------------------------------------------------------
 
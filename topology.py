@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+#=============================================================================
+
+from ConfigParser import RawConfigParser
+
+IHU_HOST = '192.168.9.2%d'
+IHU_PORT = 5000
+
+IHU_AXES = ('alt', 'alm', 'foc')
+
+#=============================================================================
+# Topology
+#=============================================================================
+#
+# Class: Topology
+#
+# Registry of the IHU controllers and IHUs: the host of every controller,
+# and the controller, motor ids per axis, port, wiring and step limits of
+# every IHU.  The registry is loaded once from a configuration file, and
+# the lookup tables (IHU -> motors, controller motor -> IHU and axis,
+# controller and axis -> bitmask) are built at load time, so every lookup
+# is a dictionary access.
+#
+# Configuration file (ConfigParser format):
+#
+#	[controller 1]
+#	host = 192.168.9.21		; default: IHU_HOST % number
+#	port = 5000				; default: IHU_PORT
+#
+#	[ihu 1]
+#	controller = 1
+#	slot = 1				; motors 3*slot-2 .. 3*slot (alt, alm, foc)
+#	alt = 1					; or the motor ids one by one
+#	alm = 2
+#	foc = 3
+#	port = 1				; default: port of the alt motor
+#	foc_wiring = 1			; 0: normal (default), 1: reverse
+#	foc_limits = -5000 5000	; step limits of the axis
+#
+#=============================================================================
+
+class Topology(object):
+
+#-----------------------------------------------------------------------------
+# Topology::__init__
+#-----------------------------------------------------------------------------
+
+	def __init__(self):
+		self.controllers = {}
+		self.ihus = {}
+		self.build()
+		return
+
+#-----------------------------------------------------------------------------
+# Topology::slot_motors
+# Description:
+#	Motor ids (alt, alm, foc) of slot $slot of a controller.
+#-----------------------------------------------------------------------------
+
+	@staticmethod
+	def slot_motors(slot):
+		m1 = slot * 3 - 2
+		return (m1, m1+1, m1+2)
+
+#-----------------------------------------------------------------------------
+# Topology::motor_port
+# Description:
+#	Default port of motor $id, three motors per port.
+#-----------------------------------------------------------------------------
+
+	@staticmethod
+	def motor_port(id):
+		return (id+2)/3
+
+#-----------------------------------------------------------------------------
+# Topology::add_controller
+#-----------------------------------------------------------------------------
+
+	def add_controller(self, number, host=None, port=None):
+		self.controllers[number] = (host or IHU_HOST % number, port or IHU_PORT)
+		return
+
+#-----------------------------------------------------------------------------
+# Topology::add_ihu
+# Synopsis:
+#	add_ihu ihu controller motors port wiring limits
+# Input:
+#	- ihu (%d):
+#		IHU number.
+#	- controller (%d):
+#		Controller number.
+#	- motors (tuple):
+#		Motor ids of the alt, alm and foc axes.
+#	- port (%d):
+#		Port of the IHU. Default: the port of the alt motor.
+#	- wiring (dict):
+#		Axis: wiring bit (0 normal, 1 reverse).
+#	- limits (dict):
+#		Axis: (min, max) step limits.
+# Description:
+#	Add an IHU. Call build() after the last one.
+#-----------------------------------------------------------------------------
+
+	def add_ihu(self, ihu, controller, motors, port=None, wiring=None,
+			limits=None):
+		if controller not in self.controllers:
+			self.add_controller(controller)
+		self.ihus[ihu] = {
+			'controller': controller,
+			'motors': tuple([int(x) for x in motors]),
+			'port': port or self.motor_port(int(motors[0])),
+			'wiring': wiring or {},
+			'limits': limits or {}}
+		return
+
+#-----------------------------------------------------------------------------
+# Topology::build
+# Description:
+#	Build the lookup tables. For internal use.
+#-----------------------------------------------------------------------------
+
+	def build(self):
+		self.owner = {}
+		self.masks = {}
+		self.by_controller = {}
+		for ihu in sorted(self.ihus):
+			x = self.ihus[ihu]
+			c = x['controller']
+			self.by_controller.setdefault(c, []).append(ihu)
+			masks = self.masks.setdefault(c, dict([(a, 0) for a in IHU_AXES + ('all',)]))
+			for axis, id in zip(IHU_AXES, x['motors']):
+				self.owner[(c, id)] = (ihu, axis)
+				masks[axis] |= 1 << (id-1)
+				masks['all'] |= 1 << (id-1)
+		return
+
+#-----------------------------------------------------------------------------
+# Topology::default
+# Description:
+#	Topology without a configuration file: IHUs 1-4 on slots 1-4 of
+#	controller 1.
+#-----------------------------------------------------------------------------
+
+	@classmethod
+	def default(cls):
+		t = cls()
+		for ihu in range(1, 5):
+			t.add_ihu(ihu, 1, cls.slot_motors(ihu))
+		t.build()
+		return t
+
+#-----------------------------------------------------------------------------
+# Topology::load
+# Description:
+#	Load the topology from the configuration file $filename.
+#-----------------------------------------------------------------------------
+
+	@classmethod
+	def load(cls, filename):
+		config = RawConfigParser()
+		if not config.read(filename):
+			raise IOError('can not read %s' % filename)
+
+		t = cls()
+		for section in config.sections():
+			kind, number = section.split()
+			if kind == 'controller':
+				get = lambda x: config.get(section, x) if config.has_option(section, x) else None
+				port = get('port')
+				t.add_controller(int(number), get('host'), port and int(port))
+
+		for section in config.sections():
+			kind, number = section.split()
+			if kind != 'ihu':
+				continue
+			opt = dict(config.items(section))
+			if 'slot' in opt:
+				motors = list(cls.slot_motors(int(opt['slot'])))
+			else:
+				motors = [None, None, None]
+			for i, axis in enumerate(IHU_AXES):
+				if axis in opt:
+					motors[i] = int(opt[axis])
+			wiring = {}
+			limits = {}
+			for axis in IHU_AXES:
+				if axis + '_wiring' in opt:
+					wiring[axis] = int(opt[axis + '_wiring'])
+				if axis + '_limits' in opt:
+					limits[axis] = tuple([int(x) for x in opt[axis + '_limits'].split()])
+			port = opt.get('port')
+			t.add_ihu(int(number), int(opt['controller']), motors,
+				port and int(port), wiring, limits)
+		t.build()
+		return t
+
+#-----------------------------------------------------------------------------
+# Topology lookups
+#-----------------------------------------------------------------------------
+
+	def get_address(self, controller):
+		return self.controllers[controller]
+
+	def get_controller(self, ihu):
+		return self.ihus[ihu]['controller']
+
+	def get_motor_ids(self, ihu):
+		return self.ihus[ihu]['motors']
+
+	def get_motor_id(self, ihu, axis):
+		return self.ihus[ihu]['motors'][IHU_AXES.index(axis)]
+
+	def get_port(self, ihu):
+		return self.ihus[ihu]['port']
+
+	def get_wiring(self, ihu):
+		return self.ihus[ihu]['wiring']
+
+	def get_limits(self, ihu):
+		return self.ihus[ihu]['limits']
+
+	def get_ihus(self, controller):
+		return self.by_controller.get(controller, [])
+
+	def get_mask(self, controller, axis='all'):
+		return self.masks[controller][axis]
+
+	def find_motor(self, controller, id):
+		return self.owner.get((controller, id))
+
+#-----------------------------------------------------------------------------
+
+#=============================================================================
+# Functions
+#=============================================================================
+
+#-----------------------------------------------------------------------------
+# load_topology
+# Description:
+#	Load the topology from $filename, or the default topology if no file
+#	is given.
+#-----------------------------------------------------------------------------
+
+def load_topology(filename=None):
+	if not filename:
+		return Topology.default()
+	return Topology.load(filename)
+
+#=============================================================================